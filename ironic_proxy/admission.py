@@ -0,0 +1,228 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Admission control and fair queuing of requests to sources."""
+
+import collections
+import contextlib
+import heapq
+import itertools
+import math
+import threading
+import time
+
+import flask
+
+from ironic_proxy import common
+from ironic_proxy import metrics
+
+
+# Priority classes, the first one is admitted first
+PRIORITIES = ('write', 'read', 'list')
+_LOCAL = threading.local()
+
+QUEUED = metrics.Gauge(
+    'ironic_proxy_admission_queued',
+    'Requests waiting for admission to a source', labels=('source',))
+QUEUE_DURATION = metrics.Histogram(
+    'ironic_proxy_admission_wait_seconds',
+    'Time requests waited for admission to a source',
+    labels=('source', 'priority'))
+REJECTED = metrics.Counter(
+    'ironic_proxy_admission_rejected_total',
+    'Requests to sources rejected because of overload',
+    labels=('source', 'reason'))
+
+
+class Overloaded(common.Error):
+    """The request was not admitted, the client should retry later."""
+
+    def __init__(self, message, code=503, retry_after=1, **kwargs):
+        super(Overloaded, self).__init__(message, code=code, **kwargs)
+        self.retry_after = retry_after
+
+
+def priority(method, category):
+    """Get the priority class of a request to a source."""
+    if category == 'list':
+        return 'list'
+    return 'read' if method in ('GET', 'HEAD') else 'write'
+
+
+def current_project():
+    """Get the project the current request is made for."""
+    project = getattr(_LOCAL, 'project', None)
+    if project is None:
+        try:
+            project = flask.request.headers.get('X-Project-Id')
+        except RuntimeError:
+            pass
+    return project or ''
+
+
+@contextlib.contextmanager
+def acting_for(project):
+    """Make requests in this thread on behalf of the project."""
+    previous = getattr(_LOCAL, 'project', None)
+    _LOCAL.project = project
+    try:
+        yield
+    finally:
+        _LOCAL.project = previous
+
+
+class _Ticket(object):
+
+    def __init__(self, project):
+        self.project = project
+        self.event = threading.Event()
+        self.admitted = False
+        self.cancelled = False
+
+
+class Scheduler(object):
+    """Limits the number of concurrent requests to one source.
+
+    Requests over the limit wait in a queue. Higher priority classes are
+    admitted first, within a class projects share the source according to
+    their weights (start-time fair queuing). Requests are rejected when the
+    queue (or the share of the project in it) is full or when they wait for
+    too long.
+
+    :param concurrency: maximum number of concurrent requests, 0 to disable
+        admission control.
+    :param max_queued: maximum number of waiting requests, 0 for no limit.
+    :param max_queued_per_project: maximum number of waiting requests of
+        one project, 0 for no limit.
+    :param queue_timeout: maximum time (in seconds) to wait for admission,
+        0 for no limit.
+    :param weights: dictionary mapping projects to their weights (1 by
+        default).
+    """
+
+    def __init__(self, name=None, concurrency=0, max_queued=0,
+                 max_queued_per_project=0, queue_timeout=0, weights=None):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        self.max_queued_per_project = max_queued_per_project
+        self.queue_timeout = queue_timeout
+        self.weights = weights or {}
+        self._active = 0
+        self._waiting = 0
+        self._queues = {prio: [] for prio in PRIORITIES}
+        self._queued = collections.Counter()
+        self._finish = {}
+        self._virtual = 0.0
+        self._counter = itertools.count()
+        self._hold = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_options(cls, name, options, weights=None):
+        """Create a scheduler from a configuration group."""
+        return cls(name=name, concurrency=options.max_concurrency,
+                   max_queued=options.max_queued,
+                   max_queued_per_project=options.max_queued_per_project,
+                   queue_timeout=options.queue_timeout, weights=weights)
+
+    def _retry_after(self):
+        """Estimate the time (in seconds) until the queue is drained."""
+        estimate = self._hold * (self._waiting + 1) / self.concurrency
+        return max(1, int(math.ceil(estimate)))
+
+    def _reject(self, message, code, reason):
+        REJECTED.inc(source=self.name, reason=reason)
+        return Overloaded(message, code=code, retry_after=self._retry_after(),
+                          name=self.name)
+
+    def acquire(self, prio, project):
+        """Wait until a request can be sent.
+
+        :raises: Overloaded if the request is rejected.
+        """
+        if not self.concurrency:
+            return
+
+        with self._lock:
+            # Nothing is queued while there are free slots
+            if self._active < self.concurrency:
+                self._active += 1
+                return
+
+            if self.max_queued and self._waiting >= self.max_queued:
+                raise self._reject('Source {name} is overloaded', 503,
+                                   'queue_full')
+            per_project = self.max_queued_per_project
+            if per_project and self._queued[project] >= per_project:
+                raise self._reject('Too many requests to source {name}, '
+                                   'slow down', 429, 'project_limit')
+
+            start = max(self._virtual, self._finish.get(project, 0.0))
+            self._finish[project] = start + 1.0 / self.weights.get(project,
+                                                                   1.0)
+            ticket = _Ticket(project)
+            heapq.heappush(self._queues[prio],
+                           (start, next(self._counter), ticket))
+            self._queued[project] += 1
+            self._waiting += 1
+        QUEUED.inc(source=self.name)
+
+        started = time.time()
+        try:
+            ticket.event.wait(self.queue_timeout or None)
+            with self._lock:
+                if not ticket.admitted:
+                    ticket.cancelled = True
+                    self._dequeued(ticket)
+                    raise self._reject('Source {name} did not admit the '
+                                       'request in time', 503, 'timeout')
+        finally:
+            QUEUED.dec(source=self.name)
+            QUEUE_DURATION.observe(time.time() - started, source=self.name,
+                                   priority=prio)
+
+    def _dequeued(self, ticket):
+        self._waiting -= 1
+        self._queued[ticket.project] -= 1
+        if not self._queued[ticket.project]:
+            del self._queued[ticket.project]
+
+    def _next(self):
+        for prio in PRIORITIES:
+            queue = self._queues[prio]
+            while queue:
+                start, _count, ticket = heapq.heappop(queue)
+                if not ticket.cancelled:
+                    self._virtual = max(self._virtual, start)
+                    return ticket
+
+    def release(self, elapsed=0):
+        """Mark a request as finished, admit the next one."""
+        if not self.concurrency:
+            return
+
+        with self._lock:
+            self._hold = 0.8 * self._hold + 0.2 * elapsed
+            ticket = self._next()
+            if ticket is None:
+                self._active -= 1
+                if not self._active:
+                    # Idle, forget the history of projects
+                    self._finish.clear()
+                    self._virtual = 0.0
+                return
+
+            # The slot is passed to the next request
+            ticket.admitted = True
+            self._dequeued(ticket)
+            ticket.event.set()
@@ -10,22 +10,66 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import json
 import sys
+import threading
+import time
 
 import flask
-from keystonemiddleware import auth_token
 from oslo_log import log
+import six
 from six.moves.urllib import parse as urlparse
 
+from ironic_proxy import cache
 from ironic_proxy import common
+from ironic_proxy import compression
 from ironic_proxy import conf
+from ironic_proxy import feed
+from ironic_proxy import formats
 from ironic_proxy import groups
 from ironic_proxy import ironic
+from ironic_proxy import metrics
+from ironic_proxy import pagination
+from ironic_proxy import resources
+from ironic_proxy import tracing
 
 
 app = flask.Flask('ironic-proxy')
 app.url_map.strict_slashes = False
 LOG = log.getLogger(__name__)
+_RESPONSES = None
+# WSGI environment key to pass the shared cache to keystonemiddleware
+_AUTH_CACHE_KEY = 'ironic_proxy.cache'
+# Endpoints which responses can be cached
+_CACHED_ENDPOINTS = ('nodes', 'node')
+# Cache tag for all node listings
+_LIST_TAG = '<list>'
+# Media type of server-sent events
+_EVENT_STREAM = 'text/event-stream'
+# Methods allowed in batch operations
+_BATCH_METHODS = ('GET', 'PATCH', 'PUT', 'POST', 'DELETE')
+# Headers that only make sense for one connection (RFC 7230) or are set by
+# the proxy itself
+_SKIPPED_HEADERS = frozenset(['connection', 'keep-alive', 'proxy-authenticate',
+                              'proxy-authorization', 'te', 'trailer',
+                              'transfer-encoding', 'upgrade', 'date',
+                              'server', ironic.MIN_VERSION_HEADER.lower(),
+                              ironic.MAX_VERSION_HEADER.lower()])
+# Request headers passed to the sources
+_FORWARDED_HEADERS = ('Content-Type', 'Content-Encoding')
+_CHUNK_SIZE = 65536
+# Paths that do not require authentication and microversion negotiation
+_UNVERSIONED = ('', '/v1', '/metrics', '/ready')
+# Paths that do not report microversions
+_NO_MICROVERSIONS = ('/', '/metrics', '/ready')
+
+REQUEST_DURATION = metrics.Histogram(
+    'ironic_proxy_request_duration_seconds',
+    'Duration of API requests (until the first byte for streamed responses)',
+    labels=('endpoint', 'method', 'status'))
+RESPONSE_CACHE_LOOKUPS = metrics.Counter(
+    'ironic_proxy_response_cache_lookups_total',
+    'Lookups in the response cache', labels=('result',))
 
 
 @app.errorhandler(Exception)
@@ -38,6 +82,14 @@ def handle_error(exc):
             'faultcode': 'Client',
             'debuginfo': None,
         }
+    elif isinstance(exc, common.Error):
+        # Expected server-side errors, e.g. unavailable sources
+        LOG.warning('Server error %d: %s', code, exc)
+        body = {
+            'faultstring': str(exc),
+            'faultcode': 'Server',
+            'debuginfo': None,
+        }
     else:
         LOG.exception('Internal server error')
         body = {
@@ -48,6 +100,9 @@ def handle_error(exc):
 
     resp = flask.jsonify(error_message=body)
     resp.status_code = code
+    retry_after = getattr(exc, 'retry_after', None)
+    if retry_after is not None:
+        resp.headers['Retry-After'] = str(retry_after)
     return resp
 
 
@@ -55,6 +110,215 @@ def _url(path):
     return urlparse.urljoin(flask.request.script_root, path)
 
 
+def _response_cache():
+    global _RESPONSES
+    if _RESPONSES is None:
+        _RESPONSES = cache.ResponseCache(conf.CONF.api.response_cache_size,
+                                         conf.CONF.api.response_cache_ttl)
+    return _RESPONSES
+
+
+def _response_cache_key():
+    return (flask.request.path,
+            tuple(sorted(flask.request.args.items(multi=True))),
+            getattr(flask.request, 'microversion', None),
+            flask.request.headers.get('X-Project-Id'),
+            formats.negotiate(flask.request.accept_mimetypes))
+
+
+def _invalidate(node_id):
+    if conf.CONF.api.response_cache_ttl:
+        _response_cache().invalidate({node_id, _LIST_TAG})
+
+
+def _stream_items(items, key):
+    yield '{"%s": [' % key
+    for index, item in enumerate(items):
+        if index:
+            yield ', '
+        yield json.dumps(item)
+    yield ']}'
+
+
+def _list_nodes(params=None):
+    nodes, marker = groups.list_nodes(params)
+    return _listing('nodes', nodes, marker, params, {_LIST_TAG})
+
+
+def _listing(key, items, marker, params=None, cache_tags=None):
+    """Render a listing of nodes or other resources."""
+    media_type = formats.negotiate(flask.request.accept_mimetypes)
+    if media_type != formats.JSON:
+        fields = (params or flask.request.args).get('fields')
+        columns, items = formats.columns(fields, items)
+
+    # MessagePack cannot be streamed item by item.
+    streamable = media_type != formats.MSGPACK
+    if marker is None and streamable and conf.CONF.api.stream_listings:
+        if media_type == formats.JSON:
+            body = _stream_items(items, key)
+        else:
+            body = formats.stream_columnar_json(items, columns)
+        resp = flask.Response(body, mimetype=media_type)
+        resp.vary.add('Accept')
+        return resp
+
+    if cache_tags:
+        flask.request.cache_tags = cache_tags
+    next_link = None
+    if marker:
+        args = dict(flask.request.args, marker=marker)
+        next_link = '%s?%s' % (flask.request.base_url,
+                               urlparse.urlencode(args))
+
+    with tracing.span('encode'):
+        if media_type == formats.JSON:
+            result = {key: list(items)}
+            if next_link:
+                result['next'] = next_link
+            resp = flask.jsonify(result)
+        else:
+            resp = flask.Response(formats.encode(media_type, items, columns,
+                                                 next_link),
+                                  mimetype=media_type)
+    resp.vary.add('Accept')
+    return resp
+
+
+def _is_node_path(path):
+    """Whether the path is relative to a node and stays below it."""
+    if not isinstance(path, six.string_types):
+        return False
+    if path.startswith('/') or any(c in path for c in '?#:\\'):
+        return False
+    segments = urlparse.unquote(path).split('/')
+    return not any(segment in ('.', '..') for segment in segments)
+
+
+def _validate_batch(body):
+    operations = body.get('operations') if isinstance(body, dict) else None
+    if not isinstance(operations, list):
+        raise common.Error('A list of operations is required')
+    if len(operations) > conf.CONF.api.max_batch_size:
+        raise common.Error('At most {max} operations are allowed in one '
+                           'batch', max=conf.CONF.api.max_batch_size)
+
+    for index, op in enumerate(operations):
+        if not isinstance(op, dict) or not op.get('node'):
+            raise common.Error('Operation {index} does not specify a node',
+                               index=index)
+        method = str(op.get('method', '')).upper()
+        if method not in _BATCH_METHODS:
+            raise common.Error('Operation {index} has an invalid method '
+                               '{method}', index=index, method=method)
+        op['method'] = method
+        if op.get('path') and not _is_node_path(op['path']):
+            raise common.Error('Operation {index} has an invalid path '
+                               '{path}', index=index, path=op['path'])
+    return operations
+
+
+def _stream_batch(operations, results):
+    yield '{"results": ['
+    for index, result in enumerate(results):
+        if operations[result['index']]['method'] != 'GET':
+            _invalidate(result['node'])
+        if index:
+            yield ', '
+        yield json.dumps(result)
+    yield ']}'
+
+
+def _float_param(name, default, maximum):
+    value = flask.request.args.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        value = float(value)
+    except ValueError:
+        raise common.Error('Invalid {name} {value}', name=name, value=value)
+    if value < 0:
+        raise common.Error('{name} must be positive, got {value}',
+                           name=name, value=value)
+    return min(value, maximum)
+
+
+def _stream_events(changes, cursor):
+    heartbeat = conf.CONF.feed.heartbeat_interval
+    while True:
+        events, cursor = changes.changes(cursor, heartbeat)
+        if not events:
+            yield ': keep-alive\n\n'
+        for event in events:
+            yield 'id: %s\nevent: %s\ndata: %s\n\n' % (
+                event['cursor'], event['event'], json.dumps(event))
+
+
+class _SizedStream(object):
+    """A request body stream of a known length."""
+
+    def __init__(self, stream, length):
+        self._stream = stream
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        return self._stream.read(size)
+
+
+def _iter_stream(stream):
+    while True:
+        chunk = stream.read(_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _relay(resp):
+    try:
+        for chunk in _iter_stream(resp.raw):
+            yield chunk
+    finally:
+        resp.close()
+
+
+def _passthrough(ident, resource=None):
+    """Relay the current request to the source of the node as it is.
+
+    :param ident: node identifier, or an identifier of the resource.
+    :param resource: Resource the identifier belongs to, defaults to nodes.
+    """
+    request = flask.request
+    if request.content_length:
+        body = _SizedStream(request.stream, request.content_length)
+    elif request.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        body = _iter_stream(request.stream)
+    else:
+        body = None
+    headers = {name: request.headers[name] for name in _FORWARDED_HEADERS
+               if name in request.headers}
+    # The body is relayed as it is, so the source must only
+    # use the encodings the client accepts.
+    accept_encoding = request.headers.get('Accept-Encoding')
+    headers['Accept-Encoding'] = accept_encoding or 'identity'
+
+    resp = groups.proxy_raw(ident, request.path, request.method,
+                            params=request.args, body=body, headers=headers,
+                            resource=resource)
+    headers = [(name, value) for name, value in resp.headers.items()
+               if name.lower() not in _SKIPPED_HEADERS]
+    for index, (name, value) in enumerate(headers):
+        if name.lower() == 'location':
+            # Point to the proxy instead of the source
+            location = urlparse.urlsplit(value)
+            headers[index] = (name, urlparse.urlunsplit(
+                location._replace(scheme='', netloc='')))
+    return flask.Response(_relay(resp), status=resp.status_code,
+                          headers=headers, direct_passthrough=True)
+
+
 def _api_version(path):
     minv, maxv = groups.microversions()
     return {
@@ -67,8 +331,18 @@ def _api_version(path):
 
 
 @app.before_request
+def start_timer():
+    flask.request.start_time = time.time()
+    if conf.CONF.tracing.enabled:
+        flask.request.trace = tracing.start(
+            '%s %s' % (flask.request.method, flask.request.path),
+            flask.request.headers.get(tracing.TRACEPARENT_HEADER))
+
+
+@app.before_request
+@tracing.traced('check_auth')
 def check_auth():
-    if flask.request.path.rstrip('/') in ('', '/v1'):
+    if flask.request.path.rstrip('/') in _UNVERSIONED:
         return
 
     if conf.CONF.api.auth_strategy == 'none':
@@ -79,8 +353,9 @@ def check_auth():
 
 
 @app.before_request
+@tracing.traced('check_microversion')
 def check_microversion():
-    if flask.request.path == '/':
+    if flask.request.path in _NO_MICROVERSIONS:
         return
 
     mversion = flask.request.headers.get(ironic.VERSION_HEADER)
@@ -103,9 +378,92 @@ def check_microversion():
     flask.request.microversion = mversion
 
 
+@app.before_request
+def serve_cached():
+    if not conf.CONF.api.response_cache_ttl:
+        return
+
+    if flask.request.method != 'GET':
+        return
+    if flask.request.endpoint not in _CACHED_ENDPOINTS:
+        return
+
+    cached = _response_cache().get(_response_cache_key())
+    RESPONSE_CACHE_LOOKUPS.inc(result='miss' if cached is None else 'hit')
+    if cached is not None:
+        flask.request.cache_hit = True
+        body, mimetype = cached
+        return flask.Response(body, mimetype=mimetype)
+
+
+def _compression_level():
+    level = conf.CONF.compression.route_levels.get(flask.request.endpoint)
+    if level is None:
+        return conf.CONF.compression.level
+    return int(level)
+
+
+# The after_request functions are called in the reverse order,
+# so responses are compressed after they are cached and get their ETags.
+@app.after_request
+def compress_response(resp):
+    if resp.status_code < 200 or resp.status_code in (204, 304):
+        return resp
+    if resp.direct_passthrough or 'Content-Encoding' in resp.headers:
+        return resp
+    if flask.request.method == 'HEAD':
+        return resp
+
+    level = _compression_level()
+    if not level or not conf.CONF.compression.encodings:
+        return resp
+
+    resp.vary.add('Accept-Encoding')
+    encoding = compression.negotiate(flask.request.accept_encodings,
+                                     conf.CONF.compression.encodings)
+    if encoding is None:
+        return resp
+
+    if resp.is_streamed:
+        resp.response = compression.compress_stream(
+            encoding, level, resp.response,
+            flush_every_chunk=(resp.mimetype == _EVENT_STREAM))
+    else:
+        data = resp.get_data()
+        if len(data) < conf.CONF.compression.min_size:
+            return resp
+        with tracing.span('compress', encoding=encoding):
+            resp.set_data(compression.compress(encoding, level, data))
+
+    resp.headers['Content-Encoding'] = encoding
+    etag, weak = resp.get_etag()
+    if etag and not weak:
+        # The compressed body is a different representation
+        resp.set_etag(etag, weak=True)
+    return resp
+
+
+@app.after_request
+def cache_response(resp):
+    if flask.request.method != 'GET' or resp.status_code != 200:
+        return resp
+
+    if resp.is_streamed:
+        return resp
+
+    tags = getattr(flask.request, 'cache_tags', None)
+    hit = getattr(flask.request, 'cache_hit', False)
+    if tags and not hit and conf.CONF.api.response_cache_ttl:
+        _response_cache().set(_response_cache_key(),
+                              (resp.get_data(), resp.mimetype), tags)
+
+    resp.add_etag()
+    return resp.make_conditional(flask.request)
+
+
 @app.after_request
 def report_microversions(resp):
-    if flask.request.path == '/':
+    if flask.request.path in _NO_MICROVERSIONS:
         return resp
 
     minv, maxv = groups.microversions()
@@ -114,6 +472,48 @@ def report_microversions(resp):
     return resp
 
 
+@app.after_request
+def record_duration(resp):
+    start = getattr(flask.request, 'start_time', None)
+    if start is not None:
+        REQUEST_DURATION.observe(time.time() - start,
+                                 endpoint=flask.request.endpoint or 'unknown',
+                                 method=flask.request.method,
+                                 status=resp.status_code)
+    return resp
+
+
+@app.after_request
+def report_timing(resp):
+    trace = getattr(flask.request, 'trace', None)
+    if trace is not None:
+        resp.headers['Server-Timing'] = trace.server_timing()
+    return resp
+
+
+@app.teardown_request
+def finish_trace(exc):
+    trace = getattr(flask.request, 'trace', None)
+    if trace is not None:
+        tracing.finish(trace)
+
+
+@app.route('/metrics', endpoint='metrics')
+def render_metrics():
+    if not conf.CONF.api.enable_metrics:
+        raise common.NotFound('Metrics are disabled')
+    return flask.Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route('/ready')
+def ready():
+    is_ready, details = groups.readiness()
+    resp = flask.jsonify(ready=is_ready, groups=details)
+    if not is_ready:
+        resp.status_code = 503
+    return resp
+
+
 @app.route('/')
 def root():
     v1 = _api_version('v1')
@@ -132,30 +532,68 @@ def versioned_root():
 @app.route('/v1/nodes', methods=['GET', 'POST'])
 def nodes():
     if flask.request.method == 'GET':
-        nodes = groups.list_nodes()
-        return flask.jsonify(nodes=nodes)
+        return _list_nodes()
     else:
         body = flask.request.get_json(force=True)
         node = groups.create_node(body)
+        _invalidate(node['uuid'])
         return flask.jsonify(node)
 
 
+@app.route('/proxy/v1/nodes/batch', methods=['POST'])
+def batch():
+    operations = _validate_batch(flask.request.get_json(force=True))
+    results = groups.batch(operations, conf.CONF.api.batch_concurrency)
+    return flask.Response(_stream_batch(operations, results),
+                          mimetype='application/json')
+
+
+@app.route('/proxy/v1/nodes/changes', methods=['GET'])
+def node_changes():
+    changes = feed.get_feed()
+    media_type = flask.request.accept_mimetypes.best_match(
+        ['application/json', _EVENT_STREAM])
+    if media_type == _EVENT_STREAM:
+        cursor = flask.request.headers.get('Last-Event-ID')
+        if not cursor:
+            cursor = flask.request.args.get('cursor') or changes.cursor()
+        # Validate the cursor before starting the stream
+        changes.changes(cursor)
+        return flask.Response(_stream_events(changes, cursor),
+                              mimetype=_EVENT_STREAM,
+                              headers={'Cache-Control': 'no-cache'})
+
+    max_wait = conf.CONF.feed.max_wait
+    timeout = _float_param('timeout', max_wait, max_wait)
+    limit = pagination.parse_limit(flask.request.args.get('limit'),
+                                   conf.CONF.api.max_limit)
+    events, cursor = changes.changes(flask.request.args.get('cursor'),
+                                     timeout, limit)
+    return flask.jsonify(changes=events, cursor=cursor)
+
+
 @app.route('/v1/nodes/<node>', methods=['GET', 'PATCH', 'DELETE'])
 def node(node):
     if flask.request.method == 'GET':
         if node == 'detail':
             params = dict(flask.request.args, detail=True)
-            nodes = groups.list_nodes(params)
-            return flask.jsonify(nodes=nodes)
+            return _list_nodes(params)
 
         result = groups.get_node(node)
         if result is None:
             raise common.NotFound("Node {node} was not found", node=node)
 
-        return flask.jsonify(result)
+        flask.request.cache_tags = {result['uuid'], result.get('name')}
+        with tracing.span('encode'):
+            return flask.jsonify(result)
+    elif conf.CONF.api.raw_passthrough:
+        resp = _passthrough(node)
+        _invalidate(node)
+        return resp
     else:
         has_body = flask.request.method == 'PATCH'
         body = groups.proxy_request(node, json_response=has_body)
+        _invalidate(node)
         if body:
             return flask.jsonify(body)
         else:
@@ -165,19 +603,117 @@ def node(node):
 @app.route('/v1/nodes/<node>/<path:path>',
            methods=['GET', 'PUT', 'POST', 'DELETE'])
 def node_action(node, path):
+    if conf.CONF.api.raw_passthrough:
+        resp = _passthrough(node)
+        if flask.request.method != 'GET':
+            _invalidate(node)
+        return resp
+
     has_body = flask.request.method == 'GET'
     body = groups.proxy_request(node, json_response=has_body)
+    if not has_body:
+        _invalidate(node)
     if body:
         return flask.jsonify(body)
     else:
         return '', 204
 
 
+def resource_collection(collection):
+    resource = resources.BY_NAME[collection]
+    if flask.request.method == 'GET':
+        items, marker = groups.list_resources(resource)
+        return _listing(resource.name, items, marker)
+    else:
+        body = flask.request.get_json(force=True)
+        resp = flask.jsonify(groups.create_resource(resource, body))
+        resp.status_code = 201
+        return resp
+
+
+def resource_item(collection, ident):
+    resource = resources.BY_NAME[collection]
+    if flask.request.method == 'GET':
+        if ident == 'detail' and resource.detail_path:
+            items, marker = groups.list_resources(resource)
+            return _listing(resource.name, items, marker)
+
+        result = groups.get_resource(resource, ident)
+        with tracing.span('encode'):
+            return flask.jsonify(result)
+    elif conf.CONF.api.raw_passthrough and not resource.broadcast:
+        return _passthrough(ident, resource)
+    else:
+        has_body = flask.request.method == 'PATCH'
+        if resource.broadcast:
+            body = groups.proxy_everywhere(ident, resource,
+                                           json_response=has_body)
+        else:
+            body = groups.proxy_request(ident, json_response=has_body,
+                                        resource=resource)
+        if body:
+            return flask.jsonify(body)
+        else:
+            return '', 204
+
+
+def resource_action(collection, ident, path):
+    resource = resources.BY_NAME[collection]
+    if conf.CONF.api.raw_passthrough:
+        return _passthrough(ident, resource)
+
+    has_body = flask.request.method == 'GET'
+    body = groups.proxy_request(ident, json_response=has_body,
+                                resource=resource)
+    if body:
+        return flask.jsonify(body)
+    else:
+        return '', 204
+
+
+for _resource in resources.ALL.values():
+    _defaults = {'collection': _resource.name}
+    app.add_url_rule(_resource.path, 'resources', resource_collection,
+                     methods=['GET', 'POST'], defaults=_defaults)
+    app.add_url_rule('%s/<ident>' % _resource.path, 'resource',
+                     resource_item, methods=['GET', 'PATCH', 'DELETE'],
+                     defaults=_defaults)
+    app.add_url_rule('%s/<ident>/<path:path>' % _resource.path,
+                     'resource_action', resource_action,
+                     methods=['GET', 'PUT', 'POST', 'DELETE'],
+                     defaults=_defaults)
+
+
 def init(argv):
+    start = time.time()
     conf.load_config(sys.argv[1:])
+    # Preparing the groups mostly waits for the network, do
+    # the CPU-bound work meanwhile.
+    warm_up = threading.Thread(target=groups.warm_up,
+                               name='ironic-proxy-warm-up')
+    warm_up.start()
     if conf.CONF.api.auth_strategy == 'keystone':
-        app.wsgi_app = auth_token.AuthProtocol(app.wsgi_app,
-                                               {'delay_auth_decision': True})
+        # Importing keystonemiddleware takes longer than
+        # the rest of the service, only do it when needed.
+        from keystonemiddleware import auth_token
+
+        options = {'delay_auth_decision': True}
+        store = conf.shared_store()
+        if store is not None:
+            options['cache'] = _AUTH_CACHE_KEY
+        app.wsgi_app = auth_token.AuthProtocol(app.wsgi_app, options)
+        if store is not None:
+            app.wsgi_app = _with_environ(app.wsgi_app, _AUTH_CACHE_KEY, store)
+
+    warm_up.join()
+    LOG.info('Initialized in %.3f seconds', time.time() - start)
+
+
+def _with_environ(wsgi_app, key, value):
+    def _wrapper(environ, start_response):
+        environ[key] = value
+        return wsgi_app(environ, start_response)
+    return _wrapper
 
 
 def main(argv):
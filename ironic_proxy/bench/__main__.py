@@ -0,0 +1,374 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Benchmark the proxy against a fleet of fake Bare Metal services.
+
+Every scenario issues requests to the API application in-process from
+several threads and reports throughput, latency percentiles, the number of
+requests made to the sources per API request and memory usage.
+"""
+
+import argparse
+import collections
+import json
+import logging
+import random
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from ironic_proxy.bench import fake
+
+
+SCENARIOS = collections.OrderedDict()
+
+
+def scenario(func):
+    """Register a scenario.
+
+    A scenario accepts the benchmark environment and the number of requests
+    and returns a list of (method, URL, body) tuples.
+    """
+    SCENARIOS[func.__name__.lstrip('_')] = func
+    return func
+
+
+@scenario
+def _list(env, count):
+    return [('GET', '/v1/nodes', None)] * count
+
+
+@scenario
+def _detail(env, count):
+    return [('GET', '/v1/nodes/detail', None)] * count
+
+
+@scenario
+def _page(env, count):
+    return [('GET', '/v1/nodes?limit=100', None)] * count
+
+
+@scenario
+def _get_cold(env, count):
+    env.reset_caches()
+    names = env.node_names()
+    env.random.shuffle(names)
+    # Every node is only requested once, so none of them is cached
+    return [('GET', '/v1/nodes/%s' % name, None) for name in names[:count]]
+
+
+@scenario
+def _get_warm(env, count):
+    env.warm_caches()
+    names = env.node_names()
+    return [('GET', '/v1/nodes/%s' % env.random.choice(names), None)
+            for _i in range(count)]
+
+
+@scenario
+def _patch(env, count):
+    env.warm_caches()
+    names = env.node_names()
+    return [('PATCH', '/v1/nodes/%s' % env.random.choice(names),
+             [{'op': 'add', 'path': '/extra/bench', 'value': index}])
+            for index in range(count)]
+
+
+@scenario
+def _batch(env, count):
+    env.warm_caches()
+    names = env.node_names()
+    body = {'operations': [{'node': env.random.choice(names),
+                            'method': 'PUT', 'path': 'states/provision',
+                            'body': {'target': 'manage'}}
+                           for _i in range(100)]}
+    return [('POST', '/proxy/v1/nodes/batch', body)] * count
+
+
+def _ports(env):
+    env.warm_caches()
+    # Ports are only indexed when seen in listings
+    env.api.app.test_client().get('/v1/ports').get_data()
+    return [port for backend in env.backends for port in backend.ports]
+
+
+@scenario
+def _get_port(env, count):
+    ports = _ports(env)
+    return [('GET', '/v1/ports/%s' % env.random.choice(ports)['uuid'], None)
+            for _i in range(count)]
+
+
+@scenario
+def _port_addr(env, count):
+    ports = _ports(env)
+    return [('GET', '/v1/ports?address=%s'
+             % env.random.choice(ports)['address'], None)
+            for _i in range(count)]
+
+
+class Environment(object):
+    """Fake sources and the proxy configured to use them."""
+
+    def __init__(self, backends, config_files=(), seed=0, verbose=False):
+        # Import late to measure the import time
+        start = time.time()
+        from ironic_proxy import api
+        from ironic_proxy import conf
+        from ironic_proxy import groups
+        self.import_time = time.time() - start
+        self.api = api
+        self.conf = conf
+        self.groups = groups
+
+        self.random = random.Random(seed)
+        self.backends = [backend.start() for backend in backends]
+        self._config = tempfile.NamedTemporaryFile(mode='w', suffix='.conf',
+                                                   prefix='ironic-proxy-')
+        self._config.write(self._config_text())
+        self._config.flush()
+        argv = ['--config-file', self._config.name]
+        for path in config_files:
+            argv.extend(['--config-file', path])
+        conf.load_config(argv)
+        if not verbose:
+            logging.getLogger('ironic_proxy').setLevel(logging.WARNING)
+
+    def _config_text(self):
+        lines = ['[DEFAULT]',
+                 'groups = %s' % ','.join(
+                     '%s:fake%d' % (backend.group or '_', index)
+                     for index, backend in enumerate(self.backends)),
+                 '[api]',
+                 'auth_strategy = none']
+        for index, backend in enumerate(self.backends):
+            lines.extend(['[group:fake%d]' % index,
+                          'auth_type = none',
+                          'endpoint_override = %s' % backend.url])
+        return '\n'.join(lines) + '\n'
+
+    def node_names(self):
+        return [node['name'] for backend in self.backends
+                for node in backend.nodes]
+
+    def reset_caches(self):
+        self.api._RESPONSES = None
+        self.groups._CACHE = None
+
+    def warm_caches(self):
+        self.reset_caches()
+        self.groups.sync_index(force=True)
+
+    def backend_requests(self):
+        return sum(backend.reset_counters() for backend in self.backends)
+
+    def close(self):
+        for backend in self.backends:
+            backend.stop()
+        self._config.close()
+
+
+def _percentile(samples, percent):
+    if not samples:
+        return 0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100.0))]
+
+
+def _max_rss():
+    if resource is None:
+        return 0
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_scenario(env, name, count, concurrency):
+    """Run a scenario, return a dictionary with the results."""
+    calls = SCENARIOS[name](env, count)
+    env.backend_requests()
+    latencies = []
+    errors = collections.Counter()
+    lock = threading.Lock()
+    pending = iter(calls)
+
+    def _worker():
+        client = env.api.app.test_client()
+        while True:
+            with lock:
+                try:
+                    method, url, body = next(pending)
+                except StopIteration:
+                    return
+            start = time.time()
+            resp = client.open(url, method=method, json=body)
+            # Streamed responses are only produced when consumed
+            resp.get_data()
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+                if resp.status_code >= 400:
+                    errors[resp.status_code] += 1
+
+    rss_before = _max_rss()
+    start = time.time()
+    threads = [threading.Thread(target=_worker) for _i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.time() - start
+
+    return {
+        'requests': len(calls),
+        'throughput': len(calls) / wall if wall else 0,
+        'p50': _percentile(latencies, 50),
+        'p99': _percentile(latencies, 99),
+        'backend_requests': (env.backend_requests() / float(len(calls))
+                             if calls else 0),
+        'errors': dict(errors),
+        'max_rss_growth': max(0, _max_rss() - rss_before),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Compare results with a baseline, return a list of regressions."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['p99'] > base['p99'] * (1 + tolerance):
+            regressions.append('%s: p99 %.1f ms, was %.1f ms'
+                               % (name, result['p99'] * 1000,
+                                  base['p99'] * 1000))
+        if result['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append('%s: throughput %.1f req/s, was %.1f req/s'
+                               % (name, result['throughput'],
+                                  base['throughput']))
+        # Requests to the sources are deterministic for a given setup, any
+        # increase means broken fan-out planning or caching.
+        if result['backend_requests'] > base['backend_requests'] + 0.01:
+            regressions.append('%s: %.2f requests to sources per request, '
+                               'was %.2f' % (name, result['backend_requests'],
+                                             base['backend_requests']))
+    return regressions
+
+
+def _parse_backend(spec, index, args):
+    options = {'nodes': args.nodes, 'latency': args.latency,
+               'distribution': args.distribution, 'failure_rate': 0.0,
+               'group': 'group%d' % index if index else ''}
+    for item in filter(None, spec.split(',')):
+        key, value = item.split('=', 1)
+        if key not in options:
+            raise ValueError('Unknown backend option %s' % key)
+        options[key] = type(options[key])(value) if key != 'group' else value
+    return fake.FakeIronic(
+        group=options['group'], nodes=options['nodes'],
+        latency=fake.Latency(options['latency'] / 1000.0,
+                             options['distribution'], seed=index),
+        failure_rate=options['failure_rate'], seed=index)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m ironic_proxy.bench', description=__doc__)
+    parser.add_argument('--backends', type=int, default=3,
+                        help='number of fake sources (default: 3)')
+    parser.add_argument('--nodes', type=int, default=1000,
+                        help='number of nodes per source (default: 1000)')
+    parser.add_argument('--latency', type=float, default=10,
+                        help='median latency of sources in milliseconds '
+                             '(default: 10)')
+    parser.add_argument('--distribution', default='lognormal',
+                        choices=fake.Latency.DISTRIBUTIONS,
+                        help='latency distribution (default: lognormal)')
+    parser.add_argument('--backend', action='append', default=[],
+                        metavar='KEY=VALUE[,...]',
+                        help='options of one source overriding the defaults '
+                             '(nodes, latency, distribution, failure_rate, '
+                             'group), can be repeated')
+    parser.add_argument('--scenario', action='append',
+                        choices=list(SCENARIOS),
+                        help='scenario to run, can be repeated (default: '
+                             'all)')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='number of requests per scenario (default: 200)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='number of concurrent clients (default: 8)')
+    parser.add_argument('--config-file', action='append', default=[],
+                        help='additional configuration file for the proxy')
+    parser.add_argument('--verbose', action='store_true',
+                        help='log informational messages of the proxy')
+    parser.add_argument('--output', help='file to write results to as JSON')
+    parser.add_argument('--baseline',
+                        help='JSON file with previous results, exit with an '
+                             'error if the new results are worse')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative degradation of latency and '
+                             'throughput compared to the baseline '
+                             '(default: 0.2)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    count = max(args.backends, len(args.backend))
+    specs = args.backend + [''] * (count - len(args.backend))
+    backends = [_parse_backend(spec, index, args)
+                for index, spec in enumerate(specs)]
+
+    env = Environment(backends, args.config_file, verbose=args.verbose)
+    try:
+        print('Import time: %.0f ms' % (env.import_time * 1000))
+        # Warm up: connections, authentication and version discovery
+        start = time.time()
+        env.api.app.test_client().get('/v1')
+        print('First request: %.0f ms' % ((time.time() - start) * 1000))
+
+        results = collections.OrderedDict()
+        print('%-10s %8s %10s %9s %9s %9s %7s %9s'
+              % ('scenario', 'requests', 'req/s', 'p50 ms', 'p99 ms',
+                 'src/req', 'errors', 'rss MiB'))
+        for name in args.scenario or SCENARIOS:
+            result = run_scenario(env, name, args.requests, args.concurrency)
+            results[name] = result
+            print('%-10s %8d %10.1f %9.1f %9.1f %9.2f %7d %9.1f'
+                  % (name, result['requests'], result['throughput'],
+                     result['p50'] * 1000, result['p99'] * 1000,
+                     result['backend_requests'],
+                     sum(result['errors'].values()),
+                     result['max_rss_growth'] / 1048576.0))
+    finally:
+        env.close()
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            regressions = compare(results, json.load(fp), args.tolerance)
+        for item in regressions:
+            print('REGRESSION: %s' % item)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
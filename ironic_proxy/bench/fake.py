@@ -0,0 +1,359 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A fake Bare Metal API service with configurable latency and failures."""
+
+import datetime
+import logging
+import random
+import threading
+import time
+import uuid
+
+import flask
+from werkzeug import serving
+
+
+# Fields returned by ironic in listings without detail
+_LIST_FIELDS = ('uuid', 'name', 'instance_uuid', 'power_state',
+                'provision_state', 'maintenance', 'links')
+_PORT_LIST_FIELDS = ('uuid', 'address', 'links')
+MIN_VERSION = '1.1'
+MAX_VERSION = '1.58'
+
+
+def _now():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S+00:00')
+
+
+def _make_node(group, index, rnd):
+    node_uuid = str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+    return {
+        'uuid': node_uuid,
+        'name': '%s-node-%d' % (group or 'default', index),
+        'conductor_group': group,
+        'instance_uuid': (str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+                          if index % 2 else None),
+        'driver': 'ipmi',
+        'driver_info': {'ipmi_address': '10.0.%d.%d' % (index // 250,
+                                                        index % 250),
+                        'ipmi_username': 'admin',
+                        'ipmi_password': '******',
+                        'deploy_kernel': 'http://images/deploy.kernel',
+                        'deploy_ramdisk': 'http://images/deploy.ramdisk'},
+        'properties': {'cpus': 64, 'memory_mb': 262144, 'local_gb': 1024,
+                       'cpu_arch': 'x86_64',
+                       'capabilities': 'boot_mode:uefi'},
+        'extra': {},
+        'power_state': 'power off',
+        'provision_state': 'available',
+        'maintenance': False,
+        'created_at': _now(),
+        'updated_at': None,
+        'links': [{'href': 'http://fake/v1/nodes/%s' % node_uuid,
+                   'rel': 'self'}],
+    }
+
+
+def _make_port(node, index, rnd):
+    port_uuid = str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+    return {
+        'uuid': port_uuid,
+        'address': '52:54:00:%02x:%02x:%02x' % (
+            rnd.getrandbits(8), index // 256 % 256, index % 256),
+        'node_uuid': node['uuid'],
+        'pxe_enabled': True,
+        'extra': {},
+        'links': [{'href': 'http://fake/v1/ports/%s' % port_uuid,
+                   'rel': 'self'}],
+    }
+
+
+class Latency(object):
+    """A latency distribution.
+
+    :param median: median latency in seconds.
+    :param distribution: one of ``fixed``, ``uniform`` (between 0 and
+        2 * median) or ``lognormal`` (with a long tail).
+    """
+
+    DISTRIBUTIONS = ('fixed', 'uniform', 'lognormal')
+
+    def __init__(self, median=0.0, distribution='lognormal', seed=None):
+        if distribution not in self.DISTRIBUTIONS:
+            raise ValueError('Unknown latency distribution %s' % distribution)
+        self.median = median
+        self.distribution = distribution
+        self._random = random.Random(seed)
+
+    def sample(self):
+        if not self.median:
+            return 0
+        if self.distribution == 'fixed':
+            return self.median
+        elif self.distribution == 'uniform':
+            return self._random.uniform(0, 2 * self.median)
+        else:
+            return self.median * self._random.lognormvariate(0, 0.5)
+
+
+class FakeIronic(object):
+    """A fake Bare Metal API service running in a background thread.
+
+    Implements node and port listings (with fields, limit, marker, sorting
+    and basic filters), node and port retrieval, updates and actions. Every
+    node has one port. Node updates only support adding and replacing
+    top-level fields. Allocations can be created, deploy templates can be
+    created, listed, updated and deleted.
+    """
+
+    def __init__(self, group='', nodes=1000, latency=None, failure_rate=0,
+                 seed=0):
+        self.group = group
+        self.latency = latency or Latency()
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self.nodes = sorted((_make_node(group, index, self._random)
+                             for index in range(nodes)),
+                            key=lambda node: node['uuid'])
+        self._by_id = {}
+        for node in self.nodes:
+            self._by_id[node['uuid']] = node
+            self._by_id[node['name']] = node
+        self.ports = sorted((_make_port(node, index, self._random)
+                             for index, node in enumerate(self.nodes)),
+                            key=lambda port: port['uuid'])
+        self._ports_by_id = {port['uuid']: port for port in self.ports}
+        self.allocations = []
+        self.deploy_templates = []
+        self._server = None
+        self.app = self._make_app()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self._server.server_port
+
+    def start(self):
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        self._server = serving.make_server('127.0.0.1', 0, self.app,
+                                           threaded=True)
+        thread = threading.Thread(target=self._server.serve_forever,
+                                  name='fake-ironic-%s' % self.group)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+    def reset_counters(self):
+        with self._lock:
+            result, self.requests = self.requests, 0
+        return result
+
+    def _before_request(self):
+        with self._lock:
+            self.requests += 1
+            fail = False
+            if self.failure_rate:
+                fail = self._random.random() < self.failure_rate
+        time.sleep(self.latency.sample())
+        if fail:
+            return self._error('Service temporarily unavailable', 503)
+
+    @staticmethod
+    def _error(message, code):
+        resp = flask.jsonify(error_message={'faultstring': message,
+                                            'faultcode': 'Client',
+                                            'debuginfo': None})
+        resp.status_code = code
+        return resp
+
+    def _find(self, node_id):
+        try:
+            return self._by_id[node_id]
+        except KeyError:
+            flask.abort(self._error('Node %s could not be found' % node_id,
+                                    404))
+
+    def _update(self, node, patch):
+        with self._lock:
+            for op in patch or ():
+                field = op['path'].strip('/')
+                if op['op'] in ('add', 'replace') and '/' not in field:
+                    node[field] = op['value']
+            node['updated_at'] = _now()
+
+    def _find_template(self, ident):
+        for template in self.deploy_templates:
+            if ident in (template['uuid'], template['name']):
+                return template
+        flask.abort(self._error('Deploy template %s could not be found'
+                                % ident, 404))
+
+    def _create_allocation(self, body):
+        for node_id in body.get('candidate_nodes') or ():
+            if node_id not in self._by_id:
+                return self._error('Candidate node %s could not be found'
+                                   % node_id, 400)
+        allocation = dict(body, state='allocating', node_uuid=None)
+        allocation.setdefault('uuid', str(uuid.uuid4()))
+        with self._lock:
+            self.allocations.append(allocation)
+        resp = flask.jsonify(allocation)
+        resp.status_code = 201
+        return resp
+
+    def _create_template(self, body):
+        template = dict(body, created_at=_now())
+        template.setdefault('uuid', str(uuid.uuid4()))
+        with self._lock:
+            taken = {key for existing in self.deploy_templates
+                     for key in (existing['uuid'], existing['name'])}
+            if template['uuid'] in taken or template.get('name') in taken:
+                return self._error('Deploy template already exists', 409)
+            self.deploy_templates.append(template)
+        resp = flask.jsonify(template)
+        resp.status_code = 201
+        return resp
+
+    def _find_port(self, port_id):
+        try:
+            return self._ports_by_id[port_id]
+        except KeyError:
+            flask.abort(self._error('Port %s could not be found' % port_id,
+                                    404))
+
+    def _list(self, detail, collection='nodes'):
+        args = flask.request.args
+        fields = args.get('fields')
+        if fields and detail:
+            return self._error('Can not specify ?detail=True and fields in '
+                               'the same request.', 400)
+
+        if collection == 'nodes':
+            nodes = self.nodes
+            filters = ('conductor_group', 'instance_uuid', 'provision_state')
+            list_fields = _LIST_FIELDS
+        else:
+            nodes = self.ports
+            filters = ('address',)
+            list_fields = _PORT_LIST_FIELDS
+            if args.get('node'):
+                node_uuid = self._find(args['node'])['uuid']
+                nodes = [port for port in nodes
+                         if port['node_uuid'] == node_uuid]
+        for key in filters:
+            if args.get(key) is not None:
+                nodes = [node for node in nodes
+                         if (node[key] or '').lower() == args[key].lower()]
+
+        sort_key = args.get('sort_key') or 'uuid'
+        reverse = args.get('sort_dir') == 'desc'
+        if sort_key != 'uuid' or reverse:
+            nodes = sorted(nodes, key=lambda node: (node.get(sort_key) or '',
+                                                    node['uuid']),
+                           reverse=reverse)
+        if args.get('marker'):
+            uuids = [node['uuid'] for node in nodes]
+            try:
+                nodes = nodes[uuids.index(args['marker']) + 1:]
+            except ValueError:
+                return self._error('Marker %s not found' % args['marker'],
+                                   400)
+
+        limit = int(args.get('limit') or 1000) or 1000
+        page = nodes[:limit]
+        if fields:
+            fields = fields.split(',')
+        elif not detail:
+            fields = list_fields
+        if fields:
+            page = [{key: node.get(key) for key in fields} for node in page]
+
+        result = {collection: page}
+        if len(nodes) > limit:
+            result['next'] = '%s?marker=%s' % (flask.request.base_url,
+                                               page[-1]['uuid'])
+        return flask.jsonify(result)
+
+    def _make_app(self):
+        app = flask.Flask('fake-ironic')
+        app.before_request(self._before_request)
+
+        @app.route('/')
+        def root():
+            return flask.jsonify(default_version={
+                'id': 'v1', 'status': 'CURRENT',
+                'min_version': MIN_VERSION, 'version': MAX_VERSION})
+
+        @app.route('/v1/nodes', methods=['GET'])
+        def nodes():
+            return self._list(detail=False)
+
+        @app.route('/v1/nodes/detail', methods=['GET'])
+        def nodes_detail():
+            return self._list(detail=True)
+
+        @app.route('/v1/nodes/<node_id>', methods=['GET', 'PATCH'])
+        def node(node_id):
+            node = self._find(node_id)
+            if flask.request.method == 'PATCH':
+                self._update(node, flask.request.get_json(force=True))
+            return flask.jsonify(node)
+
+        @app.route('/v1/ports', methods=['GET'])
+        def ports():
+            return self._list(detail=False, collection='ports')
+
+        @app.route('/v1/ports/detail', methods=['GET'])
+        def ports_detail():
+            return self._list(detail=True, collection='ports')
+
+        @app.route('/v1/ports/<port_id>', methods=['GET', 'PATCH'])
+        def port(port_id):
+            return flask.jsonify(self._find_port(port_id))
+
+        @app.route('/v1/allocations', methods=['POST'])
+        def allocations():
+            return self._create_allocation(flask.request.get_json(force=True))
+
+        @app.route('/v1/deploy_templates', methods=['GET', 'POST'])
+        def deploy_templates():
+            if flask.request.method == 'POST':
+                return self._create_template(
+                    flask.request.get_json(force=True))
+            return flask.jsonify(deploy_templates=self.deploy_templates)
+
+        @app.route('/v1/deploy_templates/<ident>',
+                   methods=['GET', 'PATCH', 'DELETE'])
+        def deploy_template(ident):
+            template = self._find_template(ident)
+            if flask.request.method == 'DELETE':
+                with self._lock:
+                    self.deploy_templates.remove(template)
+                return '', 204
+            if flask.request.method == 'PATCH':
+                self._update(template, flask.request.get_json(force=True))
+            return flask.jsonify(template)
+
+        @app.route('/v1/nodes/<node_id>/<path:path>',
+                   methods=['GET', 'PUT', 'POST'])
+        def node_action(node_id, path):
+            self._find(node_id)
+            return '', 202
+
+        return app
@@ -0,0 +1,528 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Cache of node locations."""
+
+import collections
+import errno
+import hashlib
+import os
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+
+from oslo_log import log
+
+try:
+    import memcache
+except ImportError:
+    memcache = None
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+LOG = log.getLogger(__name__)
+# Memcached API uses "time" as an argument name
+_now = time.time
+INSTANCE_PREFIX = 'instance:'
+# Prefix for locations of resources other than nodes, these entries are not
+# affected by reconciliation with node listings
+RESOURCE_PREFIX = 'resource:'
+# Prefix for node locations in key-value stores
+_LOCATION_PREFIX = 'location:'
+
+
+def _keys(node):
+    for key in ('uuid', 'name'):
+        if node.get(key):
+            yield node[key]
+    if node.get('instance_uuid'):
+        yield INSTANCE_PREFIX + node['instance_uuid']
+
+
+class LocationCache(object):
+    """A bounded LRU cache mapping node identifiers to groups.
+
+    Nodes are stored by UUID, name and (prefixed with INSTANCE_PREFIX)
+    instance UUID. Other resources are stored by keys prefixed with
+    RESOURCE_PREFIX.
+    """
+
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _expiry(self):
+        return time.time() + self.ttl if self.ttl else None
+
+    def _set(self, key, group, expires):
+        self._data.pop(key, None)
+        self._data[key] = (group, expires)
+        while self.max_size and len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def get(self, key):
+        """Get the group of a node by its UUID or name.
+
+        :raises: KeyError if the node is not known.
+        """
+        with self._lock:
+            group, expires = self._data.pop(key)
+            if expires is not None and expires < time.time():
+                raise KeyError(key)
+            # Move to the end to mark as recently used
+            self._data[key] = (group, expires)
+            return group
+
+    def add(self, node, group):
+        """Remember the location of a node."""
+        self.add_keys(_keys(node), group)
+
+    def add_keys(self, keys, group):
+        """Remember the location of a resource by its keys."""
+        expires = self._expiry()
+        with self._lock:
+            for key in keys:
+                self._set(key, group, expires)
+
+    def reconcile(self, group, nodes):
+        """Replace all locations for the group with the provided nodes.
+
+        :returns: number of removed entries.
+        """
+        expires = self._expiry()
+        seen = set()
+        with self._lock:
+            for node in nodes:
+                for key in _keys(node):
+                    self._set(key, group, expires)
+                    seen.add(key)
+
+            # Resources are not affected by node listings
+            stale = [key for key, (grp, _exp) in self._data.items()
+                     if grp == group and key not in seen
+                     if not key.startswith(RESOURCE_PREFIX)]
+            for key in stale:
+                del self._data[key]
+        return len(stale)
+
+    def remove(self, key):
+        """Forget the location of a node."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def items(self):
+        """Get a snapshot of all non-expired items."""
+        now = time.time()
+        with self._lock:
+            return [(key, group, expires)
+                    for key, (group, expires) in self._data.items()
+                    if expires is None or expires >= now]
+
+    def save(self, path):
+        """Save the cache to an SQLite file.
+
+        The file is written next to the target and renamed into place, so
+        a process crashing while saving does not leave a broken snapshot.
+        """
+        items = self.items()
+        fd, tmp_path = tempfile.mkstemp(
+            prefix='.%s.' % os.path.basename(path),
+            dir=os.path.dirname(os.path.abspath(path)))
+        os.close(fd)
+        try:
+            conn = sqlite3.connect(tmp_path)
+            try:
+                with conn:
+                    conn.execute('CREATE TABLE locations (key TEXT PRIMARY '
+                                 'KEY, grp TEXT, expires REAL)')
+                    conn.executemany('INSERT INTO locations '
+                                     'VALUES (?, ?, ?)', items)
+            finally:
+                conn.close()
+            os.rename(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        LOG.debug('Saved %d node locations to %s', len(items), path)
+
+    def load(self, path):
+        """Load the cache from an SQLite file."""
+        conn = sqlite3.connect(path)
+        try:
+            rows = conn.execute('SELECT key, grp, expires FROM locations '
+                                'WHERE expires IS NULL OR expires >= ?',
+                                (time.time(),)).fetchall()
+        except sqlite3.OperationalError as exc:
+            LOG.warning('Cannot load node locations from %s: %s', path, exc)
+            return
+        finally:
+            conn.close()
+
+        with self._lock:
+            for key, group, expires in rows:
+                self._set(key, group, expires)
+        LOG.info('Loaded %d node locations from %s', len(rows), path)
+
+
+class SQLiteLocationCache(object):
+    """Node locations shared between processes via an SQLite file.
+
+    Has the same interface as LocationCache, but is not bounded in size:
+    stale entries are removed when they expire or on reconciliation. Put the
+    file on a memory file system (e.g. /dev/shm) to avoid disk I/O. The file
+    is shared with SQLiteStore, so it is only accessible by its owner.
+    """
+
+    def __init__(self, path, ttl=None, timeout=5):
+        self.path = path
+        self.ttl = ttl
+        self.timeout = timeout
+        _create_private(path)
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS locations '
+                         '(key TEXT PRIMARY KEY, grp TEXT, expires REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS locations_grp '
+                         'ON locations (grp)')
+
+    def _connect(self):
+        return _connect(self.path, self.timeout)
+
+    def _rows(self, keys, group):
+        expires = time.time() + self.ttl if self.ttl else None
+        for key in keys:
+            yield key, group, expires
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM locations WHERE '
+                                'expires IS NULL OR expires >= ?',
+                                (time.time(),)).fetchone()[0]
+
+    def get(self, key):
+        """Get the group of a node by its UUID or name.
+
+        :raises: KeyError if the node is not known.
+        """
+        with self._connect() as conn:
+            row = conn.execute('SELECT grp FROM locations WHERE key = ? AND '
+                               '(expires IS NULL OR expires >= ?)',
+                               (key, time.time())).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def add(self, node, group):
+        """Remember the location of a node."""
+        self.add_keys(_keys(node), group)
+
+    def add_keys(self, keys, group):
+        """Remember the location of a resource by its keys."""
+        with self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO locations '
+                             'VALUES (?, ?, ?)', self._rows(keys, group))
+
+    def reconcile(self, group, nodes):
+        """Replace all locations for the group with the provided nodes.
+
+        :returns: number of removed entries.
+        """
+        with self._connect() as conn:
+            conn.execute('CREATE TEMP TABLE seen (key TEXT PRIMARY KEY)')
+            keys = (key for node in nodes for key in _keys(node))
+            for row in self._rows(keys, group):
+                conn.execute('INSERT OR REPLACE INTO locations '
+                             'VALUES (?, ?, ?)', row)
+                conn.execute('INSERT OR IGNORE INTO seen VALUES (?)',
+                             (row[0],))
+            removed = conn.execute('DELETE FROM locations WHERE grp = ? AND '
+                                   'key NOT IN (SELECT key FROM seen) AND '
+                                   'key NOT LIKE ?',
+                                   (group, RESOURCE_PREFIX + '%')).rowcount
+            conn.execute('DROP TABLE seen')
+        return removed
+
+    def remove(self, key):
+        """Forget the location of a node."""
+        with self._connect() as conn:
+            conn.execute('DELETE FROM locations WHERE key = ?', (key,))
+
+    def purge(self):
+        """Delete all expired locations."""
+        with self._connect() as conn:
+            conn.execute('DELETE FROM locations WHERE expires < ?',
+                         (time.time(),))
+
+    def items(self):
+        """Get a snapshot of all non-expired items."""
+        with self._connect() as conn:
+            return conn.execute('SELECT key, grp, expires FROM locations '
+                                'WHERE expires IS NULL OR expires >= ?',
+                                (time.time(),)).fetchall()
+
+
+class StoreLocationCache(object):
+    """Node locations in a memcached-like key-value store.
+
+    Has the same interface as LocationCache, but stores cannot be iterated:
+    stale entries are only removed when they expire or when a request to
+    the group reports that the node is not there.
+    """
+
+    def __init__(self, store, ttl=None):
+        self.store = store
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(key):
+        # Memcached keys cannot contain spaces and are
+        # limited in length.
+        return _LOCATION_PREFIX + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def __len__(self):
+        return 0
+
+    def get(self, key):
+        """Get the group of a node by its UUID or name.
+
+        :raises: KeyError if the node is not known.
+        """
+        group = self.store.get(self._key(key))
+        if group is None:
+            raise KeyError(key)
+        if isinstance(group, bytes):
+            group = group.decode('utf-8')
+        return group
+
+    def add(self, node, group):
+        """Remember the location of a node."""
+        self.add_keys(_keys(node), group)
+
+    def add_keys(self, keys, group):
+        """Remember the location of a resource by its keys."""
+        for key in keys:
+            self.store.set(self._key(key), group, time=self.ttl or 0)
+
+    def reconcile(self, group, nodes):
+        """Refresh all locations for the group with the provided nodes.
+
+        :returns: number of removed entries (always zero).
+        """
+        for node in nodes:
+            self.add(node, group)
+        return 0
+
+    def remove(self, key):
+        """Forget the location of a node."""
+        self.store.delete(self._key(key))
+
+    def items(self):
+        """Stores cannot be iterated, always returns an empty list."""
+        return []
+
+
+class ResponseCache(object):
+    """A short-living LRU cache of serialized API responses.
+
+    Every entry has a set of tags that can be used to invalidate it.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get a cached response or None."""
+        with self._lock:
+            try:
+                value, tags, expires = self._data[key]
+            except KeyError:
+                return None
+
+            if expires < time.time():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, tags=()):
+        """Cache a response."""
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, frozenset(tags), expires)
+            while self.max_size and len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, tags):
+        """Remove all responses with any of the tags."""
+        tags = set(tags)
+        with self._lock:
+            stale = [key for key, (_value, entry_tags, _exp)
+                     in self._data.items() if tags & entry_tags]
+            for key in stale:
+                del self._data[key]
+
+
+class SQLiteStore(object):
+    """A key-value store shared between processes via an SQLite file.
+
+    Implements the subset of the memcached client interface used by
+    keystonemiddleware, so it can be used as its cache. The file contains
+    tokens, so it is only accessible by its owner.
+    """
+
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        _create_private(path)
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS store '
+                         '(key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+
+    def _connect(self):
+        return _connect(self.path, self.timeout)
+
+    def get(self, key):
+        """Get a value or None if it is missing or expired."""
+        with self._connect() as conn:
+            row = conn.execute('SELECT value FROM store WHERE key = ? AND '
+                               '(expires IS NULL OR expires >= ?)',
+                               (key, _now())).fetchone()
+        return row[0] if row is not None else None
+
+    def set(self, key, value, time=0, min_compress_len=0):
+        """Set a value, expiring in the given number of seconds."""
+        expires = _now() + time if time else None
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO store VALUES (?, ?, ?)',
+                         (key, value, expires))
+        return True
+
+    def add(self, key, value, time=0, min_compress_len=0):
+        """Set a value unless it is already set.
+
+        :returns: whether the value was set.
+        """
+        expires = _now() + time if time else None
+        with self._connect() as conn:
+            conn.execute('DELETE FROM store WHERE key = ? AND expires < ?',
+                         (key, _now()))
+            return conn.execute('INSERT OR IGNORE INTO store '
+                                'VALUES (?, ?, ?)',
+                                (key, value, expires)).rowcount == 1
+
+    def delete(self, key, time=0):
+        """Delete a value."""
+        with self._connect() as conn:
+            conn.execute('DELETE FROM store WHERE key = ?', (key,))
+        return True
+
+    def purge(self):
+        """Delete all expired values."""
+        with self._connect() as conn:
+            conn.execute('DELETE FROM store WHERE expires < ?', (_now(),))
+
+
+class RedisStore(object):
+    """A key-value store backed by redis.
+
+    Implements the same subset of the memcached client interface as
+    SQLiteStore.
+    """
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError('The redis library is required to use redis')
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        """Get a value or None if it is missing or expired."""
+        return self._client.get(key)
+
+    def set(self, key, value, time=0, min_compress_len=0):
+        """Set a value, expiring in the given number of seconds."""
+        return bool(self._client.set(key, value, ex=time or None))
+
+    def add(self, key, value, time=0, min_compress_len=0):
+        """Set a value unless it is already set."""
+        return bool(self._client.set(key, value, ex=time or None, nx=True))
+
+    def delete(self, key, time=0):
+        """Delete a value."""
+        self._client.delete(key)
+        return True
+
+
+def memcached_store(servers):
+    """Create a memcached client for the given list of host:port."""
+    if memcache is None:
+        raise RuntimeError('The python-memcached library is required to use '
+                           'memcached')
+    return memcache.Client(servers)
+
+
+def _create_private(path):
+    """Create a file only accessible by its owner unless it exists.
+
+    :raises: RuntimeError if an existing file is accessible by others.
+    """
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+    else:
+        os.close(fd)
+        return
+
+    mode = stat.S_IMODE(os.stat(path).st_mode)
+    if mode & (stat.S_IRWXG | stat.S_IRWXO):
+        raise RuntimeError('%s is accessible by other users (mode %o), '
+                           'it must only be accessible by its owner'
+                           % (path, mode))
+
+
+def _connect(path, timeout):
+    # A new connection every time, since connections
+    # cannot be shared between threads or survive fork.
+    conn = sqlite3.connect(path, timeout=timeout)
+    # Let readers in other processes proceed while one process writes
+    conn.execute('PRAGMA journal_mode=WAL')
+    return _closing(conn)
+
+
+class _closing(object):
+    """Commit (or roll back) and close an SQLite connection."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, *exc_info):
+        try:
+            return self._conn.__exit__(*exc_info)
+        finally:
+            self._conn.close()
@@ -0,0 +1,109 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compression of responses."""
+
+import zlib
+
+from urllib3.util import request as urllib3_request
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+# Amount of input after which a compressed stream is flushed, so that the
+# client can process the data received so far
+FLUSH_SIZE = 65536
+
+
+def available():
+    """Get the supported encodings, the preferred one first."""
+    result = []
+    if zstandard is not None:
+        result.append(ZSTD)
+    result.append(GZIP)
+    return result
+
+
+def decodable():
+    """Get the encodings that can be decoded in responses from sources."""
+    return urllib3_request.ACCEPT_ENCODING
+
+
+def negotiate(accept_encodings, allowed):
+    """Pick the encoding of a response or None to not compress it.
+
+    :param accept_encodings: werkzeug Accept object of the Accept-Encoding
+        header.
+    :param allowed: list of allowed encodings in the order of preference.
+    """
+    supported = [encoding for encoding in allowed
+                 if encoding in available()]
+    if not supported:
+        return None
+    return accept_encodings.best_match(supported)
+
+
+class Compressor(object):
+    """Incremental compression with the given encoding and level."""
+
+    def __init__(self, encoding, level):
+        self.encoding = encoding
+        if encoding == ZSTD:
+            self._obj = zstandard.ZstdCompressor(
+                level=max(1, min(level, 22))).compressobj()
+        else:
+            self._obj = zlib.compressobj(max(1, min(level, 9)), zlib.DEFLATED,
+                                         16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def flush(self):
+        """Get all the data compressed so far, keep the stream open."""
+        if self.encoding == ZSTD:
+            return self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._obj.flush()
+
+
+def compress(encoding, level, data):
+    """Compress a complete body."""
+    compressor = Compressor(encoding, level)
+    return compressor.compress(data) + compressor.finish()
+
+
+def compress_stream(encoding, level, chunks, flush_every_chunk=False):
+    """Compress a streamed body chunk by chunk.
+
+    The stream is flushed every FLUSH_SIZE bytes of input, or after every
+    chunk with flush_every_chunk (e.g. for events that must not be delayed).
+    """
+    compressor = Compressor(encoding, level)
+    pending = 0
+    for chunk in chunks:
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        pending += len(chunk)
+        if flush_every_chunk or pending >= FLUSH_SIZE:
+            data += compressor.flush()
+            pending = 0
+        if data:
+            yield data
+    yield compressor.finish()
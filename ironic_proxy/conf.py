@@ -10,21 +10,51 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import contextlib
+from multiprocessing import pool
+
 from keystoneauth1 import loading
+from keystoneauth1 import session
 from oslo_config import cfg
 from oslo_log import log
 
+from ironic_proxy import admission
+from ironic_proxy import cache
+from ironic_proxy import compression
 from ironic_proxy import ironic
+from ironic_proxy import resilience
 
 
 CONF = cfg.CONF
 LOG = log.getLogger(__name__)
 _GROUPS = None
+_STORE = None
 
 default_opts = [
     cfg.DictOpt('groups',
                 default={},
                 help='Mapping of conductor groups to source names'),
+    cfg.IntOpt('fan_out_workers',
+               default=16,
+               min=1,
+               help='Maximum number of requests to sources that can run '
+                    'concurrently when polling all groups. Not used by the '
+                    'eventlet server, which runs every request to a source '
+                    'in a new green thread.'),
+    cfg.FloatOpt('fan_out_timeout',
+                 default=30.0,
+                 min=0,
+                 help='Timeout (in seconds) for each group when polling all '
+                      'groups, both for listings and for looking up nodes. '
+                      'Groups that do not respond in time are skipped. '
+                      'Set to 0 to disable.'),
+    cfg.IntOpt('microversion_refresh_interval',
+               default=600,
+               min=0,
+               help='Interval (in seconds) between refreshing the range of '
+                    'supported microversions in the background, e.g. to '
+                    'pick up upgrades of the sources. The last known range '
+                    'is used while refreshing. Set to 0 to disable.'),
 ]
 
 api_opts = [
@@ -35,11 +65,348 @@ api_opts = [
                default='keystone',
                choices=['keystone', 'none'],
                help='Strategy to authenticate API requests'),
+    cfg.BoolOpt('enable_metrics',
+                default=True,
+                help='Expose metrics in the Prometheus format at /metrics. '
+                     'The endpoint does not require authentication. Metrics '
+                     'are collected separately by every process.'),
+    cfg.StrOpt('host_ip',
+               default='127.0.0.1',
+               help='Address to listen on when running the eventlet '
+                    'server (ironic_proxy.green).'),
+    cfg.PortOpt('port',
+                default=6385,
+                help='Port to listen on when running the eventlet server.'),
+    cfg.IntOpt('max_connections',
+               default=1000,
+               min=1,
+               help='Maximum number of concurrent requests handled by the '
+                    'eventlet server.'),
+    cfg.IntOpt('max_limit',
+               default=1000,
+               min=1,
+               help='Maximum number of nodes returned in one page. Must not '
+                    'exceed the max_limit of any of the sources.'),
+    cfg.BoolOpt('stream_listings',
+                default=True,
+                help='Stream node listings to clients as they are received '
+                     'from the sources instead of collecting them in memory. '
+                     'Streamed responses are not cached and have no ETag. '
+                     'Paginated listings are never streamed. Install ijson '
+                     'to also parse responses from the sources '
+                     'incrementally.'),
+    cfg.BoolOpt('raw_passthrough',
+                default=True,
+                help='Relay node actions and node updates between clients '
+                     'and sources without parsing the bodies. Status codes '
+                     'and headers of the sources are returned as they are.'),
+    cfg.IntOpt('max_batch_size',
+               default=1000,
+               min=1,
+               help='Maximum number of operations in one batch request.'),
+    cfg.IntOpt('batch_concurrency',
+               default=8,
+               min=1,
+               help='Maximum number of operations from one batch request '
+                    'that run concurrently in one group.'),
+    cfg.IntOpt('batch_workers',
+               default=16,
+               min=1,
+               help='Maximum number of operations from all batch requests '
+                    'that run concurrently in one process. Batches do not '
+                    'use the workers of [DEFAULT]fan_out_workers, so that '
+                    'they cannot delay listings. Not used by the eventlet '
+                    'server.'),
+    cfg.DictOpt('project_weights',
+                default={},
+                help='Mapping of project IDs to their weights when sharing '
+                     'overloaded sources, e.g. to prefer the project of the '
+                     'Compute service. The default weight is 1.'),
+    cfg.IntOpt('response_cache_ttl',
+               default=0,
+               min=0,
+               help='Time (in seconds) to cache responses to node GET '
+                    'requests. Responses are invalidated when a node is '
+                    'modified through this process, but changes made '
+                    'elsewhere may stay invisible for this long. Set to 0 '
+                    'to disable the cache.'),
+    cfg.IntOpt('response_cache_size',
+               default=1000,
+               min=1,
+               help='Maximum number of cached responses.'),
+]
+
+cache_opts = [
+    cfg.StrOpt('shared_backend',
+               default='memory',
+               choices=[('memory', 'node locations are kept in memory of '
+                         'every process'),
+                        ('sqlite', 'node locations are shared between '
+                         'processes on one host via the SQLite file set in '
+                         'shared_path'),
+                        ('memcached', 'node locations, authentication '
+                         'tokens and version discovery results are shared '
+                         'via memcached servers set in shared_backend_url'),
+                        ('redis', 'the same via a redis server set in '
+                         'shared_backend_url')],
+               help='Where to keep the node location cache and other state '
+                    'shared between processes.'),
+    cfg.StrOpt('shared_backend_url',
+               help='Comma-separated list of host:port of memcached servers '
+                    'or a redis URL (e.g. redis://127.0.0.1:6379/0).'),
+    cfg.IntOpt('max_size',
+               default=300000,
+               min=0,
+               help='Maximum number of entries in the node location cache '
+                    'when it is kept in memory. Every node takes up to three '
+                    'entries (UUID, name and instance UUID). Set to 0 to '
+                    'disable the limit.'),
+    cfg.IntOpt('ttl',
+               default=86400,
+               min=0,
+               help='Time (in seconds) to keep a node location in the cache. '
+                    'Set to 0 to keep locations forever.'),
+    cfg.StrOpt('snapshot_path',
+               help='Path to an SQLite file to save node locations to when '
+                    'they are kept in memory. The cache is loaded from it on '
+                    'start up.'),
+    cfg.IntOpt('snapshot_interval',
+               default=300,
+               min=0,
+               help='Interval (in seconds) between saving node locations '
+                    'in the background. They are always saved on exit. Set '
+                    'to 0 to only save them on exit.'),
+    cfg.StrOpt('shared_path',
+               help='Path to an SQLite file used to share authentication '
+                    'tokens, version discovery results and validated '
+                    'incoming tokens between processes and across restarts. '
+                    'All API processes must run as the owner of the file, '
+                    'it is created accessible only by its owner and is '
+                    'rejected if other users can access it.'),
+    cfg.IntOpt('discovery_ttl',
+               default=3600,
+               min=0,
+               help='Time (in seconds) to keep version discovery results in '
+                    'the shared cache.'),
+    cfg.IntOpt('purge_interval',
+               default=3600,
+               min=0,
+               help='Interval (in seconds) between removing expired entries '
+                    'from the file set in shared_path. Set to 0 to never '
+                    'remove them.'),
+    cfg.IntOpt('sync_interval',
+               default=600,
+               min=0,
+               help='Interval (in seconds) between background '
+                    'synchronizations of the node location cache with all '
+                    'groups. Set to 0 to disable the synchronization.'),
+]
+
+pool_opts = [
+    cfg.IntOpt('pool_connections',
+               default=10,
+               min=1,
+               help='Number of per-host connection pools to keep.'),
+    cfg.IntOpt('pool_maxsize',
+               default=32,
+               min=1,
+               help='Maximum number of connections to keep open to one host. '
+                    'Should not be lower than [DEFAULT]fan_out_workers.'),
+    cfg.BoolOpt('pool_block',
+                default=False,
+                help='Wait for a free connection when pool_maxsize is '
+                     'reached instead of opening a connection that will not '
+                     'be reused.'),
+    cfg.IntOpt('idle_timeout',
+               default=0,
+               min=0,
+               help='Close all pooled connections if no requests were made '
+                    'for this number of seconds, e.g. to avoid reusing '
+                    'connections dropped by a load balancer. Set to 0 to '
+                    'disable.'),
+]
+
+resilience_opts = [
+    cfg.IntOpt('retries',
+               default=2,
+               min=0,
+               help='Number of retries of GET requests on connection '
+                    'failures and HTTP 502, 503 and 504.'),
+    cfg.FloatOpt('retry_delay',
+                 default=0.5,
+                 min=0,
+                 help='Base delay (in seconds) between retries. Doubles with '
+                      'every attempt, a random jitter is applied.'),
+    cfg.FloatOpt('min_timeout',
+                 default=10,
+                 min=0,
+                 help='Lower bound for timeouts based on observed latency.'),
+    cfg.FloatOpt('max_timeout',
+                 default=60,
+                 min=0,
+                 help='Timeout (in seconds) for requests before enough '
+                      'latency is observed, and the upper bound afterwards. '
+                      'Set to 0 for no limit (not recommended).'),
+    cfg.FloatOpt('timeout_percentile',
+                 default=99,
+                 min=1,
+                 max=100,
+                 help='Percentile of the observed latency to base the '
+                      'timeouts on.'),
+    cfg.FloatOpt('timeout_multiplier',
+                 default=3,
+                 min=1,
+                 help='Timeouts are the latency percentile multiplied by '
+                      'this value.'),
+    cfg.StrOpt('hedge_endpoint',
+               help='Alternative endpoint of the same Bare Metal service. '
+                    'If set, GET requests taking longer than '
+                    'hedge_percentile of the observed latency are repeated '
+                    'against it and the first response wins.'),
+    cfg.FloatOpt('hedge_percentile',
+                 default=95,
+                 min=1,
+                 max=100,
+                 help='Latency percentile after which to send a hedged '
+                      'request.'),
+    cfg.IntOpt('failure_threshold',
+               default=5,
+               min=0,
+               help='Number of failures in a row after which the source is '
+                    'considered down and skipped. Set to 0 to disable.'),
+    cfg.IntOpt('reset_timeout',
+               default=30,
+               min=1,
+               help='Time (in seconds) after which a source that is down '
+                    'is tried again.'),
+]
+
+admission_opts = [
+    cfg.IntOpt('max_concurrency',
+               default=32,
+               min=0,
+               help='Maximum number of concurrent requests to the source, '
+                    'further requests wait in a queue. Writes are admitted '
+                    'first, then reads, then listings; within each class '
+                    'projects are served according to '
+                    '[api]project_weights. Set to 0 to disable admission '
+                    'control.'),
+    cfg.IntOpt('max_queued',
+               default=256,
+               min=0,
+               help='Maximum number of requests waiting for the source, '
+                    'further requests are rejected with HTTP 503. Set to 0 '
+                    'for no limit.'),
+    cfg.IntOpt('max_queued_per_project',
+               default=64,
+               min=0,
+               help='Maximum number of requests of one project waiting for '
+                    'the source, further requests are rejected with '
+                    'HTTP 429. Set to 0 for no limit.'),
+    cfg.FloatOpt('queue_timeout',
+                 default=10,
+                 min=0,
+                 help='Maximum time (in seconds) a request waits for the '
+                      'source, after that it is rejected with HTTP 503. '
+                      'Set to 0 for no limit.'),
+]
+
+feed_opts = [
+    cfg.IntOpt('interval',
+               default=5,
+               min=1,
+               help='Interval (in seconds) between fetching recently '
+                    'changed nodes from all groups. The feed is only '
+                    'updated after it is requested for the first time.'),
+    cfg.IntOpt('full_sync_interval',
+               default=300,
+               min=0,
+               help='Interval (in seconds) between complete listings of '
+                    'all groups, which are required to notice deleted '
+                    'nodes. Set to 0 to always list all nodes.'),
+    cfg.ListOpt('fields',
+                default=['uuid', 'name', 'instance_uuid', 'power_state',
+                         'target_power_state', 'provision_state',
+                         'target_provision_state', 'maintenance',
+                         'last_error', 'created_at', 'updated_at'],
+                help='Node fields to report in the feed, changes of other '
+                     'fields are not reported.'),
+    cfg.IntOpt('max_events',
+               default=10000,
+               min=1,
+               help='Number of most recent changes to keep. Clients with '
+                    'older cursors have to list all nodes again.'),
+    cfg.IntOpt('max_wait',
+               default=60,
+               min=0,
+               help='Maximum time (in seconds) to wait for changes in a '
+                    'long-poll request. The request occupies a server '
+                    'worker while waiting.'),
+    cfg.IntOpt('heartbeat_interval',
+               default=15,
+               min=1,
+               help='Interval (in seconds) between keep-alive comments in '
+                    'event streams.'),
+]
+
+compression_opts = [
+    cfg.ListOpt('encodings',
+                default=['zstd', 'gzip'],
+                help='Encodings to compress responses with, in the order of '
+                     'preference. The encoding is negotiated using the '
+                     'Accept-Encoding header. zstd requires the zstandard '
+                     'library. Set to an empty list to disable '
+                     'compression.'),
+    cfg.IntOpt('min_size',
+               default=1024,
+               min=0,
+               help='Responses smaller than this number of bytes are not '
+                    'compressed. Streamed responses are always '
+                    'compressed.'),
+    cfg.IntOpt('level',
+               default=6,
+               min=0,
+               max=22,
+               help='Compression level, 1 (fastest) to 9 for gzip or 22 '
+                    'for zstd. Set to 0 to disable compression.'),
+    cfg.DictOpt('route_levels',
+                default={},
+                help='Compression levels for specific endpoints, e.g. '
+                     'nodes:1,node:6 to favor speed for listings. Level 0 '
+                     'disables compression for the endpoint.'),
+    cfg.BoolOpt('request_compressed',
+                default=True,
+                help='Request compressed responses from the sources.'),
+]
+
+tracing_opts = [
+    cfg.BoolOpt('enabled',
+                default=False,
+                help='Record a trace of every API request, report the time '
+                     'spent in its parts in the Server-Timing header and '
+                     'propagate the trace context to the sources using the '
+                     'W3C traceparent header.'),
+    cfg.StrOpt('export_path',
+               help='Path to a file to append finished spans to, one '
+                    'OpenTelemetry (OTLP JSON) span per line.'),
+    cfg.StrOpt('collector_url',
+               help='URL of an OpenTelemetry collector accepting OTLP over '
+                    'HTTP with JSON encoding, e.g. '
+                    'http://127.0.0.1:4318/v1/traces. Spans are sent in the '
+                    'background.'),
 ]
 
 
 opt_group = cfg.OptGroup(name='api',
                          title='Options for the ironic-proxy API service')
+cache_group = cfg.OptGroup(name='cache',
+                           title='Options for the node location cache')
+compression_group = cfg.OptGroup(name='compression',
+                                 title='Options for response compression')
+feed_group = cfg.OptGroup(name='feed',
+                          title='Options for the feed of node changes')
+tracing_group = cfg.OptGroup(name='tracing',
+                             title='Options for request tracing')
 
 
 def register_opts():
@@ -47,6 +414,14 @@ def register_opts():
     CONF.register_opts(default_opts)
     CONF.register_group(opt_group)
     CONF.register_opts(api_opts, group=opt_group)
+    CONF.register_group(cache_group)
+    CONF.register_opts(cache_opts, group=cache_group)
+    CONF.register_group(compression_group)
+    CONF.register_opts(compression_opts, group=compression_group)
+    CONF.register_group(feed_group)
+    CONF.register_opts(feed_opts, group=feed_group)
+    CONF.register_group(tracing_group)
+    CONF.register_opts(tracing_opts, group=tracing_group)
 
 
 def load_config(argv):
@@ -59,21 +434,90 @@ def load_config(argv):
         loading.register_auth_conf_options(CONF, conf_group)
         loading.register_session_conf_options(CONF, conf_group)
         loading.register_adapter_conf_options(CONF, conf_group)
+        CONF.register_opts(pool_opts, group=conf_group)
+        CONF.register_opts(resilience_opts, group=conf_group)
+        CONF.register_opts(admission_opts, group=conf_group)
 
 
 def _load_adapter(source):
     conf_group = 'group:%s' % source
     auth = loading.load_auth_from_conf_options(CONF, conf_group)
     sess = loading.load_session_from_conf_options(CONF, conf_group)
+
+    http = session.TCPKeepAliveAdapter(
+        pool_connections=CONF[conf_group].pool_connections,
+        pool_maxsize=CONF[conf_group].pool_maxsize,
+        pool_block=CONF[conf_group].pool_block)
+    for scheme in list(sess.session.adapters):
+        sess.session.mount(scheme, http)
+
     return loading.load_adapter_from_conf_options(CONF, conf_group,
                                                   session=sess, auth=auth)
 
 
+def shared_store():
+    """Get the store shared between processes or None if not configured."""
+    global _STORE
+    if _STORE is None:
+        url = CONF.cache.shared_backend_url or ''
+        if CONF.cache.shared_backend == 'memcached':
+            _STORE = cache.memcached_store(
+                [server.strip() for server in url.split(',')
+                 if server.strip()])
+        elif CONF.cache.shared_backend == 'redis':
+            _STORE = cache.RedisStore(url)
+        elif CONF.cache.shared_path:
+            _STORE = cache.SQLiteStore(CONF.cache.shared_path)
+    return _STORE
+
+
+def location_cache():
+    """Create the node location cache for the configured backend."""
+    backend = CONF.cache.shared_backend
+    if backend == 'memory':
+        return cache.LocationCache(max_size=CONF.cache.max_size,
+                                   ttl=CONF.cache.ttl)
+    elif backend == 'sqlite':
+        if not CONF.cache.shared_path:
+            raise RuntimeError('[cache]shared_path is required for the '
+                               'sqlite backend')
+        return cache.SQLiteLocationCache(CONF.cache.shared_path,
+                                         ttl=CONF.cache.ttl)
+    else:
+        return cache.StoreLocationCache(shared_store(), ttl=CONF.cache.ttl)
+
+
 def groups():
     global _GROUPS
     if _GROUPS is None:
+        # Groups with the same source share the connection
+        # pool.
+        sources = sorted(set(CONF.groups.values()))
+        if len(sources) > 1:
+            # Loading plugins and certificates takes time,
+            # do it for all sources in parallel.
+            with contextlib.closing(pool.ThreadPool(len(sources))) as workers:
+                adapters = dict(zip(sources,
+                                    workers.map(_load_adapter, sources)))
+        else:
+            adapters = {source: _load_adapter(source) for source in sources}
+        policies = {source: resilience.Policy.from_options(
+                    CONF['group:%s' % source]) for source in sources}
+        weights = {project: float(weight) for project, weight
+                   in CONF.api.project_weights.items()}
+        accept_encoding = (compression.decodable()
+                           if CONF.compression.request_compressed
+                           else 'identity')
+        schedulers = {source: admission.Scheduler.from_options(
+                      source, CONF['group:%s' % source], weights)
+                      for source in sources}
         _GROUPS = {'' if group == '_' else group:
-                   ironic.Ironic(_load_adapter(source))
+                   ironic.Ironic(adapters[source],
+                                 CONF['group:%s' % source].idle_timeout,
+                                 name=source, store=shared_store(),
+                                 policy=policies[source],
+                                 scheduler=schedulers[source],
+                                 accept_encoding=accept_encoding)
                    for group, source in CONF.groups.items()}
         LOG.info('Loaded groups: %s', ', '.join(_GROUPS))
     return _GROUPS
@@ -0,0 +1,399 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Feed of node changes computed from periodic listings of all groups.
+
+Every event has a cursor. Clients pass the cursor of the last event they
+have seen to receive the following events, so that many clients can follow
+the changes at the cost of one listing loop.
+
+With a shared store (see the [cache] options), the events are kept in it and
+one process (the leader) updates the feed for all of them.
+"""
+
+import collections
+import json
+import threading
+import time
+import uuid
+
+from oslo_log import log
+
+from ironic_proxy import common
+from ironic_proxy import conf
+from ironic_proxy import groups
+from ironic_proxy import metrics
+
+
+LOG = log.getLogger(__name__)
+_FEED = None
+_FEED_LOCK = threading.Lock()
+# Fields that are required to compute changes
+_REQUIRED_FIELDS = ('uuid', 'created_at', 'updated_at')
+# Shared store keys: the process updating the feed, the cursor of the most
+# recent event and the events themselves
+_LEADER_KEY = 'feed:leader'
+_HEAD_KEY = 'feed:head'
+_EVENT_KEY = 'feed:event:%s'
+# Events in the shared store expire after a day even if there are no newer
+_EVENT_TTL = 86400
+# Interval (in seconds) between checks for new events in the shared store
+_POLL_INTERVAL = 0.5
+# Minimum time (in seconds) a leader is trusted without renewing its lease
+_MIN_LEASE = 30
+
+EVENTS = metrics.Counter(
+    'ironic_proxy_feed_events_total',
+    'Node changes published in the feed', labels=('event',))
+
+
+def _newest(nodes, key):
+    values = [node[key] for node in nodes if node.get(key)]
+    return max(values) if values else None
+
+
+def _new_epoch():
+    return uuid.uuid4().hex[:8]
+
+
+def _split(cursor):
+    epoch, seq = cursor.rsplit('-', 1)
+    return epoch, int(seq)
+
+
+class _LocalLog(object):
+    """Events kept in memory of the process."""
+
+    def __init__(self, max_events):
+        # Cursors of a previous process cannot be trusted
+        self.epoch = _new_epoch()
+        self._events = collections.deque(maxlen=max_events)
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """The process always updates its own feed."""
+        return True
+
+    def restart(self):
+        pass
+
+    def head(self):
+        """Get the epoch, the most recent and the oldest sequence numbers."""
+        with self._cond:
+            oldest = self._events[0][0] if self._events else self._seq + 1
+            return self.epoch, self._seq, oldest
+
+    def append(self, events):
+        with self._cond:
+            for event in events:
+                self._seq += 1
+                event['cursor'] = '%s-%d' % (self.epoch, self._seq)
+                self._events.append((self._seq, event))
+            self._cond.notify_all()
+
+    def wait(self, epoch, seq, timeout):
+        """Wait up to timeout seconds for events after seq."""
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._seq <= seq:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                self._cond.wait(remaining)
+
+    def events(self, seq, limit=None):
+        """Get events after seq."""
+        with self._cond:
+            events = [event for event_seq, event in self._events
+                      if event_seq > seq]
+        return events[:limit] if limit else events
+
+
+class _SharedLog(object):
+    """Events kept in a store shared between processes.
+
+    Only the process holding the lease appends events, the others read
+    them. Waiting for events polls the store.
+    """
+
+    def __init__(self, store, max_events, lease):
+        self.store = store
+        self.max_events = max_events
+        self.lease = lease
+        self._token = uuid.uuid4().hex
+        self._epoch = None
+        self._seq = 0
+
+    def _get(self, key):
+        value = self.store.get(key)
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        return value
+
+    def acquire(self):
+        """Try to become (or stay) the process updating the feed."""
+        leader = self._get(_LEADER_KEY)
+        if leader == self._token:
+            self.store.set(_LEADER_KEY, self._token, time=self.lease)
+            return True
+        if leader is None:
+            return bool(self.store.add(_LEADER_KEY, self._token,
+                                       time=self.lease))
+        return False
+
+    def restart(self):
+        """Start a new epoch, invalidating all cursors."""
+        self._epoch = _new_epoch()
+        self._seq = 0
+        self.store.set(_HEAD_KEY, '%s-0' % self._epoch)
+        LOG.info('This process now updates the feed, new epoch %s',
+                 self._epoch)
+
+    def head(self):
+        """Get the epoch, the most recent and the oldest sequence numbers."""
+        value = self._get(_HEAD_KEY)
+        if value is None:
+            self.store.add(_HEAD_KEY, '%s-0' % _new_epoch())
+            value = self._get(_HEAD_KEY)
+        epoch, seq = _split(value)
+        return epoch, seq, max(1, seq - self.max_events + 1)
+
+    def append(self, events):
+        # A slow leader may have lost its lease to another
+        # process, which has started a new epoch.
+        if self._get(_LEADER_KEY) != self._token:
+            LOG.warning('This process no longer updates the feed, dropping '
+                        '%d events', len(events))
+            return
+
+        for event in events:
+            self._seq += 1
+            event['cursor'] = '%s-%d' % (self._epoch, self._seq)
+            self.store.set(_EVENT_KEY % event['cursor'], json.dumps(event),
+                           time=_EVENT_TTL)
+            evicted = self._seq - self.max_events
+            if evicted > 0:
+                self.store.delete(_EVENT_KEY
+                                  % ('%s-%d' % (self._epoch, evicted)))
+        self.store.set(_HEAD_KEY, '%s-%d' % (self._epoch, self._seq))
+
+    def wait(self, epoch, seq, timeout):
+        """Wait up to timeout seconds for events after seq."""
+        deadline = time.time() + timeout
+        while True:
+            head_epoch, head_seq, _oldest = self.head()
+            remaining = deadline - time.time()
+            if head_epoch != epoch or head_seq > seq or remaining <= 0:
+                return
+            time.sleep(min(_POLL_INTERVAL, remaining))
+
+    def events(self, seq, limit=None):
+        """Get events after seq, stops at the first missing one."""
+        epoch, head_seq, _oldest = self.head()
+        if limit:
+            head_seq = min(head_seq, seq + limit)
+        events = []
+        for event_seq in range(seq + 1, head_seq + 1):
+            value = self._get(_EVENT_KEY % ('%s-%d' % (epoch, event_seq)))
+            if value is None:
+                break
+            events.append(json.loads(value))
+        return events
+
+
+class Feed(object):
+    """Known state of all nodes and a bounded log of their changes.
+
+    :param fields: node fields to track.
+    :param max_events: number of events to keep.
+    :param full_sync_interval: interval between complete listings.
+    :param store: store to share the events between processes, by default
+        they are only kept in this process.
+    :param lease: time (in seconds) the process updating the feed is
+        trusted without renewing it, only used with a store.
+    """
+
+    def __init__(self, fields, max_events, full_sync_interval=0, store=None,
+                 lease=_MIN_LEASE):
+        self.fields = list(fields) + [field for field in _REQUIRED_FIELDS
+                                      if field not in fields]
+        self.full_sync_interval = full_sync_interval
+        if store is None:
+            self._log = _LocalLog(max_events)
+        else:
+            self._log = _SharedLog(store, max_events, lease)
+        self._leading = False
+        self._reset()
+
+    def _reset(self):
+        self._nodes = {}
+        self._marks = {}
+        self._last_full = {}
+
+    @staticmethod
+    def _expired(cursor):
+        return common.Error('Cursor {cursor} has expired, list the nodes '
+                            'again and use the new cursor',
+                            cursor=cursor, code=410)
+
+    def _parse(self, cursor):
+        try:
+            epoch, seq = _split(cursor)
+        except (AttributeError, ValueError):
+            raise common.Error('Invalid cursor {cursor}', cursor=cursor)
+
+        head_epoch, head_seq, oldest = self._log.head()
+        if epoch != head_epoch or seq < oldest - 1:
+            raise self._expired(cursor)
+        if seq > head_seq:
+            raise common.Error('Invalid cursor {cursor}', cursor=cursor)
+        return seq
+
+    def cursor(self):
+        """Get the cursor of the most recent event."""
+        epoch, seq, _oldest = self._log.head()
+        return '%s-%d' % (epoch, seq)
+
+    def apply(self, group, nodes, complete=False):
+        """Compare a listing of the group with the known state.
+
+        The first complete listing of a group is the baseline and does not
+        produce events.
+
+        :param complete: whether the listing contains all nodes of the
+            group, otherwise deletions cannot be detected.
+        :returns: number of published events.
+        """
+        known = self._nodes.get(group)
+        if known is None:
+            if complete:
+                self._nodes[group] = {node['uuid']: node for node in nodes}
+            return 0
+
+        events = []
+        seen = set()
+        for node in nodes:
+            seen.add(node['uuid'])
+            old = known.get(node['uuid'])
+            known[node['uuid']] = node
+            if old is None:
+                events.append({'event': 'created', 'node': node})
+                continue
+
+            changed = [field for field in self.fields
+                       if old.get(field) != node.get(field)]
+            if 'updated_at' in changed:
+                changed.remove('updated_at')
+            if changed:
+                events.append({'event': 'updated', 'node': node,
+                               'changed': changed})
+
+        if complete:
+            for node_uuid in set(known) - seen:
+                events.append({'event': 'deleted',
+                               'node': known.pop(node_uuid)})
+
+        self._publish(group, events)
+        return len(events)
+
+    def _publish(self, group, events):
+        if not events:
+            return
+
+        for event in events:
+            event['group'] = group
+            EVENTS.inc(event=event['event'])
+        self._log.append(events)
+
+    def sync(self):
+        """Fetch recently changed nodes from all groups and publish events.
+
+        With a shared store, only the process holding the lease does it.
+        """
+        if not self._log.acquire():
+            if self._leading:
+                LOG.info('Another process now updates the feed')
+                self._leading = False
+            return
+
+        if not self._leading:
+            # Changes made while another process updated
+            # the feed are not known, start from a new baseline.
+            self._reset()
+            self._log.restart()
+            self._leading = True
+
+        now = time.time()
+        since = {group: marks for group, marks in self._marks.items()
+                 if now - self._last_full[group] < self.full_sync_interval}
+        microversion = '%d.%d' % groups.microversions()[1]
+
+        for group, complete, nodes in groups.list_changed_nodes(
+                self.fields, since, microversion=microversion):
+            count = self.apply(group, nodes, complete)
+            if complete:
+                self._last_full[group] = now
+            known = self._nodes.get(group)
+            if known is not None:
+                self._marks[group] = {
+                    key: _newest(known.values(), key)
+                    for key in ('created_at', 'updated_at')}
+            LOG.debug('Received %d nodes from group %s (complete: %s), '
+                      '%d changes', len(nodes), group or '<default>',
+                      complete, count)
+
+    def changes(self, cursor=None, timeout=0, limit=None):
+        """Get the events following the cursor.
+
+        Waits up to timeout seconds if there are no such events yet.
+
+        :param cursor: cursor of the last seen event, None to only get
+            the current cursor.
+        :returns: tuple (events, cursor) where cursor is the cursor of the
+            last returned event (or the passed one if there are none).
+        """
+        if cursor is None:
+            return [], self.cursor()
+
+        seq = self._parse(cursor)
+        self._log.wait(_split(cursor)[0], seq, timeout)
+        # Events may have been evicted while waiting
+        seq = self._parse(cursor)
+        events = self._log.events(seq, limit)
+        if events and _split(events[0]['cursor'])[1] != seq + 1:
+            raise self._expired(cursor)
+        if not events:
+            if self._log.head()[1] > seq:
+                raise self._expired(cursor)
+            return [], cursor
+        return events, events[-1]['cursor']
+
+
+def sync_feed():
+    _FEED.sync()
+
+
+def get_feed():
+    """Get the feed, start updating it if needed."""
+    global _FEED
+    if _FEED is None:
+        with _FEED_LOCK:
+            if _FEED is None:
+                _FEED = Feed(conf.CONF.feed.fields,
+                             conf.CONF.feed.max_events,
+                             conf.CONF.feed.full_sync_interval,
+                             store=conf.shared_store(),
+                             lease=max(_MIN_LEASE,
+                                       3 * conf.CONF.feed.interval))
+    groups.start_periodic(sync_feed, conf.CONF.feed.interval)
+    return _FEED
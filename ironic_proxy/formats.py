@@ -0,0 +1,93 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compact encodings of node listings.
+
+Compact listings are columnar: field names are sent once, followed by one
+row of values per node::
+
+    {"columns": ["uuid", "name"], "rows": [["<uuid>", "node-1"], ...]}
+"""
+
+import itertools
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON = 'application/json'
+COLUMNAR_JSON = 'application/vnd.ironic-proxy.columnar+json'
+MSGPACK = 'application/x-msgpack'
+
+
+def available():
+    """Get the supported media types, the default one first."""
+    result = [JSON, COLUMNAR_JSON]
+    if msgpack is not None:
+        result.append(MSGPACK)
+    return result
+
+
+def negotiate(accept):
+    """Pick the media type for a listing.
+
+    :param accept: werkzeug MIMEAccept object.
+    """
+    return accept.best_match(available()) or JSON
+
+
+def columns(fields, nodes):
+    """Determine the columns of a listing.
+
+    Uses the requested fields or the keys of the first node.
+
+    :param fields: value of the fields parameter or None.
+    :param nodes: iterable of nodes.
+    :returns: tuple (columns, nodes) where nodes is an equivalent iterable.
+    """
+    if fields:
+        return [f.strip() for f in fields.split(',') if f.strip()], nodes
+
+    nodes = iter(nodes)
+    try:
+        first = next(nodes)
+    except StopIteration:
+        return [], []
+    return sorted(first), itertools.chain([first], nodes)
+
+
+def _rows(nodes, cols):
+    for node in nodes:
+        yield [node.get(col) for col in cols]
+
+
+def stream_columnar_json(nodes, cols):
+    """Encode a listing as columnar JSON chunk by chunk."""
+    yield '{"columns": %s, "rows": [' % json.dumps(cols)
+    for index, row in enumerate(_rows(nodes, cols)):
+        if index:
+            yield ', '
+        yield json.dumps(row)
+    yield ']}'
+
+
+def encode(media_type, nodes, cols, next_link=None):
+    """Encode a listing in a compact format."""
+    result = {'columns': cols, 'rows': list(_rows(nodes, cols))}
+    if next_link:
+        result['next'] = next_link
+    if media_type == MSGPACK:
+        return msgpack.packb(result, use_bin_type=True)
+    return json.dumps(result)
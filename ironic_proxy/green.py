@@ -0,0 +1,71 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Non-blocking API service based on eventlet green threads.
+
+All network I/O, including requests issued by keystoneauth to the sources,
+is made cooperative, so one process can handle many concurrent requests.
+"""
+
+import eventlet
+eventlet.monkey_patch()
+
+import multiprocessing  # noqa: E402
+import sys  # noqa: E402
+
+from eventlet import wsgi  # noqa: E402
+from oslo_log import log  # noqa: E402
+
+from ironic_proxy import api  # noqa: E402
+from ironic_proxy import conf  # noqa: E402
+from ironic_proxy import groups  # noqa: E402
+
+
+LOG = log.getLogger(__name__)
+
+
+class _AsyncResult(object):
+
+    def __init__(self, thread):
+        self._thread = thread
+
+    def get(self, timeout=None):
+        with eventlet.Timeout(timeout, multiprocessing.TimeoutError):
+            return self._thread.wait()
+
+
+class GreenPool(object):
+    """A green thread pool compatible with multiprocessing.pool.ThreadPool.
+
+    Only the methods used by the groups module are implemented. Every task
+    runs in a new green thread: a bounded pool shared by all requests would
+    make concurrent fan-outs wait for each other. Requests to every source
+    are limited by admission control instead.
+    """
+
+    def apply_async(self, func, args=()):
+        return _AsyncResult(eventlet.spawn(func, *args))
+
+
+def main(argv):
+    api.init(argv)
+    groups.set_pool(GreenPool())
+
+    sock = eventlet.listen((conf.CONF.api.host_ip, conf.CONF.api.port))
+    LOG.info('Listening on %s:%d', conf.CONF.api.host_ip, conf.CONF.api.port)
+    wsgi.server(sock, api.app,
+                custom_pool=eventlet.GreenPool(conf.CONF.api.max_connections),
+                log=LOG, debug=conf.CONF.api.debug)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -10,108 +10,665 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import atexit
+import collections
+import multiprocessing
 from multiprocessing import pool
+import os
+import threading
+import time
+import uuid
 
 import flask
+from keystoneauth1 import exceptions as ks_exc
 from oslo_log import log
+from six.moves import queue
+from six.moves.urllib import parse as urlparse
 
+from ironic_proxy import admission
+from ironic_proxy import cache
 from ironic_proxy import common
 from ironic_proxy import conf
+from ironic_proxy import metrics
+from ironic_proxy import pagination
+from ironic_proxy import resources
+from ironic_proxy import singleflight
+from ironic_proxy import tracing
 
 
 LOG = log.getLogger(__name__)
 _POOL = None
+# PID of the process the pool was created in
+_POOL_PID = None
+_POOL_LOCK = threading.Lock()
+# Separate pool for batch operations, so that they cannot take all workers
+_BATCH_POOL = None
+_BATCH_POOL_PID = None
 _CACHE = None
+_SAVE_LOCK = threading.Lock()
+# Periodic task name -> PID of the process it runs in
+_PERIODIC = {}
+_PERIODIC_LOCK = threading.Lock()
+# Fields needed to build the node location index, require API 1.8
+_INDEX_FIELDS = 'uuid,name,instance_uuid'
+_INDEX_MICROVERSION = '1.8'
+# Shared store key marking a recent synchronization of the location index
+_SYNC_KEY = 'index:synced'
+# Number of unknown nodes in a batch that justifies re-indexing all groups
+_BATCH_REINDEX_MIN = 10
+# Maximum size of a relayed request body kept in memory to repeat the request
+_REPLAY_MAX_SIZE = 1024 * 1024
+# Page size of incremental listings of recently changed nodes
+_CHANGES_PAGE_SIZE = 100
+
+FAN_OUT_WIDTH = metrics.Histogram(
+    'ironic_proxy_fan_out_width', 'Number of groups queried in a fan-out',
+    labels=('operation',), buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+FAN_OUT_DURATION = metrics.Histogram(
+    'ironic_proxy_fan_out_duration_seconds', 'Total duration of fan-outs',
+    labels=('operation',))
+FAN_OUT_STRAGGLER = metrics.Histogram(
+    'ironic_proxy_fan_out_straggler_seconds',
+    'Time between the fastest and the slowest group in a fan-out',
+    labels=('operation',))
+FAN_OUT_SKIPPED = metrics.Counter(
+    'ironic_proxy_fan_out_skipped_total',
+    'Groups skipped in fan-outs', labels=('operation', 'reason'))
+LOCATION_LOOKUPS = metrics.Counter(
+    'ironic_proxy_location_cache_lookups_total',
+    'Lookups in the node location cache', labels=('result',))
+POOL_TASKS = metrics.Gauge(
+    'ironic_proxy_pool_tasks',
+    'Tasks submitted to the fan-out pool and not finished yet')
+BACKEND_CONNECTIONS = metrics.Gauge(
+    'ironic_proxy_backend_connections',
+    'Connections to sources', labels=('source', 'host', 'state'))
+BACKEND_UP = metrics.Gauge(
+    'ironic_proxy_backend_up',
+    'Whether the source is available (circuit breaker closed)',
+    labels=('source',))
 _MVERSIONS = None
+_LOOKUPS = singleflight.SingleFlight('find_node')
+_RESOURCE_LOOKUPS = singleflight.SingleFlight('find_resource')
+
+
+def _get_pool():
+    global _POOL, _POOL_PID
+    # Threads do not survive fork, a pool created before a
+    # WSGI server forks its workers would never run any tasks in them.
+    if _POOL is None or _POOL_PID != os.getpid():
+        with _POOL_LOCK:
+            if _POOL is None or _POOL_PID != os.getpid():
+                _POOL = pool.ThreadPool(conf.CONF.fan_out_workers)
+                _POOL_PID = os.getpid()
+    return _POOL
+
+
+def _get_batch_pool():
+    global _BATCH_POOL, _BATCH_POOL_PID
+    if _BATCH_POOL is None or _BATCH_POOL_PID != os.getpid():
+        with _POOL_LOCK:
+            if _BATCH_POOL is None or _BATCH_POOL_PID != os.getpid():
+                _BATCH_POOL = pool.ThreadPool(conf.CONF.api.batch_workers)
+                _BATCH_POOL_PID = os.getpid()
+    return _BATCH_POOL
+
+
+def set_pool(new_pool, batch_pool=None):
+    """Replace the pool used to query groups concurrently.
+
+    The pool must provide an apply_async method compatible with
+    multiprocessing.pool.ThreadPool.
+
+    :param batch_pool: pool to run batch operations in, defaults to
+        new_pool.
+    """
+    global _POOL, _POOL_PID, _BATCH_POOL, _BATCH_POOL_PID
+    with _POOL_LOCK:
+        _POOL = new_pool
+        _BATCH_POOL = batch_pool if batch_pool is not None else new_pool
+        _POOL_PID = _BATCH_POOL_PID = os.getpid()
+
+
+def _tracked(func):
+    """Wrap a function to track it in the pool tasks gauge."""
+    def _wrapper(*args):
+        try:
+            return func(*args)
+        finally:
+            POOL_TASKS.dec()
+    return _wrapper
+
+
+def _imap_unordered(func, items, timeout=None):
+    """Call func(item) for all items concurrently.
+
+    Yields the results in the order of completion.
+
+    :raises: multiprocessing.TimeoutError if the results are not received
+        within the timeout.
+    """
+    results = queue.Queue()
+
+    def _call(item):
+        try:
+            results.put((True, func(item)))
+        except Exception as exc:
+            results.put((False, exc))
+
+    items = list(items)
+    POOL_TASKS.inc(len(items))
+    workers = _get_pool()
+    for item in items:
+        workers.apply_async(_tracked(_call), (item,))
+
+    deadline = time.time() + timeout if timeout else None
+    for _item in items:
+        if deadline is None:
+            remaining = None
+        else:
+            remaining = max(0, deadline - time.time())
+        try:
+            success, value = results.get(timeout=remaining)
+        except queue.Empty:
+            raise multiprocessing.TimeoutError()
+        if not success:
+            raise value
+        yield value
+
+
+def _sources():
+    """Get one (group, client) pair per source, sorted by group name.
+
+    Groups served by the same source share the backend, querying them
+    separately would only duplicate the results.
+    """
+    result = []
+    seen = set()
+    for group, cli in sorted(conf.groups().items()):
+        key = cli.name if cli.name is not None else id(cli)
+        if key not in seen:
+            seen.add(key)
+            result.append((group, cli))
+    return result
+
+
+def _plan_list(params):
+    """Find out which (group, client) pairs a node listing must query.
+
+    The listing is restricted to one group if the conductor group is
+    requested explicitly or the requested instance is in the location
+    cache.
+
+    :returns: tuple (targets, key) where key is the location cache key
+        used to find the group or None.
+    """
+    all_groups = conf.groups()
+
+    group = params.get('conductor_group')
+    if group is not None:
+        by_name = {name.lower(): (name, cli)
+                   for name, cli in all_groups.items()}
+        try:
+            target = by_name[group.lower()]
+        except KeyError:
+            LOG.debug('Conductor group %s is not known, nothing to list',
+                      group)
+            return [], None
+        return [target], None
+
+    instance = params.get('instance_uuid')
+    if instance:
+        key = cache.INSTANCE_PREFIX + instance
+        try:
+            group = _get_cache().get(key)
+            return [(group, all_groups[group])], key
+        except KeyError:
+            pass
 
+    return _sources(), None
 
-def _imap_unordered(func, items):
-    global _POOL
-    if _POOL is None:
-        _POOL = pool.ThreadPool()
-    return _POOL.imap_unordered(func, items)
+
+def _fan_out(func, timeout=None, targets=None, operation='other'):
+    """Run func(group, cli) for all groups concurrently.
+
+    Yields (group, result) tuples in a stable order (sorted by group name).
+    Groups that fail or do not respond within the timeout are logged and
+    skipped, so that one bad source does not break the whole result. Groups
+    that are overloaded fail the whole operation, so that the client backs
+    off.
+
+    :param targets: list of (group, client) pairs to query, defaults to
+        one group per source.
+    :param operation: operation name for metrics.
+    """
+    start = time.time()
+    if timeout is None:
+        timeout = conf.CONF.fan_out_timeout
+    deadline = time.time() + timeout if timeout else None
+    if targets is None:
+        targets = _sources()
+
+    available = []
+    for group, cli in targets:
+        if cli.available:
+            available.append((group, cli))
+        else:
+            LOG.warning('Group %s is down, skipping it', group or '<default>')
+            FAN_OUT_SKIPPED.inc(operation=operation, reason='down')
+
+    durations = []
+    parent = tracing.current_span()
+    project = admission.current_project()
+
+    def _timed(group, cli):
+        call_start = time.time()
+        try:
+            with admission.acting_for(project):
+                with tracing.span('group:%s' % (group or '<default>'),
+                                  parent=parent, operation=operation):
+                    return func(group, cli)
+        finally:
+            durations.append(time.time() - call_start)
+
+    FAN_OUT_WIDTH.observe(len(available), operation=operation)
+    POOL_TASKS.inc(len(available))
+    workers = _get_pool()
+    results = [(group, workers.apply_async(_tracked(_timed), (group, cli)))
+               for group, cli in available]
+    for group, result in results:
+        if deadline is None:
+            remaining = None
+        else:
+            remaining = max(0, deadline - time.time())
+
+        try:
+            value = result.get(remaining)
+        except multiprocessing.TimeoutError:
+            LOG.warning('Group %s did not respond in %s seconds, skipping it',
+                        group or '<default>', timeout)
+            FAN_OUT_SKIPPED.inc(operation=operation, reason='timeout')
+        except admission.Overloaded:
+            raise
+        except Exception as exc:
+            LOG.warning('Request to group %s failed, skipping it: %s',
+                        group or '<default>', exc)
+            FAN_OUT_SKIPPED.inc(operation=operation, reason='error')
+        else:
+            yield group, value
+
+    FAN_OUT_DURATION.observe(time.time() - start, operation=operation)
+    if durations:
+        FAN_OUT_STRAGGLER.observe(max(durations) - min(durations),
+                                  operation=operation)
 
 
 def _source(group):
     try:
         return conf.groups()[group]
-    except IndexError:
+    except KeyError:
         raise common.Error('No conductors in group {group}',
                            group=group or '<default>')
 
 
-def _find_node(node_id):
+def _get_cache():
     global _CACHE
+    path = conf.CONF.cache.snapshot_path
+    if conf.CONF.cache.shared_backend != 'memory':
+        path = None
     if _CACHE is None:
-        _CACHE = {}
+        _CACHE = conf.location_cache()
+        if path:
+            if os.path.exists(path):
+                _CACHE.load(path)
+            atexit.register(_save_cache)
+    if path:
+        interval = conf.CONF.cache.snapshot_interval
+        start_periodic(_save_cache, interval, delay=interval)
+    start_periodic(sync_index, conf.CONF.cache.sync_interval)
+    if conf.CONF.cache.shared_path:
+        interval = conf.CONF.cache.purge_interval
+        start_periodic(purge_expired, interval, delay=interval)
+    return _CACHE
+
+
+def start_periodic(func, interval, delay=0):
+    """Call func every interval seconds in a background thread.
+
+    :param delay: delay (in seconds) before the first call.
+    """
+    # Threads do not survive fork, so make sure the thread
+    # is running in the current process.
+    if not interval or _PERIODIC.get(func.__name__) == os.getpid():
+        return
+
+    with _PERIODIC_LOCK:
+        if _PERIODIC.get(func.__name__) == os.getpid():
+            return
+        _PERIODIC[func.__name__] = os.getpid()
+        thread = threading.Thread(target=_periodic_loop,
+                                  args=(func, interval, delay),
+                                  name='ironic-proxy-%s' % func.__name__)
+        thread.daemon = True
+        thread.start()
+
+
+def _periodic_loop(func, interval, delay):
+    time.sleep(delay)
+    while True:
+        try:
+            func()
+        except Exception:
+            LOG.exception('Periodic task %s failed', func.__name__)
+        time.sleep(interval)
+
+
+def sync_index(force=False):
+    """Synchronize the node location index with all groups.
+
+    Deleted nodes are removed from the index. Groups that fail are skipped
+    and keep their current entries. With a shared backend, only one process
+    synchronizes the index per interval (unless force is True).
+    """
+    locations = _get_cache()
+    store = conf.shared_store()
+    shared = conf.CONF.cache.shared_backend != 'memory'
+    if shared and store is not None and not force:
+        if store.get(_SYNC_KEY):
+            LOG.debug('The node location index was recently synchronized '
+                      'by another process')
+            return
+        store.set(_SYNC_KEY, str(os.getpid()),
+                  time=max(1, conf.CONF.cache.sync_interval - 1))
+
+    def _index(group, cli):
+        return list(cli.list_all_nodes({'fields': _INDEX_FIELDS},
+                                       microversion=_INDEX_MICROVERSION))
+
+    for group, nodes in _fan_out(_index, timeout=0, operation='sync_index'):
+        removed = locations.reconcile(group, nodes)
+        LOG.debug('Indexed %d nodes in group %s, removed %d stale entries',
+                  len(nodes), group or '<default>', removed)
+
+
+def _save_cache():
+    # The periodic task and the exit handler may run at the
+    # same time, writing the same file concurrently would fail.
+    with _SAVE_LOCK:
+        try:
+            _CACHE.save(conf.CONF.cache.snapshot_path)
+        except Exception:
+            LOG.exception('Failed to save node locations to %s',
+                          conf.CONF.cache.snapshot_path)
+
+
+def purge_expired():
+    """Remove expired entries from the file shared between processes.
+
+    Entries that are never requested again, such as tokens validated by
+    keystonemiddleware, are otherwise kept forever.
+    """
+    for target in (conf.shared_store(), _CACHE):
+        purge = getattr(target, 'purge', None)
+        if purge is not None:
+            purge()
+
+
+def _remember(item, group, resource=None):
+    """Remember where the node (or another resource) is located."""
+    locations = _get_cache()
+    if resource is None:
+        locations.add(item, group)
+    else:
+        locations.add_keys(resource.index_keys(item), group)
 
-    node = None
+
+def _describe(resource):
+    """Get the collection path, title and name of a resource (None: node)."""
+    if resource is None:
+        return '/v1/nodes', 'Node', 'node'
+    return resource.path, resource.title, resource.name
+
+
+def _poll(ident, microversion=None, resource=None):
+    path, title, name = _describe(resource)
+    operation = 'find_%s' % name
+    LOG.debug('Polling all sources to find %s %s', title.lower(), ident)
+    parent = tracing.current_span()
+    project = admission.current_project()
+    timeout = conf.CONF.fan_out_timeout or None
+
+    def _find(args):
+        group, cli = args
+        try:
+            with admission.acting_for(project):
+                with tracing.span('group:%s' % (group or '<default>'),
+                                  parent=parent, operation=operation):
+                    item = cli.get_resource(path, ident,
+                                            microversion=microversion,
+                                            timeout=timeout)
+        except ks_exc.NotFound:
+            return None, group, None
+        except Exception as exc:
+            return None, group, exc
+        return item, group, None
+
+    failed = []
+    sources = _sources()
+    pending = {group for group, _cli in sources}
+    FAN_OUT_WIDTH.observe(len(sources), operation=operation)
     try:
-        # Check if we already know where the node is
-        group = _CACHE[node_id]
+        for item, group, exc in _imap_unordered(_find, sources, timeout):
+            pending.discard(group)
+            if isinstance(exc, admission.Overloaded):
+                raise exc
+            if exc is not None:
+                LOG.warning('Cannot check group %s for %s %s: %s',
+                            group or '<default>', title.lower(), ident, exc)
+                failed.append(group or '<default>')
+            if item is None:
+                continue
+
+            LOG.info('%s %s found in group %s', title, ident,
+                     group or '<default>')
+            _remember(item, group, resource)
+            return item, group
+    except multiprocessing.TimeoutError:
+        LOG.warning('Groups %s did not respond in %s seconds when looking '
+                    'for %s %s', ', '.join(sorted(g or '<default>'
+                                                  for g in pending)),
+                    timeout, title.lower(), ident)
+        FAN_OUT_SKIPPED.inc(len(pending), operation=operation,
+                            reason='timeout')
+        failed.extend(group or '<default>' for group in pending)
+
+    if failed:
+        # The item may be in one of the failed groups
+        raise common.Error('{title} {ident} was not found, but groups '
+                           '{groups} are unavailable', title=title,
+                           ident=ident, groups=', '.join(sorted(failed)),
+                           code=503)
+    raise common.NotFound('{title} {ident} was not found', title=title,
+                          ident=ident)
+
+
+def _find(ident, microversion=None, resource=None):
+    path, title, name = _describe(resource)
+    key = ident if resource is None else resource.key(ident)
+    locations = _get_cache()
+    try:
+        # Check if we already know where the item is
+        group = locations.get(key)
     except KeyError:
-        # Node unknown, let's find it
-        LOG.debug('Polling all sources to find node %s', node_id)
+        # Item unknown, let's find it
+        LOCATION_LOOKUPS.inc(result='miss')
+        with FAN_OUT_DURATION.time(operation='find_%s' % name):
+            return _poll(ident, microversion, resource)
 
-        # NOTE(dtantsur): we're using threads, so flask.request won't be
-        # available. Pass the microversion explicitly.
-        microversion = getattr(flask.request, 'microversion', None)
+    LOCATION_LOOKUPS.inc(result='hit')
+    # Item is known, just fetch it
+    cli = _source(group)
+    try:
+        item = cli.get_resource(path, ident, microversion=microversion,
+                                timeout=conf.CONF.fan_out_timeout or None)
+    except ks_exc.NotFound:
+        LOG.info('%s %s is no longer in group %s, polling all sources',
+                 title, ident, group or '<default>')
+        locations.remove(key)
+        return _poll(ident, microversion, resource)
 
-        def _find(args):
-            group, cli = args
-            try:
-                node = cli.get_node(node_id, microversion=microversion)
-            except Exception:
-                node = None
-            return node, group
+    return item, group
 
-        for node, group in _imap_unordered(_find, conf.groups().items()):
-            if node is None:
-                continue
 
-            LOG.info('Node %s found in group %s',
-                     node_id, group or '<default>')
-            # Remember where the node is located
-            _CACHE[node['uuid']] = group
-            break
-    else:
-        # Node is known, just fetch it
-        cli = _source(group)
-        node = cli.get_node(node_id)
+def _request_context():
+    """Get the parts of the current request that may affect responses."""
+    try:
+        request = flask.request
+        return (getattr(request, 'microversion', None),
+                request.headers.get('X-Project-Id'),
+                request.headers.get('X-Roles'))
+    except RuntimeError:
+        return None, None, None
 
-    if node is None:
-        raise common.NotFound('Node {node} was not found', node=node_id)
-    return node, group
 
+def _locate_node(node_id, context=None):
+    """Find a node, sharing the lookup with concurrent identical requests.
 
-def _cache_nodes(nodes, group):
-    global _CACHE
-    if _CACHE is None:
-        _CACHE = {}
+    :param context: result of _request_context(), defaults to the current
+        request.
+    :returns: tuple (node, group).
+    """
+    if context is None:
+        context = _request_context()
+    return _LOOKUPS.do((node_id,) + context, _find, node_id, context[0])
 
-    for node in nodes:
-        if 'uuid' in node:
-            LOG.info('Node %s found in group %s',
-                     node['uuid'], group or '<default>')
-            _CACHE[node['uuid']] = group
 
+def _locate_resource(resource, ident, context=None):
+    """Find a resource, sharing the lookup with concurrent requests.
 
-def microversions():
+    :returns: tuple (item, group).
+    """
+    if context is None:
+        context = _request_context()
+    return _RESOURCE_LOOKUPS.do((resource.name, ident) + context, _find,
+                                ident, context[0], resource)
+
+
+def _locate(ident, resource=None):
+    if resource is None:
+        return _locate_node(ident)
+    return _locate_resource(resource, ident)
+
+
+def _cache_items(items, group, resource=None):
+    for item in items:
+        if 'uuid' in item:
+            LOG.debug('%s %s found in group %s', _describe(resource)[1],
+                      item['uuid'], group or '<default>')
+            _remember(item, group, resource)
+
+
+def refresh_microversions(cached=False, authenticate=False):
+    """Refresh the range of microversions supported by all groups.
+
+    Groups that fail or time out are ignored. If all of them fail, the
+    previous range is kept.
+
+    :param cached: whether to use the results cached in the shared store.
+    :param authenticate: whether to also make sure all groups have a valid
+        token.
+    """
     global _MVERSIONS
-    if _MVERSIONS is None:
-        curr_min = (1, 1)
-        curr_max = (1, 999)
-        for minv, maxv in _imap_unordered(
-                lambda cli: cli.get_microversions(),
-                conf.groups().values()):
-            curr_min = max(curr_min, minv)
-            curr_max = min(curr_max, maxv)
+    ttl = conf.CONF.cache.discovery_ttl
+    timeout = conf.CONF.fan_out_timeout or None
+
+    def _get(group, cli):
+        if authenticate:
+            cli.authenticate()
+        return cli.get_microversions(ttl=ttl, cached=cached, timeout=timeout)
+
+    curr_min = (1, 1)
+    curr_max = (1, 999)
+    found = False
+    for _group, (minv, maxv) in _fan_out(_get, operation='microversions'):
+        curr_min = max(curr_min, minv)
+        curr_max = min(curr_max, maxv)
+        found = True
+
+    if not found:
+        LOG.error('Unable to fetch microversions from any group')
+        return _MVERSIONS
+
+    if (curr_min, curr_max) != _MVERSIONS:
         LOG.info('Will support microversion range %s to %s',
                  curr_min, curr_max)
         _MVERSIONS = curr_min, curr_max
     return _MVERSIONS
 
 
+def microversions():
+    """Get the range of microversions supported by all groups.
+
+    Only blocks if the range has never been fetched before.
+    """
+    start_periodic(refresh_microversions,
+                   conf.CONF.microversion_refresh_interval,
+                   delay=conf.CONF.microversion_refresh_interval)
+    if _MVERSIONS is None:
+        refresh_microversions(cached=True)
+        if _MVERSIONS is None:
+            raise common.Error('Unable to fetch microversions from any group',
+                               code=503)
+    return _MVERSIONS
+
+
+def warm_up():
+    """Prepare all groups for serving requests.
+
+    Creates the clients, authenticates and fetches the supported
+    microversions for all sources in parallel.
+    """
+    start = time.time()
+    try:
+        conf.groups()
+        refresh_microversions(cached=True, authenticate=True)
+    except Exception:
+        LOG.exception('Unable to prepare groups on start up')
+    else:
+        LOG.info('Prepared %d sources in %.3f seconds', len(_sources()),
+                 time.time() - start)
+
+
+def readiness():
+    """Check whether the service is ready to serve requests.
+
+    :returns: tuple (ready, details) where details maps group names to
+        their availability.
+    """
+    details = {group: {'available': cli.available}
+               for group, cli in sorted(conf.groups().items())}
+    ready = _MVERSIONS is not None and any(item['available']
+                                           for item in details.values())
+    return ready, details
+
+
+def pool_stats():
+    """Get connection pool statistics for all groups."""
+    return {group: cli.pool_stats()
+            for group, cli in sorted(conf.groups().items())}
+
+
+@metrics.on_collect
+def _collect_metrics():
+    for _group, cli in _sources():
+        BACKEND_UP.set(int(cli.available), source=cli.name)
+        for host, stats in cli.pool_stats().items():
+            BACKEND_CONNECTIONS.set(stats['connections'], source=cli.name,
+                                    host=host, state='created')
+            BACKEND_CONNECTIONS.set(stats['idle'], source=cli.name,
+                                    host=host, state='idle')
+
+
 def create_node(node):
     group = node.get('conductor_group', '')
     cli = _source(group)
@@ -119,24 +676,414 @@ def create_node(node):
 
 
 def get_node(node_id):
-    return _find_node(node_id)[0]
+    return _locate_node(node_id)[0]
+
+
+def create_resource(resource, body):
+    """Create a resource in the group of its node.
+
+    Resources with candidate nodes are created in the group with most of
+    them, global resources are created in all sources. Other resources that
+    do not reference a node are created in the default group.
+    """
+    if resource.broadcast:
+        return _create_everywhere(resource, body)
+
+    node_id = resource.node_of(body)
+    if node_id:
+        group = _locate_node(node_id)[1]
+    elif resource.candidates_of(body):
+        group, body = _pick_candidates(resource, body)
+    else:
+        group = ''
+    cli = _source(group)
+    return cli.request(resource.path, 'POST', json=body).json()
+
+
+def _pick_candidates(resource, body):
+    """Pick the group of a new resource with candidate nodes.
+
+    A source only knows its own nodes, so the resource is created in the
+    group with most candidates (the first one on a tie), and the candidates
+    from other groups are removed.
+
+    :returns: tuple (group, updated body).
+    """
+    by_group = collections.OrderedDict()
+    for node_id in resource.candidates_of(body):
+        try:
+            group = _locate_node(node_id)[1]
+        except common.NotFound:
+            raise common.Error('Candidate node {node} was not found',
+                               node=node_id)
+        by_group.setdefault(group, []).append(node_id)
+
+    group, candidates = max(by_group.items(), key=lambda item: len(item[1]))
+    if len(by_group) > 1:
+        LOG.info('Candidate nodes of a new %s are in groups %s, using %d of '
+                 'them in group %s', resource.title.lower(),
+                 ', '.join(g or '<default>' for g in by_group),
+                 len(candidates), group or '<default>')
+    return group, dict(body, **{resource.candidates_field: candidates})
+
+
+def _create_everywhere(resource, body):
+    """Create a global resource in all sources.
+
+    The resource is deleted from the sources it was created in if any of
+    them fails.
+    """
+    # The copies must have the same UUID to be updated and
+    # deleted together.
+    body = dict(body)
+    body.setdefault('uuid', str(uuid.uuid4()))
+    url = '%s/%s' % (resource.path, urlparse.quote(body['uuid'], safe=''))
+    created = []
+    try:
+        for group, cli in _sources():
+            item = cli.request(resource.path, 'POST', json=body).json()
+            created.append((cli, item))
+    except Exception:
+        for cli, _item in created:
+            try:
+                cli.request(url, 'DELETE')
+            except Exception as exc:
+                LOG.error('Cannot delete %s %s from %s after a failed '
+                          'creation: %s', resource.title.lower(),
+                          body['uuid'], cli.name, exc)
+        raise
+    return created[0][1]
+
+
+def get_resource(resource, ident):
+    return _locate_resource(resource, ident)[0]
+
+
+def _fetch(params_for, targets, resource=None, url=None):
+    """Fetch nodes (or other resources) from several groups concurrently.
+
+    :param params_for: callable accepting a group and returning query
+        parameters to use for this group.
+    :param targets: list of (group, client) pairs to query.
+    :param resource: Resource to list, defaults to nodes.
+    :param url: URL of the resource listing.
+    :returns: iterator over tuples (group, items).
+    """
+    # NOTE(dtantsur): we're using threads, so flask.request won't be
+    # available. Pass the microversion explicitly.
+    microversion = getattr(flask.request, 'microversion', None)
+    timeout = conf.CONF.fan_out_timeout or None
+    name = 'nodes' if resource is None else resource.name
+
+    def _list(group, cli):
+        LOG.debug('Loading %s from %s', name, group or '<default>')
+        if resource is None:
+            return cli.list_nodes(params=params_for(group),
+                                  microversion=microversion, timeout=timeout)
+        return cli.list_resources(url, name, params=params_for(group),
+                                  microversion=microversion, timeout=timeout)
+
+    for group, items in _fan_out(_list, targets=targets,
+                                 operation='list_%s' % name):
+        _cache_items(items, group, resource)
+        yield group, items
+
+
+def _list_all(params, targets, resource=None, url=None):
+    """Stream items from several groups.
+
+    The requests are sent (and admitted) before returning, so that errors,
+    such as overload, are reported to the client. Only the response bodies
+    are streamed. If sorting is requested, the streams are merged.
+    """
+    # We're using threads (and the result may be consumed
+    # after the request is finished), so flask.request won't be available.
+    # Pass the microversion explicitly.
+    microversion = getattr(flask.request, 'microversion', None)
+    timeout = conf.CONF.fan_out_timeout or None
+    name = 'nodes' if resource is None else resource.name
+
+    sort_key = params.get('sort_key')
+    sort_dir = params.get('sort_dir')
+    extra = set()
+    if sort_key or sort_dir:
+        sort_key = sort_key or pagination.DEFAULT_SORT_KEY
+        sort_dir = sort_dir or 'asc'
+        if sort_dir not in pagination.SORT_DIRS:
+            raise common.Error('Invalid sort direction {dir}', dir=sort_dir)
+        fields, extra = pagination.required_fields(params, sort_key)
+        params = dict(params, sort_key=sort_key, sort_dir=sort_dir)
+        if fields:
+            params['fields'] = fields
+
+    def _open(group, cli):
+        LOG.debug('Streaming %s from %s', name, group or '<default>')
+        if resource is None:
+            return cli.iter_nodes(params=params, microversion=microversion,
+                                  timeout=timeout)
+        return cli.iter_resources(url, name, params=params,
+                                  microversion=microversion, timeout=timeout)
+
+    listings = list(_fan_out(_open, targets=targets,
+                             operation='list_%s' % name))
+
+    def _items(group, items):
+        try:
+            for item in items:
+                if 'uuid' in item:
+                    _remember(item, group, resource)
+                yield item
+        except Exception as exc:
+            LOG.warning('Listing %s from group %s was interrupted: %s',
+                        name, group or '<default>', exc)
+
+    def _iter():
+        streams = [(group, _items(group, items))
+                   for group, items in listings]
+        if sort_key:
+            merged = pagination.iter_merged(streams, sort_key, sort_dir)
+        else:
+            merged = ((group, item) for group, items in streams
+                      for item in items)
+        for _group, item in merged:
+            for key in extra:
+                item.pop(key, None)
+            yield item
+
+    return _iter()
+
+
+def _positions_after(ident, params, targets, resource=None):
+    """Find the positions of all groups after the item with the identifier.
+
+    Clients of ironic pass the UUID of the last item they have seen as the
+    marker. Its group resumes from it, other groups resume from their last
+    item sorted before it, which requires listing them up to this item.
+
+    :returns: per-group positions as stored in markers.
+    """
+    try:
+        item, start_group = _locate(ident, resource)
+    except common.NotFound:
+        raise common.Error('Invalid marker {marker}', marker=ident)
+
+    sort_key = params['sort_key']
+    sort_dir = params['sort_dir']
+    start = pagination.position(start_group, item, sort_key)
+    # Fields require API 1.8, the client may use an older
+    # version since it does not request them.
+    microversion = max(getattr(flask.request, 'microversion', None) or (1, 1),
+                       (1, 8))
+    microversion = '%d.%d' % microversion
+    timeout = conf.CONF.fan_out_timeout or None
+    path = '/v1/nodes' if resource is None else resource.path
+    name = 'nodes' if resource is None else resource.name
+    base = dict(params, fields=','.join(sorted({'uuid', sort_key})))
+    base.pop('detail', None)
+
+    def _find_last(group, cli):
+        query = dict(base)
+        last = None
+        while True:
+            items = cli.list_resources(path, name, params=query,
+                                       microversion=microversion,
+                                       timeout=timeout)
+            for item in items:
+                if not pagination.precedes(
+                        pagination.position(group, item, sort_key), start,
+                        sort_dir):
+                    return last
+                last = item['uuid']
+            if len(items) < query['limit']:
+                return last
+            query['marker'] = last
+
+    others = [(group, cli) for group, cli in targets if group != start_group]
+    positions = {start_group: item['uuid']}
+    for group, last in _fan_out(_find_last, targets=others,
+                                operation='find_marker'):
+        if last is not None:
+            positions[group] = last
+    return positions
+
+
+def _list_page(params, limit, marker, targets, resource=None, url=None):
+    sort_key = params.get('sort_key') or pagination.DEFAULT_SORT_KEY
+    sort_dir = params.get('sort_dir') or 'asc'
+    if sort_dir not in pagination.SORT_DIRS:
+        raise common.Error('Invalid sort direction {dir}', dir=sort_dir)
+    fields, extra = pagination.required_fields(params, sort_key)
+
+    base = dict(params, limit=limit, sort_key=sort_key, sort_dir=sort_dir)
+    base.pop('marker', None)
+    positions = pagination.decode_marker(marker)
+    if positions is None:
+        positions = _positions_after(marker, base, targets, resource)
+    if fields:
+        base['fields'] = fields
+
+    def _params(group):
+        result = dict(base)
+        if positions.get(group):
+            result['marker'] = positions[group]
+        return result
+
+    listings = list(_fetch(_params, targets, resource, url))
+    page = pagination.merge(listings, limit, sort_key, sort_dir)
+    for group, item in page:
+        positions[group] = item['uuid']
+
+    total = sum(len(items) for _group, items in listings)
+    if total > len(page) or any(len(items) >= limit
+                                for _group, items in listings):
+        next_marker = pagination.encode_marker(positions)
+    else:
+        next_marker = None
+
+    items = [item for _group, item in page]
+    for item in items:
+        for key in extra:
+            item.pop(key, None)
+    return items, next_marker
+
+
+def _list(params, targets, resource=None, url=None):
+    limit = pagination.parse_limit(params.get('limit'),
+                                   conf.CONF.api.max_limit)
+    marker = params.get('marker')
+    if limit is None and not marker:
+        return _list_all(params, targets, resource, url), None
+
+    return _list_page(params, limit or conf.CONF.api.max_limit, marker,
+                      targets, resource, url)
 
 
 def list_nodes(params=None):
+    """List nodes from all groups.
+
+    If limit or marker is requested, listings from all groups are merged
+    according to sort_key and sort_dir, and only one page is returned.
+
+    :returns: tuple (nodes, marker) where nodes is an iterable and marker is
+        an opaque marker of the next page or None.
+    """
     if params is None:
         params = flask.request.args
-    result = []
-    for group, cli in conf.groups().items():
-        LOG.debug('Loading nodes from %s', group or '<default>')
-        nodes = cli.list_nodes(params=params)
-        _cache_nodes(nodes, group)
-        result.extend(nodes)
-    return result
+    targets, key = _plan_list(params)
+    nodes, marker = _list(params, targets)
+    if key is None or params.get('marker'):
+        return nodes, marker
+
+    # The instance may have moved to a node in another group (e.g. on
+    # evacuation), the index is only updated on the next sync.
+    nodes = list(nodes)
+    if nodes:
+        return nodes, marker
+
+    LOG.info('Location of %s is stale, listing all groups', key)
+    _get_cache().remove(key)
+    return _list(params, _sources())
 
 
-def proxy_request(node_id, url=None, method=None, params=None, body=None,
-                  json_response=True):
-    group = _find_node(node_id)[1]
+def _plan_resources(resource, params):
+    """Find out which (group, client) pairs a resource listing must query.
+
+    The listing is restricted to one group if it is filtered by a node or
+    by a resource with a known location. Global resources are listed from
+    the first source, since all sources have the same copies.
+    """
+    if resource.broadcast:
+        return _sources()[:1]
+
+    for param, target in sorted(resource.filters.items()):
+        value = params.get(param)
+        if not value:
+            continue
+
+        if target == resources.NODE:
+            try:
+                group = _get_cache().get(value)
+            except KeyError:
+                group = _locate_node(value)[1]
+        else:
+            try:
+                group = _get_cache().get(resources.BY_NAME[target].key(value))
+            except KeyError:
+                continue
+        return [(group, _source(group))]
+
+    return _sources()
+
+
+def list_resources(resource, params=None, url=None):
+    """List resources other than nodes from all groups.
+
+    Works the same way as list_nodes.
+
+    :param url: URL of the listing, defaults to the path of the request.
+    """
+    if params is None:
+        params = flask.request.args
+    if url is None:
+        url = flask.request.path
+    return _list(params, _plan_resources(resource, params), resource, url)
+
+
+def _iter_since(cli, params, key, mark, microversion):
+    """List nodes with the key not older than the mark, newest first."""
+    params = dict(params, sort_key=key, sort_dir='desc',
+                  limit=_CHANGES_PAGE_SIZE)
+    while True:
+        nodes = cli.list_nodes(params, microversion=microversion)
+        for node in nodes:
+            # Nodes that were never updated come last (and
+            # are picked up by complete listings). Nodes with the mark
+            # itself are returned again, the caller filters them out.
+            if node.get(key) is None:
+                return
+            if mark is not None and node[key] < mark:
+                return
+            yield node
+        if len(nodes) < _CHANGES_PAGE_SIZE:
+            return
+        params['marker'] = nodes[-1]['uuid']
+
+
+def list_changed_nodes(fields, since, microversion=None):
+    """List nodes created or updated since the given marks in all groups.
+
+    :param fields: fields to fetch, must include uuid, created_at and
+        updated_at.
+    :param since: dictionary mapping groups to dictionaries with the newest
+        known created_at and updated_at values. Groups that are not in it
+        are listed completely.
+    :returns: iterator over tuples (group, complete, nodes) where complete
+        is whether all nodes of the group are listed.
+    """
+    base = {'fields': ','.join(fields)}
+
+    def _list(group, cli):
+        marks = since.get(group)
+        if marks is None:
+            return True, list(cli.list_all_nodes(base,
+                                                 microversion=microversion))
+
+        result = collections.OrderedDict()
+        for key in ('updated_at', 'created_at'):
+            for node in _iter_since(cli, base, key, marks.get(key),
+                                    microversion):
+                result[node['uuid']] = node
+        return False, list(result.values())
+
+    for group, (complete, nodes) in _fan_out(_list, timeout=0,
+                                             operation='list_changes'):
+        yield group, complete, nodes
+
+
+def proxy_request(ident, url=None, method=None, params=None, body=None,
+                  json_response=True, resource=None):
+    """Send a request to the group of the node (or another resource)."""
+    group = _locate(ident, resource)[1]
     cli = _source(group)
 
     if url is None:
@@ -151,3 +1098,224 @@ def proxy_request(node_id, url=None, method=None, params=None, body=None,
     resp = cli.request(url, method, params=params, json=body)
     if json_response:
         return resp.json()
+
+
+def proxy_everywhere(ident, resource, json_response=True):
+    """Send the current request for a global resource to all sources.
+
+    Sources without the resource are skipped.
+
+    :returns: the response of the first source that has the resource.
+    """
+    request = flask.request
+    body = request.get_json(force=True, silent=True)
+    result = None
+    found = False
+    for group, cli in _sources():
+        try:
+            resp = cli.request(request.path, request.method,
+                               params=request.args, json=body)
+        except ks_exc.NotFound:
+            LOG.warning('%s %s is missing in group %s', resource.title,
+                        ident, group or '<default>')
+            continue
+        if not found and json_response:
+            result = resp.json()
+        found = True
+
+    if not found:
+        raise common.NotFound('{title} {ident} was not found',
+                              title=resource.title, ident=ident)
+    return result
+
+
+def proxy_raw(ident, url, method, params=None, body=None, headers=None,
+              resource=None):
+    """Send a request to the group of the node without processing it.
+
+    :param ident: node identifier, or an identifier of the resource.
+    :param body: file-like object or iterable with the request body.
+    :param headers: request headers to pass to the source.
+    :param resource: Resource the identifier belongs to, defaults to nodes.
+    :returns: requests Response with the body not read yet. Any status code
+        is returned as it is, except for 404 from the cached group of the
+        item, after which the item is looked up again. The caller must
+        close the response.
+    """
+    key = ident if resource is None else resource.key(ident)
+    try:
+        group = _get_cache().get(key)
+    except KeyError:
+        group = None
+
+    if group is not None and body is not None:
+        # The request is repeated if the cached location is
+        # stale, so its body must be kept. Large bodies are streamed after
+        # the location is verified instead.
+        try:
+            size = len(body)
+        except TypeError:
+            size = None
+        if size is not None and size <= _REPLAY_MAX_SIZE:
+            body = body.read()
+        else:
+            group = None
+
+    def _send(group):
+        cli = _source(group)
+        return cli.request(url, method, params=params, data=body,
+                           headers=dict(headers or {}), stream=True,
+                           raise_exc=False, log=False)
+
+    if group is not None:
+        LOCATION_LOOKUPS.inc(result='hit')
+        resp = _send(group)
+        if resp.status_code != 404:
+            return resp
+        resp.close()
+        LOG.info('%s %s may no longer be in group %s, polling all sources',
+                 _describe(resource)[1], ident, group or '<default>')
+        _get_cache().remove(key)
+
+    group = _locate(ident, resource)[1]
+    return _send(group)
+
+
+def _batch_item(op, group, microversion):
+    """Run one operation of a batch in the given group."""
+    cli = _source(group)
+    url = '/v1/nodes/%s' % urlparse.quote(op['node'], safe='')
+    if op.get('path'):
+        url = '%s/%s' % (url, op['path'].strip('/'))
+
+    resp = cli.request(url, op['method'], microversion=microversion,
+                       params=op.get('params'), json=op.get('body'))
+    return resp.status_code, resp.json() if resp.content else None
+
+
+def _batch_run(index, op, group, cached, context):
+    """Run one operation of a batch and build its result.
+
+    :returns: result dictionary or None if the node is no longer in the
+        cached group and must be looked up again.
+    """
+    result = {'index': index, 'node': op['node']}
+    try:
+        status, body = _batch_item(op, group, context[0])
+    except Exception as exc:
+        if cached and isinstance(exc, ks_exc.NotFound):
+            LOG.info('Node %s is no longer in group %s, polling all sources',
+                     op['node'], group or '<default>')
+            _get_cache().remove(op['node'])
+            return None
+
+        result['status'] = getattr(exc, 'http_status', None) or getattr(
+            exc, 'code', None) or 500
+        if isinstance(exc, (ks_exc.HttpError, common.Error)):
+            result['error'] = getattr(exc, 'details', None) or str(exc)
+        else:
+            LOG.exception('Batch operation %d on node %s failed',
+                          index, op['node'])
+            result['error'] = 'Internal server error'
+    else:
+        result['status'] = status
+        if body is not None:
+            result['body'] = body
+    return result
+
+
+def batch(operations, concurrency):
+    """Run operations on many nodes, concurrently per group.
+
+    Operations on nodes in the location cache are queued to their groups
+    immediately. The remaining nodes are looked up one by one (after
+    re-indexing all groups if there are many of them), as well as the nodes
+    that are no longer in their cached groups. At most concurrency
+    operations run in every group at the same time.
+
+    :param operations: list of dictionaries with keys node, method and
+        optionally path (relative to the node), params and body.
+    :param concurrency: maximum number of concurrent operations per group.
+    :returns: iterator over dictionaries with keys index (in operations),
+        node, status and either body or error, in the order of completion.
+    """
+    # The result is consumed after the request is finished,
+    # so flask.request won't be available.
+    context = _request_context()
+    results = queue.Queue()
+    pending = collections.defaultdict(collections.deque)
+    active = collections.defaultdict(int)
+    lock = threading.Lock()
+
+    def _drain(group):
+        while True:
+            with lock:
+                if not pending[group]:
+                    active[group] -= 1
+                    return
+                index, op, cached = pending[group].popleft()
+            with admission.acting_for(context[1]):
+                result = _batch_run(index, op, group, cached, context)
+            # Looking up a node polls all groups using the
+            # same pool, doing it in the pool may exhaust it and deadlock.
+            # Stale nodes are sent back to the dispatcher instead.
+            if result is None:
+                results.put((False, (index, op)))
+            else:
+                results.put((True, result))
+
+    def _dispatch(index, op, locate=True):
+        cached = True
+        try:
+            group = _get_cache().get(op['node'])
+        except KeyError:
+            if not locate:
+                return False
+            cached = False
+            try:
+                group = _locate_node(op['node'], context)[1]
+            except Exception as exc:
+                results.put((True, {'index': index, 'node': op['node'],
+                                    'status': getattr(exc, 'code', 500),
+                                    'error': str(exc)}))
+                return True
+
+        with lock:
+            pending[group].append((index, op, cached))
+            if active[group] >= concurrency:
+                return True
+            active[group] += 1
+        # A drain keeps its worker until the queue of the group is empty,
+        # running it in the fan-out pool would starve listings.
+        _get_batch_pool().apply_async(_drain, (group,))
+        return True
+
+    def _iter():
+        # Start with the nodes with known locations
+        unknown = [(index, op) for index, op in enumerate(operations)
+                   if not _dispatch(index, op, locate=False)]
+        if len(unknown) >= _BATCH_REINDEX_MIN:
+            # One listing per group is cheaper than polling for every node
+            LOG.debug('%d nodes in a batch are not known, re-indexing',
+                      len(unknown))
+            sync_index(force=True)
+
+        retry = collections.deque(unknown)
+        received = 0
+        while received < len(operations):
+            if retry:
+                _dispatch(*retry.popleft())
+                try:
+                    done, item = results.get_nowait()
+                except queue.Empty:
+                    continue
+            else:
+                done, item = results.get()
+
+            if done:
+                received += 1
+                yield item
+            else:
+                retry.append(item)
+
+    return _iter()
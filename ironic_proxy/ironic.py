@@ -10,27 +10,242 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import datetime
+import itertools
+import json
+import os
+import threading
+import time
+
 import flask
+from keystoneauth1 import exceptions as ks_exc
 from oslo_log import log
+from six.moves import queue
 from six.moves.urllib import parse as urlparse
 
+from ironic_proxy import admission
+from ironic_proxy import common
+from ironic_proxy import metrics
+from ironic_proxy import resilience
+from ironic_proxy import resources
+from ironic_proxy import tracing
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 
 VERSION_HEADER = 'X-OpenStack-Ironic-API-Version'
 MIN_VERSION_HEADER = 'X-OpenStack-Ironic-API-Minimum-Version'
 MAX_VERSION_HEADER = 'X-OpenStack-Ironic-API-Maximum-Version'
 LOG = log.getLogger(__name__)
+_LIST_URLS = frozenset(itertools.chain(
+    ['/v1/nodes', '/v1/nodes/detail'],
+    resources.ALL,
+    ('%s/detail' % resource.path for resource in resources.ALL.values()
+     if resource.detail_path)))
+
+BACKEND_DURATION = metrics.Histogram(
+    'ironic_proxy_backend_request_duration_seconds',
+    'Duration of requests to sources', labels=('source', 'category'))
+BACKEND_ERRORS = metrics.Counter(
+    'ironic_proxy_backend_errors_total',
+    'Failed requests to sources', labels=('source', 'status'))
+
+
+def _parse_version(version):
+    return tuple(int(x) for x in version.split('.', 1))
 
 
 class Ironic(object):
     """A simple ironic client."""
 
-    def __init__(self, adapter):
+    def __init__(self, adapter, idle_timeout=None, name=None, store=None,
+                 policy=None, scheduler=None, accept_encoding=None):
         if adapter.service_type is None:
             adapter.service_type = 'baremetal'
         self._adapter = adapter
+        self.policy = policy or resilience.Policy()
+        self.scheduler = scheduler or admission.Scheduler(name=name)
+        self.accept_encoding = accept_encoding
+        self._idle_timeout = idle_timeout
+        self._last_used = None
+        self._pid = os.getpid()
+        self._pid_lock = threading.Lock()
+        self.name = name
+        self._store = store
+        self._auth_ref = None
+        self._load_auth_state()
+
+    def _load_auth_state(self):
+        auth = self._adapter.auth
+        if self._store is None or not hasattr(auth, 'set_auth_state'):
+            return
+
+        try:
+            state = self._store.get('auth:%s' % self.name)
+            if state:
+                auth.set_auth_state(state)
+                self._auth_ref = auth.auth_ref
+        except Exception as exc:
+            LOG.warning('Cannot load shared authentication state for %s: %s',
+                        self.name, exc)
+
+    def _save_auth_state(self):
+        auth = self._adapter.auth
+        if self._store is None or not hasattr(auth, 'get_auth_state'):
+            return
+
+        auth_ref = auth.auth_ref
+        if auth_ref is None or auth_ref is self._auth_ref:
+            return
+
+        self._auth_ref = auth_ref
+        ttl = 0
+        if auth_ref.expires is not None:
+            now = datetime.datetime.now(auth_ref.expires.tzinfo)
+            ttl = max(1, int((auth_ref.expires - now).total_seconds()))
+
+        try:
+            self._store.set('auth:%s' % self.name, auth.get_auth_state(),
+                            time=ttl)
+        except Exception as exc:
+            LOG.warning('Cannot save shared authentication state for %s: %s',
+                        self.name, exc)
+
+    def _http_adapters(self):
+        result = []
+        for http in self._adapter.session.session.adapters.values():
+            if http not in result:
+                result.append(http)
+        return result
+
+    def _check_fork(self):
+        # Connections opened before a WSGI server forks its
+        # workers must not be shared by them.
+        if self._pid == os.getpid():
+            return
+        with self._pid_lock:
+            if self._pid != os.getpid():
+                LOG.debug('Running in a new process, closing connections '
+                          'opened by the parent process')
+                for http in self._http_adapters():
+                    http.close()
+                self._pid = os.getpid()
+
+    def _check_idle(self):
+        now = time.time()
+        idle = now - (self._last_used or now)
+        if self._idle_timeout and idle > self._idle_timeout:
+            LOG.debug('Closing connections idle for %d seconds', idle)
+            for http in self._http_adapters():
+                http.close()
+        self._last_used = now
+
+    def pool_stats(self):
+        """Get usage statistics of connection pools.
+
+        :returns: dictionary mapping hosts to dictionaries with keys
+            ``connections`` (number of connections ever created),
+            ``requests`` (number of requests made), ``idle`` (number of
+            connections available for reuse) and ``maxsize``.
+        """
+        result = {}
+        for http in self._http_adapters():
+            pools = http.poolmanager.pools
+            for key in list(pools.keys()):
+                try:
+                    conn_pool = pools[key]
+                except KeyError:
+                    continue
+                host = '%s://%s:%s' % (conn_pool.scheme, conn_pool.host,
+                                       conn_pool.port)
+                result[host] = {
+                    'connections': conn_pool.num_connections,
+                    'requests': conn_pool.num_requests,
+                    'idle': conn_pool.pool.qsize() if conn_pool.pool else 0,
+                    'maxsize': conn_pool.pool.maxsize if conn_pool.pool else 0,
+                }
+        return result
+
+    def authenticate(self):
+        """Make sure the client has a valid token."""
+        if self._adapter.auth is None:
+            return
+        try:
+            self._adapter.get_token()
+        finally:
+            self._save_auth_state()
+
+    @property
+    def available(self):
+        """Whether the source is not known to be down."""
+        return self.policy.breaker.is_available()
+
+    def _send(self, url, method, microversion, kwargs, endpoint=None):
+        if endpoint is not None:
+            kwargs = dict(kwargs, endpoint_override=endpoint)
+        try:
+            return self._adapter.request(url, method,
+                                         microversion=microversion, **kwargs)
+        finally:
+            self._save_auth_state()
+
+    def _send_hedged(self, url, microversion, kwargs, delay):
+        """Send a GET request, repeating it to the hedge endpoint if slow."""
+        results = queue.Queue()
+
+        def _run(endpoint=None):
+            try:
+                results.put((True, self._send(url, 'GET', microversion,
+                                              kwargs, endpoint)))
+            except Exception as exc:
+                results.put((False, exc))
+
+        def _spawn(endpoint=None):
+            thread = threading.Thread(target=_run, args=(endpoint,))
+            thread.daemon = True
+            thread.start()
+
+        _spawn()
+        pending = 1
+        try:
+            success, value = results.get(timeout=delay)
+        except queue.Empty:
+            LOG.debug('GET %s takes longer than %.3f seconds, sending a '
+                      'hedged request to %s', url, delay,
+                      self.policy.hedge_endpoint)
+            _spawn(self.policy.hedge_endpoint)
+            pending += 1
+            success, value = results.get()
+        pending -= 1
+
+        while not success and pending:
+            success, value = results.get()
+            pending -= 1
+
+        if success:
+            return value
+        raise value
 
     def request(self, url, method, microversion=None, **kwargs):
-        """Issue a request."""
+        """Issue a request.
+
+        Applies the resilience policy: GET requests are retried on connection
+        failures and 502-504 responses and may be hedged, timeouts are based
+        on the observed latency, failing sources are not requested.
+
+        Every attempt is subject to admission control by the scheduler.
+
+        :raises: admission.Overloaded if the request is not admitted.
+        """
+        if not self.policy.breaker.allow():
+            raise common.Error('Source {name} is temporarily unavailable',
+                               name=self.name, code=503)
+
+        self._check_fork()
+        self._check_idle()
         kwargs.setdefault('raise_exc', True)
         if url != '/' and not microversion:
             try:
@@ -40,19 +255,113 @@ class Ironic(object):
             else:
                 if mversion is not None:
                     microversion = '%s.%s' % mversion
+
+        if self.accept_encoding:
+            # Responses are decoded by requests, raw
+            # responses are returned in the requested encoding.
+            kwargs['headers'] = dict({'Accept-Encoding': self.accept_encoding},
+                                     **(kwargs.get('headers') or {}))
+
+        category = 'list' if url in _LIST_URLS else method
+        timeout = self.policy.timeout(category, kwargs.get('timeout'))
+        if timeout:
+            kwargs['timeout'] = timeout
+
+        if method == 'GET':
+            attempts = self.policy.retries + 1
+            # Do not hedge streaming requests, the losing
+            # response would keep its connection.
+            hedge_delay = (None if kwargs.get('stream')
+                           else self.policy.hedge_delay(category))
+        else:
+            attempts = 1
+            hedge_delay = None
+
+        prio = admission.priority(method, category)
+        project = admission.current_project()
+
         LOG.debug('%s %s (API version %s) %s', method, url, microversion,
                   kwargs.get('params', {}))
-        return self._adapter.request(url, method, microversion=microversion,
-                                     **kwargs)
+        for attempt in range(attempts):
+            self.scheduler.acquire(prio, project)
+            start = time.time()
+            try:
+                with tracing.span('%s %s' % (method, self.name),
+                                  url=url, attempt=attempt):
+                    trace_headers = tracing.headers()
+                    if trace_headers:
+                        kwargs['headers'] = dict(kwargs.get('headers') or {},
+                                                 **trace_headers)
+                    if hedge_delay is not None:
+                        resp = self._send_hedged(url, microversion, kwargs,
+                                                 hedge_delay)
+                    else:
+                        resp = self._send(url, method, microversion, kwargs)
+            except Exception as exc:
+                status = getattr(exc, 'http_status', None)
+                BACKEND_ERRORS.inc(source=self.name,
+                                   status=status or type(exc).__name__)
+                if resilience.is_retriable(exc):
+                    self.policy.breaker.failure()
+                elif isinstance(exc, ks_exc.HttpError):
+                    # The source is alive, it's the request that is wrong
+                    self.policy.breaker.success()
+                    raise
+                else:
+                    self.policy.breaker.failure()
+                    raise
+
+                if attempt + 1 >= attempts:
+                    raise
+                LOG.debug('%s %s failed (attempt %d of %d): %s',
+                          method, url, attempt + 1, attempts, exc)
+            else:
+                elapsed = time.time() - start
+                BACKEND_DURATION.observe(elapsed, source=self.name,
+                                         category=category)
+                self.policy.latency[category].add(elapsed)
+                if resp.status_code in resilience.RETRIABLE_CODES:
+                    # Only possible with raise_exc=False, the response is
+                    # returned as it is, but the source is not healthy.
+                    BACKEND_ERRORS.inc(source=self.name,
+                                       status=resp.status_code)
+                    self.policy.breaker.failure()
+                else:
+                    self.policy.breaker.success()
+                return resp
+            finally:
+                self.scheduler.release(time.time() - start)
+
+            # Do not occupy the source while backing off
+            self.policy.backoff(attempt)
+
+    def get_microversions(self, ttl=0, cached=True, **kwargs):
+        """Get the supported microversions.
 
-    def get_microversions(self):
-        """Get the supported microversions."""
-        data = self._adapter.get_endpoint_data()
+        Reads the root document of the API, the result is not cached by
+        keystoneauth.
 
-        if data.min_microversion and data.max_microversion:
-            return data.min_microversion, data.max_microversion
+        :param ttl: time to keep the result in the shared store (if any).
+        :param cached: whether to use the result from the shared store.
+        """
+        key = 'versions:%s' % self.name
+        if self._store is not None and ttl and cached:
+            value = self._store.get(key)
+            if value:
+                minv, maxv = json.loads(value)
+                return tuple(minv), tuple(maxv)
+
+        data = self.request('/', 'GET', **kwargs).json()
+        version = data.get('default_version') or {}
+        if version.get('min_version') and version.get('version'):
+            result = (_parse_version(version['min_version']),
+                      _parse_version(version['version']))
         else:
-            return (1, 1), (1, 1)
+            result = (1, 1), (1, 1)
+
+        if self._store is not None and ttl:
+            self._store.set(key, json.dumps(result), time=ttl)
+        return result
 
     def create_node(self, node):
         """Create a node."""
@@ -60,15 +369,84 @@ class Ironic(object):
 
     def get_node(self, node_id, microversion=None):
         """Get a bare metal node."""
-        url = '/v1/nodes/%s' % urlparse.quote(node_id, safe='')
-        return self.request(url, 'GET', microversion=microversion).json()
+        return self.get_resource('/v1/nodes', node_id,
+                                 microversion=microversion)
 
-    def list_nodes(self, params=None, microversion=None):
-        """List bare metal nodes."""
+    def get_resource(self, path, ident, microversion=None, timeout=None):
+        """Get a resource from the collection at the given path."""
+        url = '%s/%s' % (path, urlparse.quote(ident, safe=''))
+        return self.request(url, 'GET', microversion=microversion,
+                            timeout=timeout).json()
+
+    @staticmethod
+    def _nodes_url(params):
         params = dict(params or {})
-        if params.pop('detail', False):
+        # Ironic does not accept fields with detail, and the
+        # explicitly requested fields are all that is needed anyway.
+        if params.pop('detail', False) and not params.get('fields'):
             url = '/v1/nodes/detail'
         else:
             url = '/v1/nodes'
+        return url, params
+
+    @staticmethod
+    def _iter_items(resp, key):
+        try:
+            if ijson is None:
+                for item in resp.json().get(key, []):
+                    yield item
+            else:
+                resp.raw.decode_content = True
+                for item in ijson.items(resp.raw, '%s.item' % key,
+                                        use_float=True):
+                    yield item
+        finally:
+            resp.close()
+
+    def list_nodes(self, params=None, microversion=None, **kwargs):
+        """List bare metal nodes."""
+        url, params = self._nodes_url(params)
+        return self.list_resources(url, 'nodes', params,
+                                   microversion=microversion, **kwargs)
+
+    def iter_nodes(self, params=None, microversion=None, **kwargs):
+        """List bare metal nodes, parsing the response incrementally."""
+        url, params = self._nodes_url(params)
+        return self.iter_resources(url, 'nodes', params,
+                                   microversion=microversion, **kwargs)
+
+    def list_resources(self, url, key, params=None, microversion=None,
+                       **kwargs):
+        """List resources, key is the name of the collection."""
         return self.request(url, 'GET', params=params,
-                            microversion=microversion).json().get('nodes', [])
+                            microversion=microversion,
+                            **kwargs).json().get(key, [])
+
+    def iter_resources(self, url, key, params=None, microversion=None,
+                       **kwargs):
+        """List resources, parsing the response incrementally.
+
+        The request is issued immediately, the response body is parsed as
+        the returned iterator is consumed. Requires ijson, otherwise the
+        whole body is parsed at once.
+        """
+        # Logging the response would read the whole body
+        resp = self.request(url, 'GET', params=params,
+                            microversion=microversion, stream=True,
+                            log=False, **kwargs)
+        return self._iter_items(resp, key)
+
+    def list_all_nodes(self, params=None, microversion=None, **kwargs):
+        """List all bare metal nodes, following pagination.
+
+        The uuid field must be present in the results.
+        """
+        params = dict(params or {}, limit=0)
+        while True:
+            nodes = self.list_nodes(params, microversion=microversion,
+                                    **kwargs)
+            if not nodes:
+                break
+            for node in nodes:
+                yield node
+            params['marker'] = nodes[-1]['uuid']
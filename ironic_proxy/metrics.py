@@ -0,0 +1,173 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Simple metrics in the Prometheus text format.
+
+Metrics are collected per process.
+"""
+
+import contextlib
+import threading
+import time
+
+from oslo_log import log
+
+
+LOG = log.getLogger(__name__)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+_REGISTRY = []
+_COLLECTORS = []
+
+
+def _escape(value):
+    return (str(value).replace('\\', r'\\').replace('\n', r'\n')
+            .replace('"', r'\"'))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield self.name, key, (), value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for name, key, extra, value in self._samples():
+            lines.append('%s%s %s' % (name,
+                                      _format_labels(self.labels, key, extra),
+                                      _format_value(value)))
+        return lines
+
+
+class Counter(_Metric):
+    """A monotonically increasing counter."""
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that can go up and down."""
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """A histogram of observed values."""
+
+    type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            try:
+                counts, total = self._values[key]
+            except KeyError:
+                counts, total = [0] * len(self.buckets), 0
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the time spent in the context."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((key, (list(counts), total))
+                           for key, (counts, total) in self._values.items())
+        for key, (counts, total) in items:
+            for bound, count in zip(self.buckets, counts):
+                yield (self.name + '_bucket', key,
+                       (('le', _format_value(bound)),), count)
+            yield self.name + '_count', key, (), counts[-1]
+            yield self.name + '_sum', key, (), total
+
+
+def on_collect(func):
+    """Register a function to call before rendering the metrics.
+
+    Can be used to update gauges that are expensive to keep current.
+    """
+    _COLLECTORS.append(func)
+    return func
+
+
+def render():
+    """Render all metrics in the Prometheus text format."""
+    for func in _COLLECTORS:
+        try:
+            func()
+        except Exception:
+            LOG.exception('Failed to collect metrics with %s', func.__name__)
+
+    lines = []
+    for metric in _REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,151 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Pagination of listings merged from several groups."""
+
+import base64
+import heapq
+import json
+
+from oslo_log import log
+
+from ironic_proxy import common
+
+
+LOG = log.getLogger(__name__)
+DEFAULT_SORT_KEY = 'uuid'
+SORT_DIRS = ('asc', 'desc')
+
+
+def parse_limit(limit, max_limit):
+    """Parse and validate the limit parameter."""
+    if limit is None or limit == '':
+        return None
+
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise common.Error('Invalid limit {limit}', limit=limit)
+
+    if limit < 0:
+        raise common.Error('Limit must be positive, got {limit}', limit=limit)
+    elif limit == 0 or limit > max_limit:
+        limit = max_limit
+    return limit
+
+
+def encode_marker(positions):
+    """Encode per-group positions into an opaque marker."""
+    data = json.dumps(positions, sort_keys=True).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_marker(marker):
+    """Decode an opaque marker into per-group positions.
+
+    :returns: dictionary or None if the marker was not encoded by
+        encode_marker (e.g. it is a UUID as used by ironic).
+    """
+    if not marker:
+        return {}
+
+    try:
+        positions = json.loads(
+            base64.urlsafe_b64decode(marker.encode('ascii')).decode('utf-8'))
+    except Exception:
+        LOG.debug('Marker %s is not an encoded marker', marker)
+        return None
+
+    if not isinstance(positions, dict):
+        return None
+    return positions
+
+
+def required_fields(params, sort_key):
+    """Extend the requested fields with ones required for merging.
+
+    Returns a tuple (fields, extra) where fields is the new value of the
+    fields parameter (or None) and extra is a set of fields to remove from
+    the nodes before returning them.
+    """
+    fields = params.get('fields')
+    if not fields:
+        return None, set()
+
+    fields = [f.strip() for f in fields.split(',') if f.strip()]
+    extra = {f for f in ('uuid', sort_key) if f not in fields}
+    return ','.join(fields + sorted(extra)), extra
+
+
+def position(group, node, sort_key):
+    """Get the position of a node of the group in merged listings."""
+    value = node.get(sort_key)
+    # None cannot be compared to other values on Python 3
+    return (value is not None, value, group)
+
+
+def precedes(first, second, sort_dir='asc'):
+    """Whether the first position comes before the second one."""
+    if sort_dir == 'desc':
+        return first > second
+    return first < second
+
+
+class _Descending(object):
+    """Position wrapper that reverses the order."""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def iter_merged(listings, sort_key, sort_dir='asc'):
+    """Lazily merge sorted listings from several groups.
+
+    Only one item of every listing is kept in memory.
+
+    :param listings: list of tuples (group, nodes), every nodes iterable
+        must be already sorted by sort_key in sort_dir, with None values
+        coming first in ascending order.
+    :returns: iterator over tuples (group, node).
+    """
+    def _decorate(group, nodes):
+        for node in nodes:
+            key = position(group, node, sort_key)
+            if sort_dir == 'desc':
+                key = _Descending(key)
+            # Positions include the group, so nodes are never compared
+            yield key, (group, node)
+
+    streams = [_decorate(group, nodes) for group, nodes in listings]
+    for _key, item in heapq.merge(*streams):
+        yield item
+
+
+def merge(listings, limit, sort_key, sort_dir='asc'):
+    """Merge sorted listings from several groups.
+
+    :param listings: list of tuples (group, nodes), every nodes list must be
+        already sorted by sort_key in sort_dir.
+    :returns: list of tuples (group, node), at most limit items.
+    """
+    items = [(group, node) for group, nodes in listings for node in nodes]
+    # Timsort detects the pre-sorted runs, making this effectively a merge.
+    # Unlike iter_merged, it also copes with sources placing None values
+    # differently (e.g. PostgreSQL sorts them last).
+    items.sort(key=lambda item: position(item[0], item[1], sort_key),
+               reverse=(sort_dir == 'desc'))
+    return items[:limit]
@@ -0,0 +1,165 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Latency tracking, timeouts, retries and circuit breaking for sources."""
+
+import collections
+import random
+import threading
+import time
+
+from keystoneauth1 import exceptions as ks_exc
+
+
+# HTTP codes that mean the source (or a proxy in front of it) is unhealthy
+RETRIABLE_CODES = (502, 503, 504)
+# Minimum number of samples to calculate percentiles
+MIN_SAMPLES = 20
+
+
+def is_retriable(exc):
+    """Whether the exception signals an unhealthy source."""
+    if isinstance(exc, ks_exc.ConnectionError):
+        return True
+    return getattr(exc, 'http_status', None) in RETRIABLE_CODES
+
+
+class LatencyTracker(object):
+    """Keeps a window of recent latencies."""
+
+    def __init__(self, size=200):
+        self._samples = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, latency):
+        with self._lock:
+            self._samples.append(latency)
+
+    def percentile(self, percent):
+        """Get the percentile or None if there are not enough samples."""
+        with self._lock:
+            if len(self._samples) < MIN_SAMPLES:
+                return None
+            samples = sorted(self._samples)
+        index = min(len(samples) - 1, int(len(samples) * percent / 100.0))
+        return samples[index]
+
+
+class CircuitBreaker(object):
+    """Stops requests to a source after several failures in a row.
+
+    After reset_timeout seconds one request is let through, the breaker is
+    closed again if it succeeds.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def is_available(self):
+        """Whether the breaker is closed or can be tried again."""
+        opened_at = self._opened_at
+        if opened_at is None:
+            return True
+        return time.time() - opened_at >= self.reset_timeout
+
+    def allow(self):
+        """Whether a request can be made."""
+        if not self.threshold:
+            return True
+
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.time() - self._opened_at >= self.reset_timeout:
+                # Half-open: let one request through
+                self._opened_at = time.time()
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.threshold and self._failures >= self.threshold:
+                self._opened_at = time.time()
+
+
+class Policy(object):
+    """Resilience policy of one source."""
+
+    def __init__(self, retries=0, retry_delay=0.5, min_timeout=None,
+                 max_timeout=None, timeout_percentile=99,
+                 timeout_multiplier=3.0, hedge_endpoint=None,
+                 hedge_percentile=95, failure_threshold=0,
+                 reset_timeout=30):
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_percentile = timeout_percentile
+        self.timeout_multiplier = timeout_multiplier
+        self.hedge_endpoint = hedge_endpoint
+        self.hedge_percentile = hedge_percentile
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.latency = collections.defaultdict(LatencyTracker)
+
+    @classmethod
+    def from_options(cls, options):
+        """Create a policy from a configuration group."""
+        return cls(retries=options.retries,
+                   retry_delay=options.retry_delay,
+                   min_timeout=options.min_timeout,
+                   max_timeout=options.max_timeout,
+                   timeout_percentile=options.timeout_percentile,
+                   timeout_multiplier=options.timeout_multiplier,
+                   hedge_endpoint=options.hedge_endpoint,
+                   hedge_percentile=options.hedge_percentile,
+                   failure_threshold=options.failure_threshold,
+                   reset_timeout=options.reset_timeout)
+
+    def timeout(self, category, requested=None):
+        """Calculate the timeout for a request.
+
+        Uses the observed latency percentile of the category, but never
+        exceeds the requested timeout or goes out of the configured bounds.
+        """
+        timeout = self.max_timeout
+        observed = self.latency[category].percentile(self.timeout_percentile)
+        if observed is not None:
+            timeout = observed * self.timeout_multiplier
+            if self.min_timeout:
+                timeout = max(timeout, self.min_timeout)
+            if self.max_timeout:
+                timeout = min(timeout, self.max_timeout)
+
+        if requested and timeout:
+            return min(requested, timeout)
+        return requested or timeout or None
+
+    def hedge_delay(self, category):
+        """Delay before issuing a hedged request or None to not hedge."""
+        if not self.hedge_endpoint:
+            return None
+        return self.latency[category].percentile(self.hedge_percentile)
+
+    def backoff(self, attempt):
+        """Sleep before a retry using exponential backoff with jitter."""
+        delay = self.retry_delay * (2 ** attempt)
+        time.sleep(random.uniform(0, delay))
@@ -0,0 +1,100 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Resources federated in addition to nodes."""
+
+import collections
+
+from ironic_proxy import cache
+
+
+# Marks filters that reference a node
+NODE = 'node'
+
+
+class Resource(object):
+    """A resource type served by the sources.
+
+    :param name: name of the collection in responses.
+    :param path: URL path of the collection.
+    :param title: human-readable name for error messages.
+    :param keys: fields identifying a resource, remembered in the location
+        cache.
+    :param filters: dictionary mapping query parameters to either NODE or
+        the name of another resource. Listings filtered by them only query
+        the group of this node or resource (if it is known).
+    :param node_fields: fields of a new resource that reference its node.
+    :param candidates_field: field of a new resource with a list of nodes
+        it may end up on, used when no node is referenced.
+    :param detail_path: whether detailed listings are served at
+        ``<path>/detail`` (otherwise with the ``detail`` parameter).
+    :param broadcast: whether the resource is global and must exist in all
+        groups. Such resources are created, updated and deleted in all
+        sources and listed from one of them.
+    """
+
+    def __init__(self, name, path, title, keys=('uuid',), filters=None,
+                 node_fields=(), candidates_field=None, detail_path=False,
+                 broadcast=False):
+        self.name = name
+        self.path = path
+        self.title = title
+        self.keys = keys
+        self.filters = filters or {}
+        self.node_fields = node_fields
+        self.candidates_field = candidates_field
+        self.detail_path = detail_path
+        self.broadcast = broadcast
+
+    def key(self, ident):
+        """Get the location cache key of a resource identifier."""
+        return '%s%s:%s' % (cache.RESOURCE_PREFIX, self.name, ident)
+
+    def index_keys(self, item):
+        """Get the location cache keys of a resource."""
+        return [self.key(item[field]) for field in self.keys
+                if item.get(field)]
+
+    def node_of(self, item):
+        """Get the node a new resource references or None."""
+        for field in self.node_fields:
+            value = item.get(field)
+            if value:
+                return value
+
+    def candidates_of(self, item):
+        """Get the list of candidate nodes of a new resource."""
+        if self.candidates_field:
+            return item.get(self.candidates_field) or []
+        return []
+
+
+ALL = collections.OrderedDict((resource.path, resource) for resource in [
+    Resource('ports', '/v1/ports', 'Port', keys=('uuid', 'address'),
+             filters={'node': NODE, 'node_uuid': NODE, 'address': 'ports',
+                      'portgroup': 'portgroups'},
+             node_fields=('node_uuid',), detail_path=True),
+    Resource('portgroups', '/v1/portgroups', 'Port group',
+             keys=('uuid', 'name', 'address'),
+             filters={'node': NODE, 'address': 'portgroups'},
+             node_fields=('node_uuid',), detail_path=True),
+    Resource('allocations', '/v1/allocations', 'Allocation',
+             keys=('uuid', 'name'), filters={'node': NODE},
+             node_fields=('node',), candidates_field='candidate_nodes'),
+    Resource('connectors', '/v1/volume/connectors', 'Volume connector',
+             filters={'node': NODE}, node_fields=('node_uuid',)),
+    Resource('targets', '/v1/volume/targets', 'Volume target',
+             filters={'node': NODE}, node_fields=('node_uuid',)),
+    Resource('deploy_templates', '/v1/deploy_templates', 'Deploy template',
+             keys=('uuid', 'name'), broadcast=True),
+])
+BY_NAME = {resource.name: resource for resource in ALL.values()}
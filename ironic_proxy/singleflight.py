@@ -0,0 +1,84 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Coalescing of concurrent identical calls."""
+
+import copy
+import threading
+
+from ironic_proxy import metrics
+
+
+COALESCED_CALLS = metrics.Counter(
+    'ironic_proxy_coalesced_calls_total',
+    'Calls that waited for an identical call in progress instead of '
+    'issuing their own', labels=('operation',))
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """Makes concurrent calls with the same key share one execution.
+
+    The first caller runs the function, the others wait for it and receive
+    a copy of its result (or the same exception).
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """Call func(*args, **kwargs) unless a call with the key is running.
+
+        :param key: hashable key, must include everything that affects
+            the result.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            COALESCED_CALLS.inc(operation=self.operation)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            # The result may be modified by the callers, so every waiter gets
+            # its own copy of the pristine result.
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        # No new waiters can join after the key is removed
+        if call.waiters:
+            return copy.deepcopy(call.result)
+        return call.result
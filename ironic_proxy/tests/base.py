@@ -10,8 +10,154 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import io
+
+from keystoneauth1 import exceptions as ks_exc
+import mock
+from oslo_config import fixture as config_fixture
 from oslotest import base
+import requests
+from requests import structures
+
+from ironic_proxy import api
+from ironic_proxy.bench import fake
+from ironic_proxy import conf
+from ironic_proxy import feed
+from ironic_proxy import groups
+from ironic_proxy import ironic
 
 
 class TestCase(base.BaseTestCase):
     """Test case base class for all unit tests."""
+
+    def setUp(self):
+        super(TestCase, self).setUp()
+        self.config = self.useFixture(config_fixture.Config(conf.CONF))
+
+
+class _Session(object):
+
+    def __init__(self):
+        self.adapters = {}
+
+
+class ChunkedBody(object):
+    """Raw response body returned in small chunks, records reads."""
+
+    def __init__(self, data, chunk_size=16):
+        self._stream = io.BytesIO(data)
+        self.chunk_size = chunk_size
+        self.length = len(data)
+
+    @property
+    def position(self):
+        return self._stream.tell()
+
+    def read(self, size=-1, **kwargs):
+        if size is None or size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+        return self._stream.read(size)
+
+    def close(self):
+        pass
+
+
+def streamed(resp, chunk_size=16):
+    """Make the response body only available from a chunked raw stream."""
+    resp.raw = ChunkedBody(resp._content, chunk_size)
+    resp._content = False
+    resp._content_consumed = False
+    return resp
+
+
+class FakeAdapter(object):
+    """A keystoneauth adapter sending requests to a fake source in-process.
+
+    :param source: bench.fake.FakeIronic instance.
+    """
+
+    service_type = 'baremetal'
+    auth = None
+
+    def __init__(self, source):
+        self.source = source
+        self.requests = []
+        self.session = _Session()
+        self.session.session = _Session()
+        self._client = source.app.test_client()
+
+    def request(self, url, method, microversion=None, raise_exc=True,
+                params=None, json=None, data=None, headers=None,
+                stream=False, timeout=None, log=True,
+                endpoint_override=None):
+        headers = dict(headers or {})
+        if microversion:
+            if isinstance(microversion, tuple):
+                microversion = '%d.%d' % microversion
+            headers[ironic.VERSION_HEADER] = microversion
+        if data is not None and not isinstance(data, bytes):
+            data = (data.read() if hasattr(data, 'read')
+                    else b''.join(data))
+        self.requests.append((method, url, dict(params or {})))
+
+        result = self._client.open(url, method=method,
+                                   query_string=dict(params or {}),
+                                   json=json, data=data, headers=headers)
+        resp = requests.Response()
+        resp.status_code = result.status_code
+        resp.headers = structures.CaseInsensitiveDict(result.headers)
+        resp._content = result.get_data()
+        resp.raw = io.BytesIO(resp._content)
+        resp.url = url
+        if raise_exc and resp.status_code >= 400:
+            raise ks_exc.from_response(resp, method, url)
+        return resp
+
+
+class ProxyTestCase(TestCase):
+    """Test case with the proxy configured to use fake sources in-process.
+
+    Every group is served by its own source.
+    """
+
+    # Mapping of groups to the number of nodes in them
+    GROUPS = {'': 10, 'g1': 10}
+
+    def setUp(self):
+        super(ProxyTestCase, self).setUp()
+        self.config.config(auth_strategy='none', group='api')
+        self.config.config(sync_interval=0, purge_interval=0, group='cache')
+        self.config.config(microversion_refresh_interval=0,
+                           groups={group or '_': 'fake-%s' % group
+                                   for group in self.GROUPS})
+        self.sources = {}
+        self.adapters = {}
+        clients = {}
+        for index, (group, count) in enumerate(sorted(self.GROUPS.items())):
+            self.sources[group] = fake.FakeIronic(group, count, seed=index)
+            self.adapters[group] = FakeAdapter(self.sources[group])
+            clients[group] = ironic.Ironic(self.adapters[group],
+                                           name='fake-%s' % group)
+
+        for module, name, value in [(conf, '_GROUPS', clients),
+                                    (conf, '_STORE', None),
+                                    (groups, '_CACHE', None),
+                                    (groups, '_MVERSIONS', None),
+                                    (api, '_RESPONSES', None),
+                                    (feed, '_FEED', None)]:
+            patcher = mock.patch.object(module, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.client = api.app.test_client()
+
+    def reset_requests(self):
+        for adapter in self.adapters.values():
+            del adapter.requests[:]
+
+    def requests_to(self, group):
+        """Get (method, url, params) of requests made to the group."""
+        return self.adapters[group].requests
+
+    def node(self, group, index=0):
+        return self.sources[group].nodes[index]
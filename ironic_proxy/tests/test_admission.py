@@ -0,0 +1,154 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import threading
+import time
+
+import mock
+
+from ironic_proxy import admission
+from ironic_proxy import conf
+from ironic_proxy import groups
+from ironic_proxy.tests import base
+
+
+def _wait_for(predicate, timeout=5):
+    for _i in range(int(timeout * 100)):
+        if predicate():
+            return
+        time.sleep(0.01)
+    raise AssertionError('Timed out waiting')
+
+
+class TestScheduler(base.TestCase):
+
+    def setUp(self):
+        super(TestScheduler, self).setUp()
+        self.scheduler = admission.Scheduler('test', concurrency=1)
+        self.admitted = []
+        self.rejected = []
+        self.threads = []
+
+    def _acquire(self, prio, project):
+        try:
+            self.scheduler.acquire(prio, project)
+        except admission.Overloaded as exc:
+            self.rejected.append(exc)
+        else:
+            self.admitted.append(project)
+
+    def _enqueue(self, prio, project):
+        def _handled():
+            return self.scheduler._waiting + len(self.rejected)
+
+        expected = _handled() + 1
+        thread = threading.Thread(target=self._acquire, args=(prio, project))
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+        _wait_for(lambda: _handled() >= expected)
+
+    def _release_all(self):
+        for count in range(len(self.admitted) + 1,
+                           len(self.threads) - len(self.rejected) + 1):
+            self.scheduler.release()
+            _wait_for(lambda: len(self.admitted) >= count)
+        for thread in self.threads:
+            thread.join(5)
+
+    def test_disabled(self):
+        scheduler = admission.Scheduler('test')
+        for _i in range(100):
+            scheduler.acquire('read', 'p1')
+
+    def test_fair_between_projects(self):
+        self.scheduler.acquire('read', 'p1')
+        for project in ('p1', 'p1', 'p1', 'p2'):
+            self._enqueue('read', project)
+        self._release_all()
+        self.assertEqual(['p1', 'p2', 'p1', 'p1'], self.admitted)
+
+    def test_weights(self):
+        self.scheduler.weights = {'p2': 2}
+        self.scheduler.acquire('read', 'p1')
+        for project in ('p1', 'p1', 'p2', 'p2', 'p2'):
+            self._enqueue('read', project)
+        self._release_all()
+        self.assertEqual(['p1', 'p2', 'p2', 'p1', 'p2'], self.admitted)
+
+    def test_priorities(self):
+        self.scheduler.acquire('list', 'p1')
+        self._enqueue('list', 'lister')
+        self._enqueue('read', 'reader')
+        self._enqueue('write', 'writer')
+        self._release_all()
+        self.assertEqual(['writer', 'reader', 'lister'], self.admitted)
+
+    def test_queue_full(self):
+        self.scheduler.max_queued = 1
+        self.scheduler.acquire('read', 'p1')
+        self._enqueue('read', 'p1')
+        self._enqueue('read', 'p2')
+        self.assertEqual(1, len(self.rejected))
+        self.assertEqual(503, self.rejected[0].code)
+        self.assertGreaterEqual(self.rejected[0].retry_after, 1)
+        self._release_all()
+        self.assertEqual(['p1'], self.admitted)
+
+    def test_project_limit(self):
+        self.scheduler.max_queued_per_project = 1
+        self.scheduler.acquire('read', 'p1')
+        self._enqueue('read', 'p1')
+        self._enqueue('read', 'p1')
+        self._enqueue('read', 'p2')
+        self.assertEqual([429], [exc.code for exc in self.rejected])
+        self._release_all()
+        self.assertEqual(['p1', 'p2'], self.admitted)
+
+    def test_timeout(self):
+        self.scheduler.queue_timeout = 0.05
+        self.scheduler.acquire('read', 'p1')
+        exc = self.assertRaises(admission.Overloaded,
+                                self.scheduler.acquire, 'read', 'p2')
+        self.assertEqual(503, exc.code)
+        self.assertEqual(0, self.scheduler._waiting)
+        # The slot is not passed to the cancelled request
+        self.scheduler.release()
+        self.scheduler.acquire('read', 'p3')
+
+
+class TestStreamedListing(base.ProxyTestCase):
+
+    def setUp(self):
+        super(TestStreamedListing, self).setUp()
+        groups.refresh_microversions()
+
+    def test_overloaded(self):
+        exc = admission.Overloaded('Source is overloaded', code=429,
+                                   retry_after=5)
+        with mock.patch.object(conf.groups()['g1'].scheduler, 'acquire',
+                               autospec=True, side_effect=exc):
+            resp = self.client.get('/v1/nodes')
+        self.assertEqual(429, resp.status_code)
+        self.assertEqual('5', resp.headers['Retry-After'])
+
+    def test_project(self):
+        projects = []
+        scheduler = conf.groups()['g1'].scheduler
+        with mock.patch.object(scheduler, 'acquire', autospec=True,
+                               side_effect=lambda prio, project:
+                               projects.append(project)):
+            resp = self.client.get('/v1/nodes',
+                                   headers={'X-Project-Id': 'p1'})
+            self.assertEqual(20, len(resp.get_json()['nodes']))
+        self.assertIn('p1', projects)
+        self.assertNotIn('', projects)
@@ -0,0 +1,387 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from multiprocessing import pool
+import threading
+
+from keystoneauth1 import exceptions as ks_exc
+import mock
+
+from ironic_proxy import api
+from ironic_proxy import conf
+from ironic_proxy import groups
+from ironic_proxy.tests import base
+
+
+class TestResponseCaching(base.ProxyTestCase):
+
+    def setUp(self):
+        super(TestResponseCaching, self).setUp()
+        self.config.config(response_cache_ttl=60, group='api')
+        self.name = self.node('g1')['name']
+
+    def test_etag(self):
+        resp = self.client.get('/v1/nodes/%s' % self.name)
+        self.assertEqual(200, resp.status_code)
+        etag = resp.headers['ETag']
+
+        resp = self.client.get('/v1/nodes/%s' % self.name,
+                               headers={'If-None-Match': etag})
+        self.assertEqual(304, resp.status_code)
+        self.assertEqual(b'', resp.get_data())
+
+    def test_cached(self):
+        first = self.client.get('/v1/nodes/%s' % self.name)
+        self.reset_requests()
+        second = self.client.get('/v1/nodes/%s' % self.name)
+        self.assertEqual(first.get_json(), second.get_json())
+        self.assertEqual([], self.requests_to('g1'))
+
+    def test_cache_key_includes_project(self):
+        self.client.get('/v1/nodes/%s' % self.name)
+        self.reset_requests()
+        self.client.get('/v1/nodes/%s' % self.name,
+                        headers={'X-Project-Id': 'other'})
+        self.assertEqual(1, len(self.requests_to('g1')))
+
+    def test_invalidated_on_update(self):
+        self.client.get('/v1/nodes/%s' % self.name)
+        resp = self.client.patch('/v1/nodes/%s' % self.name,
+                                 json=[{'op': 'add', 'path': '/owner',
+                                        'value': 'me'}])
+        self.assertEqual(200, resp.status_code)
+
+        resp = self.client.get('/v1/nodes/%s' % self.name)
+        self.assertEqual('me', resp.get_json()['owner'])
+
+    def test_disabled(self):
+        self.config.config(response_cache_ttl=0, group='api')
+        self.client.get('/v1/nodes/%s' % self.name)
+        self.reset_requests()
+        self.client.get('/v1/nodes/%s' % self.name)
+        self.assertEqual(1, len(self.requests_to('g1')))
+
+
+class TestBatch(base.ProxyTestCase):
+
+    def _batch(self, operations, status=200):
+        resp = self.client.post('/proxy/v1/nodes/batch',
+                                json={'operations': operations})
+        self.assertEqual(status, resp.status_code, resp.get_data())
+        body = resp.get_json(force=True)
+        if status != 200:
+            return body
+        return sorted(body['results'], key=lambda result: result['index'])
+
+    def test_operations(self):
+        results = self._batch([
+            {'node': self.node('g1')['name'], 'method': 'get'},
+            {'node': self.node('', 1)['uuid'], 'method': 'PATCH',
+             'body': [{'op': 'add', 'path': '/description',
+                       'value': 'test'}]},
+            {'node': self.node('g1', 2)['uuid'], 'method': 'PUT',
+             'path': 'states/provision', 'body': {'target': 'manage'}},
+            {'node': 'nope', 'method': 'GET'},
+        ])
+        self.assertEqual([0, 1, 2, 3], [r['index'] for r in results])
+        self.assertEqual([200, 200, 202, 404], [r['status'] for r in results])
+        self.assertEqual(self.node('g1')['uuid'], results[0]['body']['uuid'])
+        self.assertEqual('test', results[1]['body']['description'])
+        self.assertNotIn('body', results[2])
+        self.assertIn('error', results[3])
+
+    def test_invalid(self):
+        self._batch([{'node': 'node', 'method': 'HEAD'}], status=400)
+        self._batch([{'method': 'GET'}], status=400)
+        self.config.config(max_batch_size=1, group='api')
+        self._batch([{'node': 'n1', 'method': 'GET'},
+                     {'node': 'n2', 'method': 'GET'}], status=400)
+
+    def test_invalid_path(self):
+        node = self.node('g1')['uuid']
+        for path in ('../../ports', 'states/../../../v1/ports', '..',
+                     './states', '%2e%2e/ports', '..%2Fports', '/v1/ports',
+                     'http://example.com/v1/ports', 'states?node=x',
+                     'states#x', '..\\ports', ['states']):
+            body = self._batch([{'node': node, 'method': 'GET',
+                                 'path': path}], status=400)
+            self.assertIn('invalid path',
+                          body['error_message']['faultstring'])
+        self.assertEqual([], [url for _method, url, _params
+                              in self.requests_to('g1') if url != '/'])
+
+    def test_node_named_batch(self):
+        target = self.node('g1')
+        target['name'] = 'batch'
+        self.sources['g1']._by_id['batch'] = target
+        resp = self.client.get('/v1/nodes/batch')
+        self.assertEqual(200, resp.status_code, resp.get_data())
+        self.assertEqual(target['uuid'], resp.get_json()['uuid'])
+
+        resp = self.client.post('/v1/nodes/batch',
+                                json={'operations': []})
+        self.assertEqual(405, resp.status_code)
+
+    def test_stale_location(self):
+        # A single worker: looking up nodes in the pool would deadlock
+        workers = pool.ThreadPool(1)
+        self.addCleanup(workers.terminate)
+        self.addCleanup(groups.set_pool, groups._get_pool(),
+                        groups._get_batch_pool())
+        groups.set_pool(workers)
+
+        node = self.node('g1')
+        groups._get_cache().add(node, '')
+        results = self._batch([{'node': node['uuid'], 'method': 'GET'}])
+        self.assertEqual(200, results[0]['status'])
+        self.assertEqual(node['uuid'], results[0]['body']['uuid'])
+        self.assertEqual('g1', groups._get_cache().get(node['uuid']))
+
+    def test_concurrent_listing(self):
+        # Batch operations must not take the workers listings need
+        self.config.config(fan_out_timeout=5)
+        workers = pool.ThreadPool(1)
+        self.addCleanup(workers.terminate)
+        self.addCleanup(groups.set_pool, groups._get_pool(),
+                        groups._get_batch_pool())
+        groups.set_pool(workers, pool.ThreadPool(4))
+
+        started = threading.Event()
+        release = threading.Event()
+        self.addCleanup(release.set)
+        real_batch_item = groups._batch_item
+
+        def _slow(op, group, microversion):
+            started.set()
+            release.wait(10)
+            return real_batch_item(op, group, microversion)
+
+        operations = [{'node': self.node(group, idx)['uuid'], 'method': 'GET'}
+                      for group in ('', 'g1') for idx in range(3)]
+        for group in ('', 'g1'):
+            for idx in range(3):
+                groups._get_cache().add(self.node(group, idx), group)
+
+        with mock.patch.object(groups, '_batch_item', autospec=True,
+                               side_effect=_slow):
+            results = groups.batch(operations, 2)
+            first = threading.Thread(target=list, args=(results,))
+            first.start()
+            self.addCleanup(first.join)
+            self.assertTrue(started.wait(10))
+
+            resp = self.client.get('/v1/nodes')
+            self.assertEqual(200, resp.status_code)
+            self.assertEqual(20, len(resp.get_json()['nodes']))
+            release.set()
+
+
+class TestPassthrough(base.ProxyTestCase):
+
+    def setUp(self):
+        super(TestPassthrough, self).setUp()
+        self.target = self.node('g1')
+        self.url = '/v1/nodes/%s' % self.target['uuid']
+        self.patch = [{'op': 'add', 'path': '/description', 'value': 'test'}]
+
+    def _methods(self, group):
+        return [(method, url) for method, url, _params
+                in self.requests_to(group) if url != '/']
+
+    def test_cached_location(self):
+        groups._get_cache().add(self.target, 'g1')
+        resp = self.client.patch(self.url, json=self.patch)
+        self.assertEqual(200, resp.status_code, resp.get_data())
+        self.assertEqual('test', resp.get_json()['description'])
+        # Sent directly without fetching the node first
+        self.assertEqual([('PATCH', self.url)], self._methods('g1'))
+        self.assertEqual([], self._methods(''))
+
+    def test_unknown_location(self):
+        resp = self.client.put(self.url + '/states/provision',
+                               json={'target': 'manage'})
+        self.assertEqual(202, resp.status_code, resp.get_data())
+        self.assertEqual([('GET', self.url),
+                          ('PUT', self.url + '/states/provision')],
+                         self._methods('g1'))
+
+    def test_stale_location(self):
+        groups._get_cache().add(self.target, '')
+        resp = self.client.patch(self.url, json=self.patch)
+        self.assertEqual(200, resp.status_code, resp.get_data())
+        self.assertEqual('test', self.target['description'])
+        self.assertEqual([('PATCH', self.url), ('GET', self.url)],
+                         self._methods(''))
+        self.assertEqual([('GET', self.url), ('PATCH', self.url)],
+                         self._methods('g1'))
+        self.assertEqual('g1', groups._get_cache().get(self.target['uuid']))
+
+    def test_not_found(self):
+        resp = self.client.patch('/v1/nodes/nope', json=self.patch)
+        self.assertEqual(404, resp.status_code)
+
+    def test_invalidated_after_update(self):
+        self.config.config(response_cache_ttl=60, group='api')
+        self.assertNotIn('description', self.client.get(self.url).get_json())
+
+        def _check(node_id):
+            # The source is already updated
+            self.assertEqual('test', self.target.get('description'))
+            real_invalidate(node_id)
+
+        real_invalidate = api._invalidate
+        with mock.patch.object(api, '_invalidate', autospec=True,
+                               side_effect=_check) as mock_invalidate:
+            resp = self.client.patch(self.url, json=self.patch)
+        self.assertEqual(200, resp.status_code)
+        mock_invalidate.assert_called_once_with(self.target['uuid'])
+        self.assertEqual('test',
+                         self.client.get(self.url).get_json()['description'])
+
+
+class TestResources(base.ProxyTestCase):
+
+    def test_port(self):
+        port = self.sources['g1'].ports[0]
+        resp = self.client.get('/v1/ports/%s' % port['uuid'])
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(port['address'], resp.get_json()['address'])
+
+    def test_ports_of_node(self):
+        node = self.node('g1')
+        resp = self.client.get('/v1/ports?fields=uuid,node_uuid&node=%s'
+                               % node['name'])
+        self.assertEqual(200, resp.status_code, resp.get_data())
+        self.assertEqual([node['uuid']],
+                         [port['node_uuid']
+                          for port in resp.get_json()['ports']])
+        self.assertEqual([], [url for _method, url, _params
+                              in self.requests_to('')
+                              if url.startswith('/v1/ports')])
+
+    def test_allocation_candidates_in_several_groups(self):
+        candidates = [self.node('', 0)['uuid'], self.node('g1', 0)['uuid'],
+                      self.node('g1', 1)['name']]
+        resp = self.client.post('/v1/allocations',
+                                json={'resource_class': 'baremetal',
+                                      'candidate_nodes': candidates})
+        self.assertEqual(201, resp.status_code, resp.get_data())
+        self.assertEqual([], self.sources[''].allocations)
+        allocations = self.sources['g1'].allocations
+        self.assertEqual(1, len(allocations))
+        self.assertEqual(candidates[1:], allocations[0]['candidate_nodes'])
+
+    def test_allocation_unknown_candidate(self):
+        resp = self.client.post('/v1/allocations',
+                                json={'candidate_nodes': ['nope']})
+        self.assertEqual(400, resp.status_code)
+
+    def test_deploy_templates(self):
+        resp = self.client.post('/v1/deploy_templates',
+                                json={'name': 'CUSTOM_RAID', 'steps': []})
+        self.assertEqual(201, resp.status_code, resp.get_data())
+        template_uuid = resp.get_json()['uuid']
+        for source in self.sources.values():
+            self.assertEqual([template_uuid],
+                             [t['uuid'] for t in source.deploy_templates])
+
+        resp = self.client.get('/v1/deploy_templates')
+        self.assertEqual(200, resp.status_code, resp.get_data())
+        self.assertEqual([template_uuid],
+                         [t['uuid'] for t
+                          in resp.get_json()['deploy_templates']])
+
+        resp = self.client.patch(
+            '/v1/deploy_templates/CUSTOM_RAID',
+            json=[{'op': 'add', 'path': '/extra', 'value': {'a': 1}}])
+        self.assertEqual(200, resp.status_code, resp.get_data())
+        for source in self.sources.values():
+            self.assertEqual({'a': 1}, source.deploy_templates[0]['extra'])
+
+        resp = self.client.delete('/v1/deploy_templates/%s' % template_uuid)
+        self.assertEqual(204, resp.status_code, resp.get_data())
+        for source in self.sources.values():
+            self.assertEqual([], source.deploy_templates)
+
+    def test_deploy_template_rolled_back(self):
+        self.sources['g1'].deploy_templates.append(
+            {'uuid': 'other', 'name': 'CUSTOM_RAID'})
+        resp = self.client.post('/v1/deploy_templates',
+                                json={'name': 'CUSTOM_RAID', 'steps': []})
+        self.assertEqual(409, resp.status_code)
+        self.assertEqual([], self.sources[''].deploy_templates)
+
+
+class TestNoDefaultGroup(base.ProxyTestCase):
+
+    GROUPS = {'g1': 2}
+
+    def test_create_without_node(self):
+        resp = self.client.post('/v1/volume/connectors',
+                                json={'type': 'iqn', 'connector_id': 'id'})
+        self.assertEqual(400, resp.status_code)
+        self.assertIn('No conductors in group <default>',
+                      resp.get_json()['error_message']['faultstring'])
+
+
+class TestReadiness(base.ProxyTestCase):
+
+    def _ready(self, status):
+        resp = self.client.get('/ready')
+        self.assertEqual(status, resp.status_code, resp.get_data())
+        return resp.get_json()
+
+    def _fail(self, group):
+        self.adapters[group].request = mock.Mock(
+            side_effect=ks_exc.ConnectFailure())
+
+    def test_not_warmed_up(self):
+        body = self._ready(503)
+        self.assertFalse(body['ready'])
+        self.assertEqual({'': {'available': True}, 'g1': {'available': True}},
+                         body['groups'])
+
+    def test_warmed_up(self):
+        groups.warm_up()
+        self.assertTrue(self._ready(200)['ready'])
+
+    def test_warm_up_partly_failed(self):
+        self._fail('')
+        groups.warm_up()
+        self.assertTrue(self._ready(200)['ready'])
+        self.assertIsNotNone(groups._MVERSIONS)
+
+    def test_warm_up_failed(self):
+        self._fail('')
+        self._fail('g1')
+        groups.warm_up()
+        self.assertFalse(self._ready(503)['ready'])
+
+    def test_all_groups_down(self):
+        groups.warm_up()
+        for cli in conf.groups().values():
+            cli.policy.breaker.threshold = 1
+            cli.policy.breaker.failure()
+        body = self._ready(503)
+        self.assertEqual({'': {'available': False},
+                          'g1': {'available': False}}, body['groups'])
+
+    @mock.patch.object(conf, 'load_config', autospec=True)
+    @mock.patch.object(groups, 'warm_up', autospec=True)
+    def test_init(self, mock_warm_up, mock_load):
+        threads = []
+        mock_warm_up.side_effect = (
+            lambda: threads.append(threading.current_thread().name))
+        api.init(['ironic-proxy'])
+        self.assertTrue(mock_load.called)
+        # Finished before init returns, in a separate thread
+        self.assertEqual(['ironic-proxy-warm-up'], threads)
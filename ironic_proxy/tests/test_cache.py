@@ -0,0 +1,405 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import sqlite3
+import stat
+import time
+
+import fixtures
+import mock
+import six
+
+from ironic_proxy import cache
+from ironic_proxy import conf
+from ironic_proxy import groups
+from ironic_proxy.tests import base
+
+
+def _node(index, instance=False):
+    return {'uuid': 'uuid-%d' % index, 'name': 'node-%d' % index,
+            'instance_uuid': 'inst-%d' % index if instance else None}
+
+
+class TestLocationCache(base.TestCase):
+
+    def setUp(self):
+        super(TestLocationCache, self).setUp()
+        self.cache = cache.LocationCache(max_size=6)
+
+    def test_add_get(self):
+        self.cache.add(_node(1, instance=True), 'g1')
+        self.assertEqual('g1', self.cache.get('uuid-1'))
+        self.assertEqual('g1', self.cache.get('node-1'))
+        instance_key = cache.INSTANCE_PREFIX + 'inst-1'
+        self.assertEqual('g1', self.cache.get(instance_key))
+        self.assertRaises(KeyError, self.cache.get, 'uuid-2')
+        self.assertEqual(3, len(self.cache))
+
+    def test_remove(self):
+        self.cache.add(_node(1), 'g1')
+        self.cache.remove('uuid-1')
+        self.assertRaises(KeyError, self.cache.get, 'uuid-1')
+        self.assertEqual('g1', self.cache.get('node-1'))
+        self.cache.remove('uuid-1')
+
+    def test_eviction(self):
+        for index in range(3):
+            self.cache.add(_node(index), 'g1')
+        # Mark node 0 as recently used
+        self.cache.get('uuid-0')
+        self.cache.add(_node(3), 'g2')
+
+        self.assertEqual(6, len(self.cache))
+        self.assertEqual('g1', self.cache.get('uuid-0'))
+        self.assertEqual('g2', self.cache.get('uuid-3'))
+        # The least recently used entries are gone
+        self.assertRaises(KeyError, self.cache.get, 'node-0')
+        self.assertRaises(KeyError, self.cache.get, 'uuid-1')
+
+    def test_ttl(self):
+        self.cache.ttl = 10
+        self.cache.add(_node(1), 'g1')
+        now = time.time()
+        with mock.patch.object(time, 'time', return_value=now + 5):
+            self.assertEqual('g1', self.cache.get('uuid-1'))
+        with mock.patch.object(time, 'time', return_value=now + 11):
+            self.assertRaises(KeyError, self.cache.get, 'uuid-1')
+            self.assertEqual([], [key for key, _grp, _exp
+                                  in self.cache.items()
+                                  if key == 'node-1'])
+
+    def test_reconcile(self):
+        self.cache.max_size = None
+        self.cache.add(_node(1), 'g1')
+        self.cache.add(_node(2), 'g1')
+        self.cache.add(_node(3), 'g2')
+        self.cache.add_keys([cache.RESOURCE_PREFIX + 'ports:p1'], 'g1')
+
+        removed = self.cache.reconcile('g1', [_node(2), _node(4)])
+
+        self.assertEqual(2, removed)
+        self.assertRaises(KeyError, self.cache.get, 'uuid-1')
+        self.assertEqual('g1', self.cache.get('uuid-2'))
+        self.assertEqual('g1', self.cache.get('node-4'))
+        self.assertEqual('g2', self.cache.get('uuid-3'))
+        # Resources are not affected by node listings
+        self.assertEqual('g1',
+                         self.cache.get(cache.RESOURCE_PREFIX + 'ports:p1'))
+
+    def test_reconcile_moved_node(self):
+        self.cache.add(_node(1), 'g1')
+        self.cache.reconcile('g2', [_node(1)])
+        self.assertEqual('g2', self.cache.get('uuid-1'))
+        self.assertEqual(0, self.cache.reconcile('g1', []))
+
+    def test_save_load(self):
+        self.cache.add(_node(1, instance=True), 'g1')
+        self.cache.add(_node(2), '')
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'snapshot.db')
+        self.cache.save(path)
+        self.cache.save(path)
+
+        other = cache.LocationCache()
+        other.load(path)
+        self.assertEqual(sorted(self.cache.items()), sorted(other.items()))
+        self.assertEqual('', other.get('node-2'))
+
+    def test_save_replaces(self):
+        self.cache.add(_node(1), 'g1')
+        tmp_dir = self.useFixture(fixtures.TempDir()).path
+        path = os.path.join(tmp_dir, 'snapshot.db')
+        self.cache.save(path)
+
+        with mock.patch.object(os, 'rename', autospec=True,
+                               side_effect=os.rename) as mock_rename:
+            self.cache.save(path)
+        mock_rename.assert_called_once_with(mock.ANY, path)
+        self.assertEqual(tmp_dir,
+                         os.path.dirname(mock_rename.call_args[0][0]))
+        self.assertEqual(['snapshot.db'], os.listdir(tmp_dir))
+
+    def test_save_failure(self):
+        self.cache.add(_node(1), 'g1')
+        tmp_dir = self.useFixture(fixtures.TempDir()).path
+        path = os.path.join(tmp_dir, 'snapshot.db')
+        self.cache.save(path)
+
+        self.cache.add(_node(2), 'g1')
+        with mock.patch.object(os, 'rename', autospec=True,
+                               side_effect=OSError('boom')):
+            self.assertRaises(OSError, self.cache.save, path)
+        # The previous snapshot is intact and no temporary files are left
+        self.assertEqual(['snapshot.db'], os.listdir(tmp_dir))
+        other = cache.LocationCache()
+        other.load(path)
+        self.assertEqual('g1', other.get('uuid-1'))
+        self.assertRaises(KeyError, other.get, 'uuid-2')
+
+
+class _SharedLocationCacheTests(object):
+
+    def test_add_get(self):
+        self.cache.add(_node(1, instance=True), 'g1')
+        self.cache.add(_node(2), '')
+        self.assertEqual('g1', self.cache.get('uuid-1'))
+        self.assertEqual('g1', self.cache.get('node-1'))
+        self.assertEqual('g1',
+                         self.cache.get(cache.INSTANCE_PREFIX + 'inst-1'))
+        self.assertEqual('', self.cache.get('node-2'))
+        self.assertRaises(KeyError, self.cache.get, 'uuid-3')
+
+    def test_shared(self):
+        self.cache.add(_node(1), 'g1')
+        self.assertEqual('g1', self.other.get('uuid-1'))
+        self.other.remove('uuid-1')
+        self.assertRaises(KeyError, self.cache.get, 'uuid-1')
+
+    def test_reconcile_moved_node(self):
+        self.cache.add(_node(1), 'g1')
+        self.cache.reconcile('g2', [_node(1)])
+        self.assertEqual('g2', self.other.get('uuid-1'))
+
+
+class TestSQLiteLocationCache(_SharedLocationCacheTests, base.TestCase):
+
+    def setUp(self):
+        super(TestSQLiteLocationCache, self).setUp()
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'shared.db')
+        self.cache = cache.SQLiteLocationCache(path, ttl=10)
+        self.other = cache.SQLiteLocationCache(path, ttl=10)
+
+    def test_private(self):
+        self.assertEqual(0o600,
+                         stat.S_IMODE(os.stat(self.cache.path).st_mode))
+        # The same file can be used by the store
+        cache.SQLiteStore(self.cache.path)
+
+    def test_ttl(self):
+        self.cache.add(_node(1), 'g1')
+        self.assertEqual(2, len(self.other))
+        with mock.patch.object(time, 'time', return_value=time.time() + 11):
+            self.assertRaises(KeyError, self.other.get, 'uuid-1')
+            self.assertEqual(0, len(self.other))
+            self.assertEqual([], self.other.items())
+
+    def test_reconcile(self):
+        self.cache.add(_node(1), 'g1')
+        self.cache.add(_node(2), 'g1')
+        self.cache.add(_node(3), 'g2')
+        self.cache.add_keys([cache.RESOURCE_PREFIX + 'ports:p1'], 'g1')
+
+        self.assertEqual(2, self.other.reconcile('g1', [_node(2)]))
+        self.assertRaises(KeyError, self.cache.get, 'uuid-1')
+        self.assertEqual('g1', self.cache.get('uuid-2'))
+        self.assertEqual('g2', self.cache.get('uuid-3'))
+        self.assertEqual('g1',
+                         self.cache.get(cache.RESOURCE_PREFIX + 'ports:p1'))
+
+
+class TestStoreLocationCache(_SharedLocationCacheTests, base.TestCase):
+
+    def setUp(self):
+        super(TestStoreLocationCache, self).setUp()
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'shared.db')
+        self.cache = cache.StoreLocationCache(cache.SQLiteStore(path))
+        self.other = cache.StoreLocationCache(cache.SQLiteStore(path))
+
+    def test_ttl(self):
+        self.cache.ttl = 10
+        self.cache.add(_node(1), 'g1')
+        with mock.patch.object(cache, '_now', return_value=time.time() + 11):
+            self.assertRaises(KeyError, self.other.get, 'uuid-1')
+
+    def test_long_keys(self):
+        key = cache.INSTANCE_PREFIX + 'x y' * 200
+        self.cache.add_keys([key], 'g1')
+        self.assertEqual('g1', self.other.get(key))
+
+
+class TestSharedBackend(base.ProxyTestCase):
+
+    def setUp(self):
+        super(TestSharedBackend, self).setUp()
+        self.config.config(
+            shared_backend='sqlite',
+            shared_path=os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                     'shared.db'),
+            group='cache')
+
+    def test_location_shared(self):
+        resp = self.client.get('/v1/nodes/%s' % self.node('g1')['name'])
+        self.assertEqual(200, resp.status_code)
+        self.assertIsInstance(groups._CACHE, cache.SQLiteLocationCache)
+
+        # Another process sees the location without polling
+        with mock.patch.object(groups, '_CACHE', None):
+            self.reset_requests()
+            resp = self.client.get('/v1/nodes/%s' % self.node('g1')['name'])
+            self.assertEqual(200, resp.status_code)
+            self.assertEqual([], self.requests_to(''))
+
+    def test_sync_once(self):
+        groups.sync_index()
+        self.assertEqual('g1',
+                         groups._get_cache().get(self.node('g1')['uuid']))
+        self.reset_requests()
+        groups.sync_index()
+        self.assertEqual([], self.requests_to('g1'))
+        groups.sync_index(force=True)
+        self.assertNotEqual([], self.requests_to('g1'))
+
+    def _count(self, table):
+        conn = sqlite3.connect(conf.CONF.cache.shared_path)
+        self.addCleanup(conn.close)
+        return conn.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+
+    def test_purge_expired(self):
+        store = conf.shared_store()
+        store.set('token', b'value', time=10)
+        store.set('forever', b'value')
+        locations = groups._get_cache()
+        locations.ttl = 10
+        locations.add(self.node('g1'), 'g1')
+        self.assertEqual(2, self._count('store'))
+        self.assertNotEqual(0, self._count('locations'))
+
+        future = time.time() + 11
+        with mock.patch.object(cache, '_now', return_value=future):
+            with mock.patch.object(time, 'time', return_value=future):
+                groups.purge_expired()
+        self.assertEqual(1, self._count('store'))
+        self.assertEqual(0, self._count('locations'))
+        self.assertEqual(b'value', store.get('forever'))
+
+    @mock.patch.object(groups, 'start_periodic', autospec=True)
+    def test_purge_scheduled(self, mock_periodic):
+        self.config.config(purge_interval=42, group='cache')
+        groups._get_cache()
+        mock_periodic.assert_any_call(groups.purge_expired, 42, delay=42)
+
+
+class TestSnapshot(base.ProxyTestCase):
+
+    def setUp(self):
+        super(TestSnapshot, self).setUp()
+        self.path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'snapshot.db')
+        self.config.config(snapshot_path=self.path, snapshot_interval=42,
+                           group='cache')
+
+    @mock.patch.object(groups, 'start_periodic', autospec=True)
+    @mock.patch('atexit.register', autospec=True)
+    def test_saved_periodically(self, mock_atexit, mock_periodic):
+        groups._get_cache()
+        mock_atexit.assert_called_once_with(groups._save_cache)
+        mock_periodic.assert_any_call(groups._save_cache, 42, delay=42)
+
+    @mock.patch.object(groups, 'start_periodic', autospec=True)
+    @mock.patch('atexit.register', autospec=True)
+    def test_not_saved_in_requests(self, mock_atexit, mock_periodic):
+        with mock.patch.object(cache.LocationCache, 'save',
+                               autospec=True) as mock_save:
+            resp = self.client.get('/v1/nodes/%s' % self.node('g1')['name'])
+            self.assertEqual(200, resp.status_code)
+            mock_save.assert_not_called()
+
+            groups._save_cache()
+            mock_save.assert_called_once_with(mock.ANY, self.path)
+
+    @mock.patch.object(groups, 'start_periodic', autospec=True)
+    @mock.patch('atexit.register', autospec=True)
+    def test_loaded_on_start_up(self, mock_atexit, mock_periodic):
+        saved = cache.LocationCache()
+        saved.add(self.node('g1'), 'g1')
+        saved.save(self.path)
+
+        locations = groups._get_cache()
+        self.assertEqual('g1', locations.get(self.node('g1')['uuid']))
+
+
+class TestResponseCache(base.TestCase):
+
+    def setUp(self):
+        super(TestResponseCache, self).setUp()
+        self.cache = cache.ResponseCache(max_size=2, ttl=10)
+
+    def test_set_get(self):
+        self.assertIsNone(self.cache.get('key'))
+        self.cache.set('key', 'value', {'tag'})
+        self.assertEqual('value', self.cache.get('key'))
+
+    def test_expired(self):
+        self.cache.set('key', 'value')
+        with mock.patch.object(time, 'time', return_value=time.time() + 11):
+            self.assertIsNone(self.cache.get('key'))
+
+    def test_max_size(self):
+        for key in ('key1', 'key2', 'key3'):
+            self.cache.set(key, key)
+        self.assertIsNone(self.cache.get('key1'))
+        self.assertEqual('key3', self.cache.get('key3'))
+
+    def test_invalidate(self):
+        self.cache.set('key1', 'value1', {'node1', 'list'})
+        self.cache.set('key2', 'value2', {'node2'})
+        self.cache.invalidate({'node1'})
+        self.assertIsNone(self.cache.get('key1'))
+        self.assertEqual('value2', self.cache.get('key2'))
+
+
+class TestSQLiteStore(base.TestCase):
+
+    def setUp(self):
+        super(TestSQLiteStore, self).setUp()
+        self.path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'shared.db')
+        self.store = cache.SQLiteStore(self.path)
+
+    def test_private(self):
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(self.path).st_mode))
+        # Can be opened again
+        cache.SQLiteStore(self.path).set('key', b'value')
+        self.assertEqual(b'value', self.store.get('key'))
+
+    def test_accessible_by_others(self):
+        os.chmod(self.path, 0o644)
+        six.assertRaisesRegex(self, RuntimeError,
+                              'accessible by other users',
+                              cache.SQLiteStore, self.path)
+
+    def test_set_get_delete(self):
+        self.assertIsNone(self.store.get('key'))
+        self.assertTrue(self.store.set('key', b'value'))
+        self.assertEqual(b'value', self.store.get('key'))
+        self.store.delete('key')
+        self.assertIsNone(self.store.get('key'))
+
+    def test_add(self):
+        self.assertTrue(self.store.add('key', b'value', time=10))
+        self.assertFalse(self.store.add('key', b'other'))
+        self.assertEqual(b'value', self.store.get('key'))
+        with mock.patch.object(cache, '_now', return_value=time.time() + 11):
+            self.assertTrue(self.store.add('key', b'other'))
+        self.assertEqual(b'other', self.store.get('key'))
+
+    def test_expiration(self):
+        self.store.set('key', b'value', time=10)
+        self.store.set('forever', b'value')
+        with mock.patch.object(cache, '_now', return_value=time.time() + 11):
+            self.assertIsNone(self.store.get('key'))
+            self.store.purge()
+        self.assertIsNone(self.store.get('key'))
+        self.assertEqual(b'value', self.store.get('forever'))
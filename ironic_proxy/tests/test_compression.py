@@ -0,0 +1,191 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import unittest
+import zlib
+
+import mock
+from werkzeug import datastructures
+from werkzeug import http
+
+from ironic_proxy import compression
+from ironic_proxy import groups
+from ironic_proxy.tests import base
+
+
+def _gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def _accept(value):
+    return http.parse_accept_header(value, datastructures.Accept)
+
+
+class TestNegotiate(base.TestCase):
+
+    def test_preference(self):
+        self.assertEqual('gzip', compression.negotiate(
+            _accept('gzip, deflate'), ['zstd', 'gzip']))
+        self.assertIsNone(compression.negotiate(
+            _accept('identity'), ['zstd', 'gzip']))
+        self.assertIsNone(compression.negotiate(
+            _accept('gzip;q=0'), ['gzip']))
+        self.assertIsNone(compression.negotiate(_accept(''), ['gzip']))
+
+    def test_not_allowed(self):
+        self.assertIsNone(compression.negotiate(_accept('gzip'), []))
+        self.assertIsNone(compression.negotiate(_accept('br'), ['br']))
+
+    @unittest.skipUnless(compression.zstandard, 'zstandard is not installed')
+    def test_zstd(self):
+        self.assertEqual('zstd', compression.negotiate(
+            _accept('gzip, zstd'), ['zstd', 'gzip']))
+        self.assertEqual('gzip', compression.negotiate(
+            _accept('gzip, zstd;q=0.5'), ['zstd', 'gzip']))
+
+    @mock.patch.object(compression, 'zstandard', None)
+    def test_zstd_missing(self):
+        self.assertEqual(['gzip'], compression.available())
+        self.assertEqual('gzip', compression.negotiate(
+            _accept('gzip, zstd'), ['zstd', 'gzip']))
+        self.assertIsNone(compression.negotiate(_accept('zstd'), ['zstd']))
+
+
+class TestCompress(base.TestCase):
+
+    data = b'{"nodes": []}' * 100
+
+    def test_gzip(self):
+        compressed = compression.compress('gzip', 6, self.data)
+        self.assertLess(len(compressed), len(self.data))
+        self.assertEqual(self.data, _gunzip(compressed))
+
+    def test_stream(self):
+        chunks = list(compression.compress_stream(
+            'gzip', 1, ['{"nodes": [', b'{}', ']}']))
+        self.assertEqual(b'{"nodes": [{}]}',
+                         _gunzip(b''.join(chunks)))
+
+    def test_stream_flush_every_chunk(self):
+        chunks = list(compression.compress_stream(
+            'gzip', 6, [b'event: 1\n\n', b'event: 2\n\n'],
+            flush_every_chunk=True))
+        # Every input chunk produces output, plus the trailer
+        self.assertEqual(3, len(chunks))
+        self.assertEqual(b'event: 1\n\nevent: 2\n\n',
+                         _gunzip(b''.join(chunks)))
+
+    @unittest.skipUnless(compression.zstandard, 'zstandard is not installed')
+    def test_zstd(self):
+        compressed = compression.compress('zstd', 3, self.data)
+        self.assertEqual(self.data, compression.zstandard.ZstdDecompressor()
+                         .decompressobj().decompress(compressed))
+
+
+class TestCompressedResponses(base.ProxyTestCase):
+
+    def setUp(self):
+        super(TestCompressedResponses, self).setUp()
+        self.config.config(encodings=['gzip'], min_size=0,
+                           group='compression')
+        self.url = '/v1/nodes/%s' % self.node('g1')['uuid']
+
+    def _get(self, url, encoding='gzip', **headers):
+        headers['Accept-Encoding'] = encoding
+        return self.client.get(url, headers=headers)
+
+    def test_gzip(self):
+        resp = self._get(self.url)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('gzip', resp.headers['Content-Encoding'])
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        body = json.loads(_gunzip(resp.get_data()).decode('utf-8'))
+        self.assertEqual(self.node('g1')['uuid'], body['uuid'])
+
+    def test_streamed_listing(self):
+        resp = self._get('/v1/nodes')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('gzip', resp.headers['Content-Encoding'])
+        body = json.loads(_gunzip(resp.get_data()).decode('utf-8'))
+        self.assertEqual(20, len(body['nodes']))
+
+    def test_identity(self):
+        for encoding in ('identity', 'gzip;q=0', ''):
+            resp = self._get(self.url, encoding)
+            self.assertEqual(200, resp.status_code)
+            self.assertNotIn('Content-Encoding', resp.headers)
+            self.assertEqual(self.node('g1')['uuid'],
+                             resp.get_json()['uuid'])
+
+    def test_min_size(self):
+        self.config.config(min_size=1 << 20, group='compression')
+        resp = self._get(self.url)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+
+    def test_disabled(self):
+        self.config.config(encodings=[], group='compression')
+        self.assertNotIn('Content-Encoding', self._get(self.url).headers)
+        self.config.config(encodings=['gzip'], level=0, group='compression')
+        self.assertNotIn('Content-Encoding', self._get(self.url).headers)
+
+    def test_route_level(self):
+        self.config.config(route_levels={'node': '0'}, group='compression')
+        self.assertNotIn('Content-Encoding', self._get(self.url).headers)
+        resp = self._get('/v1/nodes')
+        self.assertEqual('gzip', resp.headers['Content-Encoding'])
+        resp.get_data()
+
+    def test_not_modified(self):
+        self.config.config(response_cache_ttl=60, group='api')
+        resp = self._get(self.url)
+        etag = resp.headers['ETag']
+        # The compressed body is a different representation
+        self.assertTrue(etag.startswith('W/'))
+
+        resp = self._get(self.url, **{'If-None-Match': etag})
+        self.assertEqual(304, resp.status_code)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(b'', resp.get_data())
+
+    def test_head(self):
+        resp = self.client.head(self.url, headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    @mock.patch.object(groups, 'proxy_raw', autospec=True)
+    def test_passthrough_not_recompressed(self, mock_proxy):
+        self.config.config(raw_passthrough=True, group='api')
+        body = compression.compress('gzip', 6, b'{}')
+        mock_proxy.return_value = mock.Mock(
+            status_code=200, raw=mock.Mock(read=mock.Mock(
+                side_effect=[body, b''])),
+            headers={'Content-Encoding': 'gzip',
+                     'Content-Type': 'application/json'})
+        resp = self.client.patch(self.url, json=[],
+                                 headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('gzip', resp.headers['Content-Encoding'])
+        self.assertEqual(body, resp.get_data())
+        self.assertEqual(
+            'gzip', mock_proxy.call_args[1]['headers']['Accept-Encoding'])
+
+    @mock.patch.object(groups, 'proxy_raw', autospec=True)
+    def test_passthrough_identity(self, mock_proxy):
+        self.config.config(raw_passthrough=True, group='api')
+        mock_proxy.return_value = mock.Mock(
+            status_code=204, raw=mock.Mock(read=mock.Mock(return_value=b'')),
+            headers={})
+        resp = self.client.delete(self.url)
+        self.assertEqual(204, resp.status_code)
+        self.assertEqual(
+            'identity', mock_proxy.call_args[1]['headers']['Accept-Encoding'])
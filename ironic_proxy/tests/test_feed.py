@@ -0,0 +1,210 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import threading
+import time
+
+import fixtures
+import mock
+
+from ironic_proxy import cache
+from ironic_proxy import common
+from ironic_proxy import feed
+from ironic_proxy.tests import base
+
+
+def _node(uuid, state='available', updated_at=None):
+    return {'uuid': uuid, 'provision_state': state,
+            'created_at': '2020-01-01T00:00:00', 'updated_at': updated_at}
+
+
+class TestApply(base.TestCase):
+
+    def setUp(self):
+        super(TestApply, self).setUp()
+        self.feed = feed.Feed(['provision_state'], 10)
+        self.feed.apply('g1', [_node('a'), _node('b')], complete=True)
+
+    def test_baseline(self):
+        self.assertEqual('%s-0' % self.feed._log.epoch, self.feed.cursor())
+        self.assertEqual(0, self.feed.apply('g2', [_node('c')]))
+        # Not a baseline since the listing is incomplete
+        self.assertEqual(0, self.feed.apply('g2', [_node('c')]))
+
+    def test_events(self):
+        cursor = self.feed.cursor()
+        nodes = [_node('a', 'active', updated_at='2020-01-02T00:00:00'),
+                 _node('c')]
+        self.assertEqual(3, self.feed.apply('g1', nodes, complete=True))
+
+        events, new_cursor = self.feed.changes(cursor)
+        self.assertEqual(
+            [('updated', 'a', ['provision_state']),
+             ('created', 'c', None),
+             ('deleted', 'b', None)],
+            [(event['event'], event['node']['uuid'], event.get('changed'))
+             for event in events])
+        self.assertEqual({'g1'}, {event['group'] for event in events})
+        self.assertEqual(events[-1]['cursor'], new_cursor)
+        self.assertEqual(new_cursor, self.feed.cursor())
+
+    def test_only_updated_at(self):
+        cursor = self.feed.cursor()
+        node = _node('a', updated_at='2020-01-02T00:00:00')
+        self.assertEqual(0, self.feed.apply('g1', [node]))
+        self.assertEqual(([], cursor), self.feed.changes(cursor))
+
+    def test_incomplete_no_deletions(self):
+        self.assertEqual(0, self.feed.apply('g1', [_node('a')]))
+
+
+class TestChanges(base.TestCase):
+
+    def setUp(self):
+        super(TestChanges, self).setUp()
+        self.feed = feed.Feed(['provision_state'], 3)
+        self.feed.apply('', [], complete=True)
+        self.cursor = self.feed.cursor()
+
+    def _create(self, *uuids):
+        self.feed.apply('', [_node(uuid) for uuid in uuids])
+
+    def test_no_cursor(self):
+        self.assertEqual(([], self.cursor), self.feed.changes())
+
+    def test_limit(self):
+        self._create('a', 'b', 'c')
+        events, cursor = self.feed.changes(self.cursor, limit=2)
+        self.assertEqual(['a', 'b'], [e['node']['uuid'] for e in events])
+        events, cursor = self.feed.changes(cursor)
+        self.assertEqual(['c'], [e['node']['uuid'] for e in events])
+        self.assertEqual(self.feed.cursor(), cursor)
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertEqual(([], self.cursor),
+                         self.feed.changes(self.cursor, timeout=0.1))
+        self.assertGreaterEqual(time.time() - start, 0.1)
+
+    def test_wait(self):
+        timer = threading.Timer(0.1, self._create, ('a',))
+        timer.start()
+        self.addCleanup(timer.join)
+        events, _cursor = self.feed.changes(self.cursor, timeout=10)
+        self.assertEqual(['a'], [e['node']['uuid'] for e in events])
+
+    def _assert_gone(self, cursor):
+        exc = self.assertRaises(common.Error, self.feed.changes, cursor)
+        self.assertEqual(410, exc.code)
+
+    def test_expired(self):
+        self._create('a', 'b', 'c', 'd')
+        self._assert_gone(self.cursor)
+
+    def test_other_epoch(self):
+        self._assert_gone('abcdef-0')
+
+    def test_invalid(self):
+        for cursor in ('nope', '%s-x' % self.feed._log.epoch,
+                       '%s-10' % self.feed._log.epoch):
+            exc = self.assertRaises(common.Error, self.feed.changes, cursor)
+            self.assertEqual(400, exc.code)
+
+
+class TestSharedFeed(base.TestCase):
+
+    def setUp(self):
+        super(TestSharedFeed, self).setUp()
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'shared.db')
+        self.feeds = [feed.Feed(['provision_state'], 3,
+                                store=cache.SQLiteStore(path))
+                      for _i in range(2)]
+        self.mock_list = self.useFixture(fixtures.MockPatchObject(
+            feed.groups, 'list_changed_nodes', autospec=True)).mock
+        self.useFixture(fixtures.MockPatchObject(
+            feed.groups, 'microversions', autospec=True,
+            return_value=((1, 1), (1, 80))))
+
+    def _sync(self, index, *uuids):
+        self.mock_list.return_value = [
+            ('', True, [_node(uuid) for uuid in uuids])]
+        self.feeds[index].sync()
+
+    def test_one_leader(self):
+        self._sync(0)
+        self._sync(1)
+        self.mock_list.assert_called_once_with(mock.ANY, mock.ANY,
+                                               microversion='1.80')
+
+    def test_cursor_shared(self):
+        self._sync(0)
+        leader, follower = self.feeds
+        cursor = follower.cursor()
+        self.assertEqual(leader.cursor(), cursor)
+
+        self._sync(0, 'a', 'b')
+        events, new_cursor = follower.changes(cursor, timeout=10)
+        self.assertEqual([('created', 'a'), ('created', 'b')],
+                         [(e['event'], e['node']['uuid']) for e in events])
+        self.assertEqual(leader.cursor(), new_cursor)
+
+    def test_evicted(self):
+        self._sync(0)
+        cursor = self.feeds[1].cursor()
+        self._sync(0, 'a', 'b', 'c', 'd')
+        exc = self.assertRaises(common.Error, self.feeds[1].changes, cursor)
+        self.assertEqual(410, exc.code)
+
+    def test_takeover(self):
+        self._sync(0, 'a')
+        cursor = self.feeds[1].cursor()
+        self.feeds[0]._log.store.delete(feed._LEADER_KEY)
+
+        self._sync(1, 'a')
+        # A new baseline in a new epoch
+        self.assertEqual([], self.feeds[1].changes(self.feeds[1].cursor())[0])
+        exc = self.assertRaises(common.Error, self.feeds[0].changes, cursor)
+        self.assertEqual(410, exc.code)
+
+        # The old leader steps down
+        self._sync(0, 'a', 'b')
+        self.assertEqual(2, self.mock_list.call_count)
+
+
+class TestChangesApi(base.ProxyTestCase):
+
+    def test_long_poll(self):
+        changes = feed.get_feed()
+        self.addCleanup(setattr, feed, '_FEED', None)
+        changes.apply('g1', [], complete=True)
+        cursor = changes.cursor()
+        changes.apply('g1', [_node('a')])
+
+        resp = self.client.get('/proxy/v1/nodes/changes?cursor=%s' % cursor)
+        self.assertEqual(200, resp.status_code, resp.get_data())
+        body = resp.get_json()
+        self.assertEqual(['a'], [e['node']['uuid'] for e in body['changes']])
+        self.assertEqual(changes.cursor(), body['cursor'])
+
+    def test_expired(self):
+        resp = self.client.get('/proxy/v1/nodes/changes?cursor=abcdef-1')
+        self.assertEqual(410, resp.status_code)
+
+    def test_node_named_changes(self):
+        target = self.node('g1')
+        target['name'] = 'changes'
+        self.sources['g1']._by_id['changes'] = target
+        resp = self.client.get('/v1/nodes/changes')
+        self.assertEqual(200, resp.status_code, resp.get_data())
+        self.assertEqual(target['uuid'], resp.get_json()['uuid'])
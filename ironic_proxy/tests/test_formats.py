@@ -0,0 +1,105 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import unittest
+
+from werkzeug import datastructures
+
+from ironic_proxy import formats
+from ironic_proxy.tests import base
+
+
+NODES = [{'uuid': 'u1', 'name': 'n1'}, {'uuid': 'u2', 'name': None}]
+
+
+class TestFormats(base.TestCase):
+
+    def test_negotiate(self):
+        self.assertEqual(formats.JSON, formats.negotiate(
+            datastructures.MIMEAccept([])))
+        self.assertEqual(formats.JSON, formats.negotiate(
+            datastructures.MIMEAccept([('*/*', 1)])))
+        self.assertEqual(formats.COLUMNAR_JSON, formats.negotiate(
+            datastructures.MIMEAccept([(formats.COLUMNAR_JSON, 1),
+                                       (formats.JSON, 0.5)])))
+        self.assertEqual(formats.JSON, formats.negotiate(
+            datastructures.MIMEAccept([('text/html', 1)])))
+
+    def test_columns(self):
+        cols, nodes = formats.columns('name, uuid', NODES)
+        self.assertEqual(['name', 'uuid'], cols)
+        self.assertIs(NODES, nodes)
+
+        cols, nodes = formats.columns(None, iter(NODES))
+        self.assertEqual(['name', 'uuid'], cols)
+        self.assertEqual(NODES, list(nodes))
+
+        self.assertEqual(([], []), formats.columns(None, iter([])))
+
+    def test_columnar_json(self):
+        expected = {'columns': ['uuid', 'name'],
+                    'rows': [['u1', 'n1'], ['u2', None]]}
+        streamed = ''.join(formats.stream_columnar_json(NODES,
+                                                        ['uuid', 'name']))
+        self.assertEqual(expected, json.loads(streamed))
+        encoded = formats.encode(formats.COLUMNAR_JSON, NODES,
+                                 ['uuid', 'name'], next_link='http://next')
+        self.assertEqual(dict(expected, next='http://next'),
+                         json.loads(encoded))
+
+    @unittest.skipIf(formats.msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        encoded = formats.encode(formats.MSGPACK, NODES, ['uuid'])
+        self.assertEqual({'columns': ['uuid'], 'rows': [['u1'], ['u2']]},
+                         formats.msgpack.unpackb(encoded, raw=False))
+
+
+class TestListingFormats(base.ProxyTestCase):
+
+    def _get(self, url, accept):
+        resp = self.client.get(url, headers={'Accept': accept})
+        self.assertEqual(200, resp.status_code, resp.get_data())
+        self.assertEqual(accept, resp.mimetype)
+        self.assertIn('Accept', resp.vary)
+        return resp
+
+    def test_columnar_streamed(self):
+        resp = self._get('/v1/nodes?fields=uuid,name', formats.COLUMNAR_JSON)
+        body = resp.get_json(force=True)
+        self.assertEqual(['uuid', 'name'], body['columns'])
+        self.assertEqual(20, len(body['rows']))
+
+    def test_columnar_paginated(self):
+        resp = self._get('/v1/nodes?limit=5&sort_key=name&fields=name',
+                         formats.COLUMNAR_JSON)
+        body = resp.get_json(force=True)
+        self.assertEqual(['name'], body['columns'])
+        self.assertEqual(5, len(body['rows']))
+        self.assertIn('next', body)
+
+    @unittest.skipIf(formats.msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        resp = self._get('/v1/nodes?fields=uuid', formats.MSGPACK)
+        body = formats.msgpack.unpackb(resp.get_data(), raw=False)
+        self.assertEqual(['uuid'], body['columns'])
+        self.assertEqual(20, len(body['rows']))
+
+    def test_fields_pushed_down(self):
+        resp = self.client.get('/v1/nodes?detail=true&fields=uuid,name')
+        self.assertEqual(20, len(resp.get_json()['nodes']))
+        for group in self.GROUPS:
+            listings = [(url, params)
+                        for _method, url, params in self.requests_to(group)
+                        if url.startswith('/v1/nodes')]
+            self.assertEqual([('/v1/nodes', {'fields': 'uuid,name'})],
+                             listings)
@@ -0,0 +1,73 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import subprocess
+import sys
+import textwrap
+import unittest
+
+from ironic_proxy.tests import base
+
+try:
+    import eventlet
+except ImportError:
+    eventlet = None
+
+
+# Importing the green module monkey patches the process,
+# so the code runs in a separate interpreter.
+_SCRIPT = textwrap.dedent("""
+    import multiprocessing
+    import time
+
+    import eventlet
+
+    from ironic_proxy import green
+    from ironic_proxy import groups
+
+    pool = green.GreenPool()
+    groups.set_pool(pool)
+
+    def _sleep(value):
+        time.sleep(0.2)
+        return value
+
+    def _fan_out(index):
+        result = pool.apply_async(_sleep, (index,)).get(5)
+        items = sorted(groups._imap_unordered(_sleep, range(3), 5))
+        return result, items
+
+    start = time.time()
+    requests = [eventlet.spawn(_fan_out, index) for index in range(100)]
+    results = [thread.wait() for thread in requests]
+    assert results == [(index, [0, 1, 2]) for index in range(100)], results
+    # All fan-outs run concurrently instead of waiting for each other
+    elapsed = time.time() - start
+    assert elapsed < 2, elapsed
+
+    try:
+        pool.apply_async(_sleep, (0,)).get(0.01)
+    except multiprocessing.TimeoutError:
+        pass
+    else:
+        raise AssertionError('No timeout')
+    print('OK')
+""")
+
+
+@unittest.skipIf(eventlet is None, 'eventlet is not installed')
+class TestGreenPool(base.TestCase):
+
+    def test_concurrent_fan_outs(self):
+        output = subprocess.check_output([sys.executable, '-c', _SCRIPT],
+                                         stderr=subprocess.STDOUT)
+        self.assertEqual(b'OK', output.strip().splitlines()[-1])
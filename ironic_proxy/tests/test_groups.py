@@ -0,0 +1,326 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import multiprocessing
+import os
+import time
+
+from keystoneauth1 import exceptions as ks_exc
+import mock
+
+from ironic_proxy import admission
+from ironic_proxy import api
+from ironic_proxy.bench import fake
+from ironic_proxy import common
+from ironic_proxy import conf
+from ironic_proxy import groups
+from ironic_proxy.tests import base
+
+
+class TestFork(base.ProxyTestCase):
+
+    def _wait(self, pid, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                return os.WEXITSTATUS(status)
+            time.sleep(0.05)
+        os.kill(pid, 9)
+        os.waitpid(pid, 0)
+        self.fail('The child process is stuck')
+
+    def test_fan_out_after_fork(self):
+        # The pool is created before fork, e.g. by the warm-up
+        groups.warm_up()
+        self.assertIsNotNone(groups._MVERSIONS)
+
+        pid = os.fork()
+        if not pid:
+            try:
+                result = [group for group, _value in groups._fan_out(
+                    lambda group, cli: cli.list_nodes())]
+                os._exit(0 if result == ['', 'g1'] else 1)
+            except BaseException:
+                os._exit(2)
+
+        self.assertEqual(0, self._wait(pid))
+
+    def test_new_pool_in_new_process(self):
+        pool = groups._get_pool()
+        self.addCleanup(groups.set_pool, pool, groups._get_batch_pool())
+        self.assertIs(pool, groups._get_pool())
+        with mock.patch.object(os, 'getpid', return_value=-1):
+            new_pool = groups._get_pool()
+            self.assertIsNot(pool, new_pool)
+            self.assertIs(new_pool, groups._get_pool())
+
+    def test_connections_closed_in_new_process(self):
+        cli = conf.groups()['g1']
+        http = mock.Mock()
+        self.adapters['g1'].session.session.adapters = {'http://': http}
+        cli.request('/', 'GET')
+        http.close.assert_not_called()
+
+        with mock.patch.object(os, 'getpid', return_value=-1):
+            cli.request('/', 'GET')
+            cli.request('/', 'GET')
+        http.close.assert_called_once_with()
+
+
+class TestPolling(base.ProxyTestCase):
+
+    def setUp(self):
+        super(TestPolling, self).setUp()
+        self.config.config(fan_out_timeout=0.5)
+        # The default group hangs
+        adapter = self.adapters['']
+        real_request = adapter.request
+
+        def _slow(*args, **kwargs):
+            time.sleep(2)
+            return real_request(*args, **kwargs)
+
+        adapter.request = _slow
+
+    def test_found_in_responding_group(self):
+        start = time.time()
+        resp = self.client.get('/v1/nodes/%s' % self.node('g1')['uuid'])
+        self.assertEqual(200, resp.status_code)
+        self.assertLess(time.time() - start, 1.5)
+
+    def test_not_found_with_timeout(self):
+        start = time.time()
+        resp = self.client.get('/v1/nodes/nope')
+        self.assertEqual(503, resp.status_code, resp.get_data())
+        self.assertLess(time.time() - start, 1.5)
+
+    def test_listing_skips_slow_group(self):
+        start = time.time()
+        resp = self.client.get('/v1/nodes')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(
+            sorted(node['uuid'] for node in self.sources['g1'].nodes),
+            sorted(node['uuid'] for node in resp.get_json()['nodes']))
+        self.assertLess(time.time() - start, 1.5)
+
+
+class TestFanOut(base.TestCase):
+
+    def setUp(self):
+        super(TestFanOut, self).setUp()
+        self.targets = [(group, mock.Mock(available=True))
+                        for group in ('', 'a', 'b', 'c')]
+
+    def _call(self, delays, timeout=5):
+        def _func(group, cli):
+            delay = delays.get(group, 0)
+            if isinstance(delay, Exception):
+                raise delay
+            time.sleep(delay)
+            return group.upper()
+
+        return list(groups._fan_out(_func, timeout=timeout,
+                                    targets=self.targets))
+
+    def test_stable_order(self):
+        # Complete in the reverse order
+        result = self._call({'': 0.3, 'a': 0.2, 'b': 0.1})
+        self.assertEqual([('', ''), ('a', 'A'), ('b', 'B'), ('c', 'C')],
+                         result)
+
+    def test_slow_skipped(self):
+        start = time.time()
+        result = self._call({'a': 2, 'c': 0.1}, timeout=0.5)
+        self.assertEqual([('', ''), ('b', 'B'), ('c', 'C')], result)
+        self.assertLess(time.time() - start, 1.5)
+
+    def test_all_slow(self):
+        start = time.time()
+        result = self._call({'': 2, 'a': 2, 'b': 2, 'c': 2}, timeout=0.5)
+        self.assertEqual([], result)
+        # The deadline is shared by all groups
+        self.assertLess(time.time() - start, 1.5)
+
+    def test_failed_skipped(self):
+        result = self._call({'b': RuntimeError('boom')})
+        self.assertEqual([('', ''), ('a', 'A'), ('c', 'C')], result)
+
+    def test_down_skipped(self):
+        self.targets[1][1].available = False
+        self.assertEqual([('', ''), ('b', 'B'), ('c', 'C')], self._call({}))
+
+    def test_overloaded(self):
+        self.assertRaises(admission.Overloaded, self._call,
+                          {'a': admission.Overloaded('busy')})
+
+
+class TestImapUnordered(base.TestCase):
+
+    def _call(self, value):
+        time.sleep(value)
+        return value
+
+    def test_results(self):
+        self.assertEqual([0, 0.1], list(groups._imap_unordered(
+            self._call, [0.1, 0], timeout=5)))
+
+    def test_timeout(self):
+        results = groups._imap_unordered(self._call, [0, 1], timeout=0.2)
+        self.assertEqual(0, next(results))
+        self.assertRaises(multiprocessing.TimeoutError, next, results)
+
+    def test_deadline_passed(self):
+        results = groups._imap_unordered(self._call, [0, 0.5], timeout=0.1)
+        self.assertEqual(0, next(results))
+        # The caller is slow to ask for the next result
+        time.sleep(0.2)
+        self.assertRaises(multiprocessing.TimeoutError, next, results)
+
+
+class TestPlanList(base.ProxyTestCase):
+
+    def setUp(self):
+        super(TestPlanList, self).setUp()
+        self.node_with_instance = next(node for node
+                                       in self.sources['g1'].nodes
+                                       if node['instance_uuid'])
+        self.instance = self.node_with_instance['instance_uuid']
+
+    def _list(self, query):
+        self.reset_requests()
+        resp = self.client.get('/v1/nodes?%s' % query)
+        self.assertEqual(200, resp.status_code, resp.get_data())
+        return [node['uuid'] for node in resp.get_json()['nodes']]
+
+    def _listed(self, group):
+        return [url for _method, url, _params in self.requests_to(group)
+                if url == '/v1/nodes']
+
+    def test_conductor_group(self):
+        for name in ('g1', 'G1'):
+            result = self._list('conductor_group=%s' % name)
+            self.assertEqual(
+                sorted(node['uuid'] for node in self.sources['g1'].nodes),
+                sorted(result))
+            self.assertEqual([], self._listed(''))
+
+    def test_unknown_conductor_group(self):
+        self.assertEqual([], self._list('conductor_group=nope'))
+        self.assertEqual([], self._listed(''))
+        self.assertEqual([], self._listed('g1'))
+
+    def test_instance_known(self):
+        groups._get_cache().add(self.node_with_instance, 'g1')
+        self.assertEqual([self.node_with_instance['uuid']],
+                         self._list('instance_uuid=%s' % self.instance))
+        self.assertEqual([], self._listed(''))
+        self.assertEqual(['/v1/nodes'], self._listed('g1'))
+
+    def test_instance_unknown(self):
+        self.assertEqual([self.node_with_instance['uuid']],
+                         self._list('instance_uuid=%s' % self.instance))
+        self.assertEqual(['/v1/nodes'], self._listed(''))
+        self.assertEqual(['/v1/nodes'], self._listed('g1'))
+
+    def test_instance_moved(self):
+        # E.g. evacuated from a node in the default group
+        groups._get_cache().add(self.node_with_instance, '')
+        self.assertEqual([self.node_with_instance['uuid']],
+                         self._list('instance_uuid=%s' % self.instance))
+        self.assertEqual(['/v1/nodes', '/v1/nodes'], self._listed(''))
+        self.assertEqual(['/v1/nodes'], self._listed('g1'))
+        self.assertEqual('g1', groups._get_cache().get(
+            'instance:%s' % self.instance))
+
+    def test_instance_deleted(self):
+        groups._get_cache().add(self.node_with_instance, 'g1')
+        self.node_with_instance['instance_uuid'] = None
+        self.assertEqual([], self._list('instance_uuid=%s' % self.instance))
+        self.assertRaises(KeyError, groups._get_cache().get,
+                          'instance:%s' % self.instance)
+
+
+class TestListAll(base.ProxyTestCase):
+
+    def setUp(self):
+        super(TestListAll, self).setUp()
+        self.bodies = {}
+        for group, adapter in self.adapters.items():
+            adapter.request = self._streamed(group, adapter.request)
+
+    def _streamed(self, group, real_request):
+        def _request(url, *args, **kwargs):
+            resp = real_request(url, *args, **kwargs)
+            if url == '/v1/nodes':
+                resp = base.streamed(resp)
+                self.bodies[group] = resp.raw
+            return resp
+        return _request
+
+    def test_streamed(self):
+        with api.app.test_request_context('/v1/nodes'):
+            nodes = groups._list_all({}, groups._sources())
+        # Requests are sent, but the bodies are not read yet
+        self.assertEqual({'', 'g1'}, set(self.bodies))
+        for body in self.bodies.values():
+            self.assertEqual(0, body.position)
+
+        first = next(nodes)
+        self.assertLess(self.bodies[''].position, self.bodies[''].length)
+        self.assertEqual(0, self.bodies['g1'].position)
+
+        result = [first['uuid']] + [node['uuid'] for node in nodes]
+        self.assertEqual([node['uuid'] for group in ('', 'g1')
+                          for node in self.sources[group].nodes], result)
+        self.assertEqual('g1', groups._get_cache().get(
+            self.node('g1')['uuid']))
+
+    def test_api(self):
+        resp = self.client.get('/v1/nodes')
+        self.assertEqual(200, resp.status_code)
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(20, len(resp.get_json()['nodes']))
+
+
+class TestMicroversions(base.ProxyTestCase):
+
+    def _fail(self, *groups_):
+        for group in groups_:
+            patcher = mock.patch.object(
+                self.adapters[group], 'request', autospec=True,
+                side_effect=ks_exc.InternalServerError())
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_refresh(self):
+        self.assertEqual(((1, 1), (1, 58)), groups.refresh_microversions())
+        self.assertEqual(((1, 1), (1, 58)), groups._MVERSIONS)
+
+    def test_failed_group_ignored(self):
+        self._fail('g1')
+        with mock.patch.object(fake, 'MAX_VERSION', '1.50'):
+            self.assertEqual(((1, 1), (1, 50)),
+                             groups.refresh_microversions())
+
+    def test_keep_last_known(self):
+        groups.refresh_microversions()
+        self._fail('', 'g1')
+        self.assertEqual(((1, 1), (1, 58)), groups.refresh_microversions())
+        self.assertEqual(((1, 1), (1, 58)), groups._MVERSIONS)
+        self.assertEqual(((1, 1), (1, 58)), groups.microversions())
+
+    def test_never_fetched(self):
+        self._fail('', 'g1')
+        self.assertIsNone(groups.refresh_microversions())
+        exc = self.assertRaises(common.Error, groups.microversions)
+        self.assertEqual(503, exc.code)
@@ -0,0 +1,298 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+import os
+import time
+
+import fixtures
+from keystoneauth1 import access
+from keystoneauth1 import exceptions as ks_exc
+from keystoneauth1 import fixture as ks_fixture
+from keystoneauth1.identity import v3
+import mock
+from requests import adapters
+
+from ironic_proxy.bench import fake
+from ironic_proxy import cache
+from ironic_proxy import common
+from ironic_proxy import ironic
+from ironic_proxy import resilience
+from ironic_proxy.tests import base
+
+
+class TestConnectionPools(base.TestCase):
+
+    def setUp(self):
+        super(TestConnectionPools, self).setUp()
+        self.adapter = base.FakeAdapter(fake.FakeIronic(nodes=1))
+        self.http = adapters.HTTPAdapter(pool_maxsize=4)
+        self.adapter.session.session.adapters = {'http://': self.http,
+                                                 'https://': self.http}
+
+    def test_pool_stats(self):
+        self.http.poolmanager.connection_from_url('http://host:6385')
+        cli = ironic.Ironic(self.adapter, name='source')
+        self.assertEqual({'http://host:6385': {'connections': 0,
+                                               'requests': 0,
+                                               'idle': 4,
+                                               'maxsize': 4}},
+                         cli.pool_stats())
+
+    def test_idle_connections_closed(self):
+        cli = ironic.Ironic(self.adapter, idle_timeout=60, name='source')
+        now = time.time()
+        with mock.patch.object(self.http, 'close', autospec=True) as close:
+            with mock.patch.object(time, 'time', return_value=now):
+                cli.request('/', 'GET')
+                cli.request('/', 'GET')
+            close.assert_not_called()
+
+            with mock.patch.object(time, 'time', return_value=now + 61):
+                cli.request('/', 'GET')
+            close.assert_called_once_with()
+
+    def test_idle_timeout_disabled(self):
+        cli = ironic.Ironic(self.adapter, name='source')
+        with mock.patch.object(self.http, 'close', autospec=True) as close:
+            cli.request('/', 'GET')
+            with mock.patch.object(time, 'time',
+                                   return_value=time.time() + 3600):
+                cli.request('/', 'GET')
+            close.assert_not_called()
+
+
+class TestRequest(base.TestCase):
+
+    url = '/v1/nodes/node-1'
+
+    def setUp(self):
+        super(TestRequest, self).setUp()
+        self.adapter = mock.Mock(service_type='baremetal', auth=None)
+        self.policy = resilience.Policy(retries=2, retry_delay=0)
+        self.cli = ironic.Ironic(self.adapter, name='source',
+                                 policy=self.policy)
+        self.resp = mock.Mock(status_code=200)
+        backoff = mock.patch.object(self.policy, 'backoff', autospec=True)
+        self.mock_backoff = backoff.start()
+        self.addCleanup(backoff.stop)
+
+    def test_success(self):
+        self.adapter.request.return_value = self.resp
+        self.assertIs(self.resp, self.cli.request(self.url, 'GET'))
+        self.adapter.request.assert_called_once_with(
+            self.url, 'GET', microversion=None, raise_exc=True)
+        self.mock_backoff.assert_not_called()
+
+    def test_retry_unavailable(self):
+        for exc in (ks_exc.ServiceUnavailable(), ks_exc.BadGateway(),
+                    ks_exc.ConnectFailure()):
+            self.adapter.request.reset_mock()
+            self.adapter.request.side_effect = [exc, self.resp]
+            self.assertIs(self.resp, self.cli.request(self.url, 'GET'))
+            self.assertEqual(2, self.adapter.request.call_count)
+
+    def test_budget_exhausted(self):
+        self.adapter.request.side_effect = ks_exc.ServiceUnavailable()
+        self.assertRaises(ks_exc.ServiceUnavailable,
+                          self.cli.request, self.url, 'GET')
+        self.assertEqual(3, self.adapter.request.call_count)
+        self.assertEqual([mock.call(0), mock.call(1)],
+                         self.mock_backoff.call_args_list)
+
+    def test_no_retry_for_changes(self):
+        for method in ('POST', 'PATCH', 'PUT', 'DELETE'):
+            self.adapter.request.reset_mock()
+            self.adapter.request.side_effect = ks_exc.ServiceUnavailable()
+            self.assertRaises(ks_exc.ServiceUnavailable,
+                              self.cli.request, self.url, method)
+            self.adapter.request.assert_called_once_with(
+                self.url, method, microversion=None, raise_exc=True)
+        self.mock_backoff.assert_not_called()
+
+    def test_no_retry_client_error(self):
+        self.adapter.request.side_effect = ks_exc.NotFound()
+        self.assertRaises(ks_exc.NotFound, self.cli.request, self.url, 'GET')
+        self.adapter.request.assert_called_once_with(
+            self.url, 'GET', microversion=None, raise_exc=True)
+
+    def test_breaker_opens(self):
+        self.policy.breaker.threshold = 3
+        self.adapter.request.side_effect = ks_exc.ConnectFailure()
+        self.assertRaises(ks_exc.ConnectFailure,
+                          self.cli.request, self.url, 'GET')
+        self.assertFalse(self.cli.available)
+        self.adapter.request.reset_mock()
+        exc = self.assertRaises(common.Error, self.cli.request, self.url,
+                                'GET')
+        self.assertEqual(503, exc.code)
+        self.adapter.request.assert_not_called()
+
+
+class TestHedging(base.TestCase):
+
+    url = '/v1/nodes/node-1'
+
+    def setUp(self):
+        super(TestHedging, self).setUp()
+        self.adapter = mock.Mock(service_type='baremetal', auth=None)
+        self.policy = resilience.Policy(hedge_endpoint='http://hedge')
+        # The hedged request is sent after 50 ms
+        for _i in range(resilience.MIN_SAMPLES):
+            self.policy.latency['GET'].add(0.05)
+        self.cli = ironic.Ironic(self.adapter, name='source',
+                                 policy=self.policy)
+        self.primary = mock.Mock(status_code=200)
+        self.hedged = mock.Mock(status_code=200)
+
+    def _respond(self, primary_delay, hedge_delay, hedge_error=None):
+        def _request(url, method, endpoint_override=None, **kwargs):
+            if endpoint_override is None:
+                time.sleep(primary_delay)
+                return self.primary
+            self.assertEqual('http://hedge', endpoint_override)
+            time.sleep(hedge_delay)
+            if hedge_error is not None:
+                raise hedge_error
+            return self.hedged
+
+        self.adapter.request.side_effect = _request
+
+    def test_fast_not_hedged(self):
+        self._respond(0, 0)
+        self.assertIs(self.primary, self.cli.request(self.url, 'GET'))
+        self.assertEqual(1, self.adapter.request.call_count)
+
+    def test_hedge_wins(self):
+        self._respond(1, 0)
+        self.assertIs(self.hedged, self.cli.request(self.url, 'GET'))
+        self.assertEqual(2, self.adapter.request.call_count)
+
+    def test_hedge_loses(self):
+        self._respond(0.2, 1)
+        self.assertIs(self.primary, self.cli.request(self.url, 'GET'))
+        self.assertEqual(2, self.adapter.request.call_count)
+
+    def test_hedge_fails(self):
+        self._respond(0.2, 0, ks_exc.ConnectFailure())
+        self.assertIs(self.primary, self.cli.request(self.url, 'GET'))
+
+    def test_changes_not_hedged(self):
+        self._respond(0.2, 0)
+        self.assertIs(self.primary, self.cli.request(self.url, 'PATCH'))
+        self.assertEqual(1, self.adapter.request.call_count)
+
+
+class TestStreaming(base.TestCase):
+
+    def setUp(self):
+        super(TestStreaming, self).setUp()
+        self.source = fake.FakeIronic(nodes=50)
+        adapter = base.FakeAdapter(self.source)
+        self.bodies = []
+        real_request = adapter.request
+
+        def _request(*args, **kwargs):
+            resp = base.streamed(real_request(*args, **kwargs))
+            self.bodies.append(resp.raw)
+            return resp
+
+        adapter.request = _request
+        self.cli = ironic.Ironic(adapter, name='source')
+        self.expected = [node['uuid'] for node in self.source.nodes]
+
+    def test_incremental(self):
+        nodes = self.cli.iter_nodes()
+        body = self.bodies[0]
+        first = next(nodes)
+        self.assertLess(body.position, body.length)
+        self.assertEqual(self.expected,
+                         [first['uuid']] + [node['uuid'] for node in nodes])
+        self.assertEqual(body.length, body.position)
+
+    def test_resources(self):
+        ports = list(self.cli.iter_resources('/v1/ports', 'ports'))
+        self.assertEqual([port['uuid'] for port in self.source.ports],
+                         [port['uuid'] for port in ports])
+
+    @mock.patch.object(ironic, 'ijson', None)
+    def test_without_ijson(self):
+        self.assertEqual(self.expected,
+                         [node['uuid'] for node in self.cli.iter_nodes()])
+
+
+class TestAuthState(base.TestCase):
+
+    def setUp(self):
+        super(TestAuthState, self).setUp()
+        self.store = cache.SQLiteStore(os.path.join(
+            self.useFixture(fixtures.TempDir()).path, 'store.sqlite'))
+
+    def _adapter(self):
+        auth = v3.Password(auth_url='http://keystone/v3', username='user',
+                           password='pass', project_name='project',
+                           user_domain_id='default',
+                           project_domain_id='default')
+        return mock.Mock(service_type='baremetal', auth=auth)
+
+    def _token(self, adapter, token_id='token'):
+        expires = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        body = ks_fixture.V3Token(expires=expires, project_name='project')
+        adapter.auth.auth_ref = access.create(body=body,
+                                              auth_token=token_id)
+
+    def test_round_trip(self):
+        adapter = self._adapter()
+        adapter.get_token.side_effect = lambda: self._token(adapter)
+        ironic.Ironic(adapter, name='source', store=self.store).authenticate()
+        self.assertIsNotNone(self.store.get('auth:source'))
+
+        other = self._adapter()
+        ironic.Ironic(other, name='source', store=self.store)
+        self.assertEqual('token', other.auth.auth_ref.auth_token)
+        self.assertEqual('project', other.auth.auth_ref.project_name)
+
+        # Sources do not share tokens
+        another = self._adapter()
+        ironic.Ironic(another, name='another', store=self.store)
+        self.assertIsNone(another.auth.auth_ref)
+
+    def test_saved_on_change(self):
+        adapter = self._adapter()
+        adapter.request.return_value = mock.Mock(status_code=200)
+        cli = ironic.Ironic(adapter, name='source', store=self.store)
+        with mock.patch.object(self.store, 'set', autospec=True) as set_:
+            cli.request('/', 'GET')
+            set_.assert_not_called()
+
+            self._token(adapter)
+            cli.request('/', 'GET')
+            cli.request('/', 'GET')
+            set_.assert_called_once_with('auth:source', mock.ANY,
+                                         time=mock.ANY)
+            self.assertTrue(3500 < set_.call_args[1]['time'] <= 3600)
+
+            self._token(adapter, 'new token')
+            cli.request('/', 'GET')
+            self.assertEqual(2, set_.call_count)
+
+    def test_store_failure(self):
+        adapter = self._adapter()
+        adapter.get_token.side_effect = lambda: self._token(adapter)
+        with mock.patch.object(self.store, 'get', autospec=True,
+                               side_effect=RuntimeError('boom')):
+            cli = ironic.Ironic(adapter, name='source', store=self.store)
+        self.assertIsNone(adapter.auth.auth_ref)
+        with mock.patch.object(self.store, 'set', autospec=True,
+                               side_effect=RuntimeError('boom')):
+            cli.authenticate()
+        self.assertEqual('token', adapter.auth.auth_ref.auth_token)
@@ -0,0 +1,75 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import mock
+
+from ironic_proxy import metrics
+from ironic_proxy.tests import base
+
+
+class TestMetrics(base.TestCase):
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        for name in ('_REGISTRY', '_COLLECTORS'):
+            patcher = mock.patch.object(metrics, name, [])
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_counter(self):
+        counter = metrics.Counter('test_total', 'Test.', ['source'])
+        counter.inc(source='a')
+        counter.inc(2, source='a"b')
+        self.assertEqual('# HELP test_total Test.\n'
+                         '# TYPE test_total counter\n'
+                         'test_total{source="a"} 1.0\n'
+                         'test_total{source="a\\"b"} 2.0\n',
+                         metrics.render())
+
+    def test_gauge_and_collector(self):
+        gauge = metrics.Gauge('test_size', 'Size.')
+        metrics.on_collect(lambda: gauge.set(42))
+        self.assertIn('test_size 42.0\n', metrics.render())
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', 'Time.',
+                                      buckets=(1, 10))
+        histogram.observe(0.5)
+        histogram.observe(5)
+        lines = metrics.render().splitlines()
+        self.assertEqual(['test_seconds_bucket{le="1.0"} 1.0',
+                          'test_seconds_bucket{le="10.0"} 2.0',
+                          'test_seconds_bucket{le="+Inf"} 2.0',
+                          'test_seconds_count 2.0',
+                          'test_seconds_sum 5.5'], lines[2:])
+
+    def test_failed_collector(self):
+        def _fail():
+            raise RuntimeError('boom')
+
+        metrics.on_collect(_fail)
+        metrics.Counter('test_total', 'Test.').inc()
+        self.assertIn('test_total 1.0\n', metrics.render())
+
+
+class TestMetricsEndpoint(base.ProxyTestCase):
+
+    def test_backend_errors(self):
+        self.client.get('/v1/nodes/nope')
+        resp = self.client.get('/metrics')
+        self.assertEqual(200, resp.status_code)
+        self.assertIn('source="fake-g1",status="404"',
+                      resp.get_data(as_text=True))
+
+    def test_disabled(self):
+        self.config.config(enable_metrics=False, group='api')
+        self.assertEqual(404, self.client.get('/metrics').status_code)
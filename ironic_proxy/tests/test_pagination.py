@@ -0,0 +1,202 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from six.moves.urllib import parse as urlparse
+
+from ironic_proxy import common
+from ironic_proxy import pagination
+from ironic_proxy.tests import base
+
+
+class TestMarkers(base.TestCase):
+
+    def test_round_trip(self):
+        positions = {'': 'uuid1', 'g1': 'uuid2'}
+        marker = pagination.encode_marker(positions)
+        self.assertEqual(positions, pagination.decode_marker(marker))
+
+    def test_empty(self):
+        self.assertEqual({}, pagination.decode_marker(None))
+        self.assertEqual({}, pagination.decode_marker(''))
+
+    def test_not_encoded(self):
+        self.assertIsNone(pagination.decode_marker(
+            '1be26c0b-03f2-4d2e-ae87-c02d7f33c123'))
+        self.assertIsNone(pagination.decode_marker('node-1'))
+        self.assertIsNone(pagination.decode_marker(
+            pagination.encode_marker(['not', 'a', 'dict'])))
+
+
+class TestParseLimit(base.TestCase):
+
+    def test_values(self):
+        self.assertIsNone(pagination.parse_limit(None, 100))
+        self.assertIsNone(pagination.parse_limit('', 100))
+        self.assertEqual(10, pagination.parse_limit('10', 100))
+        self.assertEqual(100, pagination.parse_limit('0', 100))
+        self.assertEqual(100, pagination.parse_limit('1000', 100))
+
+    def test_invalid(self):
+        self.assertRaises(common.Error, pagination.parse_limit, 'x', 100)
+        self.assertRaises(common.Error, pagination.parse_limit, '-1', 100)
+
+
+class TestMerge(base.TestCase):
+
+    listings = [('', [{'uuid': 'a', 'name': 'n3'},
+                      {'uuid': 'c', 'name': None}]),
+                ('g1', [{'uuid': 'a', 'name': 'n1'},
+                        {'uuid': 'b', 'name': 'n2'}])]
+
+    def test_merge(self):
+        result = pagination.merge(self.listings, 3, 'uuid')
+        self.assertEqual([('', 'a'), ('g1', 'a'), ('g1', 'b')],
+                         [(group, node['uuid']) for group, node in result])
+
+    def test_merge_desc_with_none(self):
+        listings = [(group, list(reversed(nodes)))
+                    for group, nodes in self.listings]
+        result = pagination.merge(listings, 10, 'name', 'desc')
+        self.assertEqual(['n3', 'n2', 'n1', None],
+                         [node['name'] for _group, node in result])
+
+    def test_iter_merged(self):
+        listings = [('', iter([{'name': 'n1'}, {'name': 'n4'}])),
+                    ('g1', iter([{'name': 'n2'}, {'name': 'n3'},
+                                 {'name': 'n5'}]))]
+        result = pagination.iter_merged(listings, 'name')
+        self.assertEqual(('', {'name': 'n1'}), next(result))
+        self.assertEqual([('g1', 'n2'), ('g1', 'n3'), ('', 'n4'),
+                          ('g1', 'n5')],
+                         [(group, node['name']) for group, node in result])
+
+    def test_iter_merged_desc_with_none(self):
+        listings = [('', [{'name': 'n3'}, {'name': None}]),
+                    ('g1', [{'name': 'n2'}, {'name': 'n2'}, {'name': None}])]
+        result = pagination.iter_merged(listings, 'name', 'desc')
+        self.assertEqual([('', 'n3'), ('g1', 'n2'), ('g1', 'n2'),
+                          ('g1', None), ('', None)],
+                         [(group, node['name']) for group, node in result])
+
+    def test_precedes(self):
+        first = pagination.position('', {'uuid': 'a'}, 'uuid')
+        second = pagination.position('g1', {'uuid': 'a'}, 'uuid')
+        self.assertTrue(pagination.precedes(first, second))
+        self.assertFalse(pagination.precedes(first, second, 'desc'))
+
+    def test_required_fields(self):
+        self.assertEqual((None, set()),
+                         pagination.required_fields({}, 'name'))
+        self.assertEqual(('name,uuid', {'uuid'}),
+                         pagination.required_fields({'fields': 'name'},
+                                                    'name'))
+        self.assertEqual(('power_state,name,uuid', {'name', 'uuid'}),
+                         pagination.required_fields(
+                             {'fields': 'power_state'}, 'name'))
+
+
+class TestPaginatedListing(base.ProxyTestCase):
+
+    GROUPS = {'': 7, 'g1': 5}
+
+    def _all(self, sort_key='uuid', sort_dir='asc'):
+        listings = [(group, source.nodes)
+                    for group, source in sorted(self.sources.items())]
+        listings = [(group, sorted(nodes, key=lambda n: n[sort_key],
+                                   reverse=(sort_dir == 'desc')))
+                    for group, nodes in listings]
+        return [node['uuid'] for _group, node in
+                pagination.merge(listings, 100, sort_key, sort_dir)]
+
+    def _get(self, url):
+        resp = self.client.get(url)
+        self.assertEqual(200, resp.status_code, resp.get_data())
+        body = resp.get_json()
+        return [node['uuid'] for node in body['nodes']], body.get('next')
+
+    def _follow(self, url):
+        result = []
+        while url:
+            page, url = self._get(url)
+            result.extend(page)
+        return result
+
+    def test_pages(self):
+        expected = self._all()
+        page, next_link = self._get('/v1/nodes?limit=5')
+        self.assertEqual(expected[:5], page)
+        self.assertIsNotNone(next_link)
+        self.assertEqual(expected, self._follow('/v1/nodes?limit=5'))
+
+    def test_pages_sorted_desc(self):
+        expected = self._all('name', 'desc')
+        self.assertEqual(
+            expected,
+            self._follow('/v1/nodes?limit=4&sort_key=name&sort_dir=desc'))
+
+    def test_last_page_has_no_link(self):
+        _page, next_link = self._get('/v1/nodes?limit=100')
+        self.assertIsNone(next_link)
+
+    def test_fields_for_merging_are_hidden(self):
+        resp = self.client.get('/v1/nodes?limit=3&fields=name&sort_key=name')
+        self.assertEqual(200, resp.status_code)
+        for node in resp.get_json()['nodes']:
+            self.assertEqual(['name'], list(node))
+
+    def test_streamed_sorted(self):
+        for sort_key, sort_dir in [('name', 'desc'), ('name', 'asc'),
+                                   ('uuid', 'desc')]:
+            page, next_link = self._get('/v1/nodes?sort_key=%s&sort_dir=%s'
+                                        % (sort_key, sort_dir))
+            self.assertEqual(self._all(sort_key, sort_dir), page)
+            self.assertIsNone(next_link)
+
+    def test_streamed_sort_dir_only(self):
+        page, _next = self._get('/v1/nodes?sort_dir=desc')
+        self.assertEqual(self._all('uuid', 'desc'), page)
+
+    def test_streamed_sort_key_hidden(self):
+        resp = self.client.get('/v1/nodes?fields=uuid&sort_key=name')
+        self.assertEqual(200, resp.status_code)
+        nodes = resp.get_json()['nodes']
+        self.assertEqual(self._all('name'), [node['uuid'] for node in nodes])
+        for node in nodes:
+            self.assertEqual(['uuid'], list(node))
+
+    def test_streamed_invalid_sort_dir(self):
+        resp = self.client.get('/v1/nodes?sort_dir=up')
+        self.assertEqual(400, resp.status_code)
+
+    def test_uuid_marker(self):
+        expected = self._all()
+        for index in (0, 3, 6, len(expected) - 1):
+            page, next_link = self._get('/v1/nodes?limit=3&marker=%s'
+                                        % expected[index])
+            self.assertEqual(expected[index + 1:index + 4], page)
+            if next_link:
+                query = urlparse.parse_qs(urlparse.urlsplit(next_link).query)
+                rest = self._follow('/v1/nodes?limit=3&marker=%s'
+                                    % query['marker'][0])
+                self.assertEqual(expected[index + 1:], page + rest)
+
+    def test_uuid_marker_sorted_by_name(self):
+        expected = self._all('name')
+        page, _next = self._get('/v1/nodes?limit=4&sort_key=name&marker=%s'
+                                % expected[2])
+        self.assertEqual(expected[3:7], page)
+
+    def test_unknown_marker(self):
+        resp = self.client.get('/v1/nodes?limit=3&marker=nope')
+        self.assertEqual(400, resp.status_code)
+        self.assertIn('Invalid marker',
+                      resp.get_json()['error_message']['faultstring'])
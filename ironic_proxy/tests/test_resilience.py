@@ -0,0 +1,97 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import time
+
+import mock
+
+from ironic_proxy import conf
+from ironic_proxy import resilience
+from ironic_proxy.tests import base
+
+
+class TestCircuitBreaker(base.TestCase):
+
+    def setUp(self):
+        super(TestCircuitBreaker, self).setUp()
+        self.breaker = resilience.CircuitBreaker(threshold=2,
+                                                 reset_timeout=10)
+
+    def test_opens_after_failures(self):
+        self.breaker.failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.failure()
+        self.assertFalse(self.breaker.allow())
+        self.assertFalse(self.breaker.is_available())
+
+    def test_success_resets(self):
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+        self.assertTrue(self.breaker.allow())
+
+    def test_half_open(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        with mock.patch.object(time, 'time', return_value=time.time() + 11):
+            self.assertTrue(self.breaker.is_available())
+            # Only one request is let through
+            self.assertTrue(self.breaker.allow())
+            self.assertFalse(self.breaker.allow())
+            self.breaker.success()
+            self.assertTrue(self.breaker.allow())
+
+    def test_disabled(self):
+        breaker = resilience.CircuitBreaker(threshold=0)
+        for _i in range(10):
+            breaker.failure()
+        self.assertTrue(breaker.allow())
+
+
+class TestPolicyTimeout(base.TestCase):
+
+    def setUp(self):
+        super(TestPolicyTimeout, self).setUp()
+        self.policy = resilience.Policy(min_timeout=1, max_timeout=60,
+                                        timeout_multiplier=3)
+
+    def _observe(self, latency):
+        for _i in range(resilience.MIN_SAMPLES):
+            self.policy.latency['get'].add(latency)
+
+    def test_default_is_finite(self):
+        self.config.register_opts(conf.resilience_opts, group='group:test')
+        policy = resilience.Policy.from_options(conf.CONF['group:test'])
+        self.assertEqual(60, policy.timeout('get'))
+
+    def test_no_samples(self):
+        self.assertEqual(60, self.policy.timeout('get'))
+        self.assertEqual(5, self.policy.timeout('get', requested=5))
+
+    def test_observed(self):
+        self._observe(2)
+        self.assertEqual(6, self.policy.timeout('get'))
+        self.assertEqual(4, self.policy.timeout('get', requested=4))
+        # Other categories are not affected
+        self.assertEqual(60, self.policy.timeout('list'))
+
+    def test_bounds(self):
+        self._observe(0.1)
+        self.assertEqual(1, self.policy.timeout('get'))
+        self.policy.latency['get'] = resilience.LatencyTracker()
+        self._observe(100)
+        self.assertEqual(60, self.policy.timeout('get'))
+
+    def test_no_limit(self):
+        policy = resilience.Policy()
+        self.assertIsNone(policy.timeout('get'))
+        self.assertEqual(5, policy.timeout('get', requested=5))
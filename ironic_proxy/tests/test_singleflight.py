@@ -0,0 +1,86 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import threading
+import time
+
+from ironic_proxy import singleflight
+from ironic_proxy.tests import base
+
+
+class TestSingleFlight(base.TestCase):
+
+    def setUp(self):
+        super(TestSingleFlight, self).setUp()
+        self.flight = singleflight.SingleFlight('test')
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def _slow(self, value):
+        self.calls.append(value)
+        self.started.set()
+        self.release.wait(5)
+        if isinstance(value, Exception):
+            raise value
+        return {'value': value}
+
+    def _run(self, key, value, count):
+        results = [None] * count
+
+        def _call(index):
+            try:
+                results[index] = self.flight.do(key, self._slow, value)
+            except Exception as exc:
+                results[index] = exc
+
+        threads = [threading.Thread(target=_call, args=(0,))]
+        threads[0].start()
+        self.started.wait(5)
+        for index in range(1, count):
+            threads.append(threading.Thread(target=_call, args=(index,)))
+            threads[-1].start()
+        # Let the waiters join the call in progress
+        for _i in range(500):
+            if self.flight._calls[key].waiters >= count - 1:
+                break
+            time.sleep(0.01)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_coalesced(self):
+        results = self._run('key', 42, 5)
+        self.assertEqual([42], self.calls)
+        self.assertEqual([{'value': 42}] * 5, results)
+        # Every caller gets its own copy
+        self.assertEqual(5, len({id(result) for result in results}))
+
+    def test_error_shared(self):
+        error = RuntimeError('boom')
+        results = self._run('key', error, 3)
+        self.assertEqual(1, len(self.calls))
+        self.assertEqual([error] * 3, results)
+
+    def test_sequential_not_coalesced(self):
+        self.release.set()
+        self.assertEqual({'value': 1}, self.flight.do('key', self._slow, 1))
+        self.assertEqual({'value': 2}, self.flight.do('key', self._slow, 2))
+        self.assertEqual([1, 2], self.calls)
+        self.assertEqual({}, self.flight._calls)
+
+    def test_different_keys(self):
+        self.release.set()
+        self.flight.do('key1', self._slow, 1)
+        self.flight.do('key2', self._slow, 2)
+        self.assertEqual([1, 2], self.calls)
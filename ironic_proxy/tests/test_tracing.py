@@ -0,0 +1,85 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import threading
+
+import mock
+from six.moves import queue
+
+from ironic_proxy import tracing
+from ironic_proxy.tests import base
+
+
+TRACEPARENT = '00-%s-%s-01' % ('a' * 32, 'b' * 16)
+
+
+class TestTrace(base.TestCase):
+
+    def test_spans(self):
+        trace = tracing.start('GET /v1/nodes', TRACEPARENT)
+        self.assertEqual('a' * 32, trace.trace_id)
+        self.assertEqual('b' * 16, trace.root.parent_id)
+        with tracing.span('group:g1', group='g1') as child:
+            self.assertIs(child, tracing.current_span())
+            self.assertEqual('00-%s-%s-01' % ('a' * 32, child.span_id),
+                             tracing.headers()[tracing.TRACEPARENT_HEADER])
+        with mock.patch.object(tracing, '_export', autospec=True):
+            tracing.finish(trace)
+
+        self.assertIsNone(tracing.current_span())
+        self.assertEqual([child, trace.root], trace.spans)
+        self.assertEqual(trace.root.span_id, child.parent_id)
+        self.assertIn('group_g1;dur=', trace.server_timing())
+
+    def test_invalid_traceparent(self):
+        trace = tracing.Trace('GET /', 'nope')
+        self.assertEqual(32, len(trace.trace_id))
+        self.assertIsNone(trace.root.parent_id)
+
+    def test_no_trace(self):
+        with tracing.span('nothing') as noop:
+            noop.attributes['key'] = 'value'
+        self.assertEqual({}, tracing.headers())
+
+
+class TestCollector(base.TestCase):
+
+    def setUp(self):
+        super(TestCollector, self).setUp()
+        self.config.config(collector_url='http://collector', group='tracing')
+        for name in ('_QUEUE', '_QUEUE_PID'):
+            patcher = mock.patch.object(tracing, name, None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(threading, 'Thread', autospec=True)
+        self.mock_thread = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_full_queue_does_not_block(self):
+        traces = queue.Queue(maxsize=1)
+        with mock.patch.object(tracing, '_collector_queue',
+                               return_value=traces):
+            tracing.finish(tracing.Trace('first'))
+            with mock.patch.object(tracing.TRACES_DROPPED, 'inc',
+                                   autospec=True) as mock_inc:
+                tracing.finish(tracing.Trace('second'))
+                mock_inc.assert_called_once_with()
+        self.assertEqual('first', traces.get_nowait().root.name)
+
+    def test_new_sender_after_fork(self):
+        traces = tracing._collector_queue()
+        self.assertIs(traces, tracing._collector_queue())
+        self.assertEqual(1, self.mock_thread.call_count)
+        with mock.patch.object(os, 'getpid', return_value=-1):
+            self.assertIsNot(traces, tracing._collector_queue())
+        self.assertEqual(2, self.mock_thread.call_count)
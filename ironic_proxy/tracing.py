@@ -0,0 +1,275 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Lightweight request tracing compatible with OpenTelemetry.
+
+Uses the W3C Trace Context format for propagation and the OTLP JSON format
+for export.
+"""
+
+import binascii
+import collections
+import contextlib
+import functools
+import json
+import os
+import re
+import threading
+import time
+
+from oslo_log import log
+import requests
+from six.moves import queue
+
+from ironic_proxy import metrics
+
+
+LOG = log.getLogger(__name__)
+TRACEPARENT_HEADER = 'traceparent'
+_TRACEPARENT_RE = re.compile(
+    r'^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+_LOCAL = threading.local()
+_FILE_LOCK = threading.Lock()
+_QUEUE = None
+_QUEUE_PID = None
+_QUEUE_LOCK = threading.Lock()
+_DROPPING = False
+
+TRACES_DROPPED = metrics.Counter(
+    'ironic_proxy_traces_dropped_total',
+    'Traces not sent to the collector because its queue was full')
+
+
+def _random_id(size):
+    return binascii.hexlify(os.urandom(size)).decode('ascii')
+
+
+class Span(object):
+    """A timed operation within a trace."""
+
+    def __init__(self, trace, name, parent_id=None, attributes=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = _random_id(8)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self.end = None
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def to_otlp(self):
+        result = {
+            'traceId': self.trace.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'startTimeUnixNano': str(int(self.start * 1e9)),
+            'endTimeUnixNano': str(int((self.end or time.time()) * 1e9)),
+            'attributes': [{'key': key, 'value': {'stringValue': str(value)}}
+                           for key, value in sorted(self.attributes.items())],
+        }
+        if self.parent_id:
+            result['parentSpanId'] = self.parent_id
+        return result
+
+
+class Trace(object):
+    """All spans of one API request."""
+
+    def __init__(self, name, traceparent=None):
+        parent_id = None
+        match = _TRACEPARENT_RE.match(traceparent or '')
+        if match:
+            self.trace_id, parent_id = match.group(1), match.group(2)
+        else:
+            self.trace_id = _random_id(16)
+        self.spans = []
+        self._lock = threading.Lock()
+        self.root = Span(self, name, parent_id)
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def finish(self):
+        self.root.end = time.time()
+        self.add(self.root)
+
+    def server_timing(self):
+        """Build the value of the Server-Timing header."""
+        totals = collections.OrderedDict()
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            if span is not self.root:
+                totals[span.name] = totals.get(span.name, 0) + span.duration
+        totals['total'] = self.root.duration
+        return ', '.join('%s;dur=%.1f' % (re.sub(r'[^\w.-]', '_', name),
+                                          value * 1000)
+                         for name, value in totals.items())
+
+
+class _NoopSpan(object):
+    attributes = {}
+
+
+def _stack():
+    try:
+        return _LOCAL.stack
+    except AttributeError:
+        _LOCAL.stack = []
+        return _LOCAL.stack
+
+
+def current_span():
+    """Get the span active in this thread or None."""
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+def start(name, traceparent=None):
+    """Start a new trace and activate it in this thread."""
+    trace = Trace(name, traceparent)
+    _stack().append(trace.root)
+    return trace
+
+
+def finish(trace):
+    """Finish the trace, deactivate it and export it."""
+    trace.finish()
+    stack = _stack()
+    while stack and stack[-1].trace is trace:
+        stack.pop()
+    _export(trace)
+
+
+@contextlib.contextmanager
+def span(name, parent=None, **attributes):
+    """Record a child span of the given or the current span.
+
+    Does nothing if there is no active trace. Pass the parent explicitly when
+    running in a different thread.
+    """
+    if parent is None:
+        parent = current_span()
+    if parent is None:
+        yield _NoopSpan()
+        return
+
+    new = Span(parent.trace, name, parent.span_id, attributes)
+    stack = _stack()
+    stack.append(new)
+    try:
+        yield new
+    finally:
+        new.end = time.time()
+        stack.pop()
+        parent.trace.add(new)
+
+
+def traced(name):
+    """Decorator recording a span for every call of the function."""
+    def _decorator(func):
+        @functools.wraps(func)
+        def _wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return _wrapper
+    return _decorator
+
+
+def headers():
+    """Get headers to propagate the current span to another service."""
+    current = current_span()
+    if current is None:
+        return {}
+    value = '00-%s-%s-01' % (current.trace.trace_id, current.span_id)
+    return {TRACEPARENT_HEADER: value}
+
+
+def _otlp(traces):
+    spans = [s.to_otlp() for trace in traces for s in trace.spans]
+    return {'resourceSpans': [{
+        'resource': {'attributes': [
+            {'key': 'service.name', 'value': {'stringValue': 'ironic-proxy'}},
+        ]},
+        'scopeSpans': [{'scope': {'name': __name__}, 'spans': spans}],
+    }]}
+
+
+def _export(trace):
+    from ironic_proxy import conf
+
+    path = conf.CONF.tracing.export_path
+    if path:
+        lines = ''.join(json.dumps(s.to_otlp()) + '\n' for s in trace.spans)
+        try:
+            with _FILE_LOCK:
+                with open(path, 'a') as fp:
+                    fp.write(lines)
+        except EnvironmentError as exc:
+            LOG.warning('Cannot write trace to %s: %s', path, exc)
+
+    if conf.CONF.tracing.collector_url:
+        _send(trace)
+
+
+def _send(trace):
+    global _DROPPING
+    # Never block the request if the collector is slow.
+    try:
+        _collector_queue().put_nowait(trace)
+    except queue.Full:
+        TRACES_DROPPED.inc()
+        if not _DROPPING:
+            LOG.warning('The queue of traces to send to the collector is '
+                        'full, dropping traces')
+        _DROPPING = True
+    else:
+        _DROPPING = False
+
+
+def _collector_queue():
+    global _QUEUE, _QUEUE_PID
+    # Threads do not survive fork, start a new sender in
+    # every process.
+    pid = os.getpid()
+    with _QUEUE_LOCK:
+        if _QUEUE is None or _QUEUE_PID != pid:
+            _QUEUE = queue.Queue(maxsize=1000)
+            _QUEUE_PID = pid
+            thread = threading.Thread(target=_send_loop, args=(_QUEUE,),
+                                      name='ironic-proxy-tracing')
+            thread.daemon = True
+            thread.start()
+        return _QUEUE
+
+
+def _send_loop(traces):
+    from ironic_proxy import conf
+
+    while True:
+        batch = [traces.get()]
+        while True:
+            try:
+                batch.append(traces.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            requests.post(conf.CONF.tracing.collector_url, json=_otlp(batch),
+                          timeout=10).raise_for_status()
+        except Exception as exc:
+            LOG.warning('Cannot send %d traces to %s: %s', len(batch),
+                        conf.CONF.tracing.collector_url, exc)